@@ -0,0 +1,290 @@
+"""
+Benchmarks for the PAE encoder and decoder.
+
+Each benchmark reports throughput (operations per second and MB/s of
+encoded data) and the peak memory allocated by a single operation, as
+measured by :mod:`tracemalloc`.
+
+Usage::
+
+    python benchmarks/bench_pae.py                      # run everything
+    python benchmarks/bench_pae.py -k 'unmarshal.*list'  # select by regex
+    python benchmarks/bench_pae.py --save before.json
+    python benchmarks/bench_pae.py --compare before.json --threshold 0.1
+
+With ``--compare``, the script exits with a non-zero status if any
+benchmark's throughput dropped by more than the threshold (as a fraction).
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+import timeit
+import tracemalloc
+from dataclasses import dataclass, asdict
+from typing import Callable, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import python_pae  # noqa: E402
+from python_pae import (  # noqa: E402
+    pae_encode, pae_encode_batch, pae_decode, pae_encode_multiple,
+    marshal, unmarshal
+)
+from python_pae.encode import PAEListSettings  # noqa: E402
+from python_pae.pae_types import (  # noqa: E402
+    PAEBytes, PAEString, PAEHomogeneousList, PAEHeterogeneousList,
+    PAE_UCHAR, PAE_USHORT, PAE_UINT, PAE_ULLONG
+)
+
+NUMBER_TYPES = [
+    ('uchar', PAE_UCHAR), ('ushort', PAE_USHORT),
+    ('uint', PAE_UINT), ('ullong', PAE_ULLONG),
+]
+
+
+@dataclass
+class Benchmark:
+    name: str
+    func: Callable[[], object]
+    nbytes: int
+    """
+    Number of bytes of encoded data processed by one call to ``func``.
+    """
+
+
+@dataclass
+class Result:
+    name: str
+    ops_per_sec: float
+    mb_per_sec: float
+    peak_memory: int
+
+
+def _codec_benchmarks(name: str, value, pae_type) -> List[Benchmark]:
+    encoded = marshal(value, pae_type)
+    assert unmarshal(encoded, pae_type) == value
+    return [
+        Benchmark(
+            f'marshal/{name}', lambda: marshal(value, pae_type), len(encoded)
+        ),
+        Benchmark(
+            f'unmarshal/{name}', lambda: unmarshal(encoded, pae_type),
+            len(encoded)
+        ),
+    ]
+
+
+def _deep_list(depth: int):
+    pae_type = PAEBytes()
+    value = b'leaf'
+    for _ in range(depth):
+        pae_type = PAEHomogeneousList(pae_type)
+        value = [value, value]
+    return value, pae_type
+
+
+def build_benchmarks() -> List[Benchmark]:
+    benchmarks = []
+
+    small = [b'x' * 16] * 4
+    benchmarks.append(Benchmark(
+        'pae_encode/4x16B', lambda: pae_encode(small),
+        len(pae_encode(small))
+    ))
+    many = [os.urandom(32) for _ in range(1000)]
+    benchmarks.append(Benchmark(
+        'pae_encode/1000x32B', lambda: pae_encode(many),
+        len(pae_encode(many))
+    ))
+    many_encoded = pae_encode(many)
+    benchmarks.append(Benchmark(
+        'pae_decode/1000x32B', lambda: pae_decode(many_encoded),
+        len(many_encoded)
+    ))
+    batch = [small] * 100
+    benchmarks.append(Benchmark(
+        'pae_encode_batch/100x4x16B', lambda: pae_encode_batch(batch),
+        100 * len(pae_encode(small))
+    ))
+    pairs = [
+        (b'header', PAEBytes()), ('text é', PAEString()),
+        (12345, PAE_UINT),
+        ([b'a', b'bc', b'def'], PAEHomogeneousList(PAEBytes())),
+    ]
+    benchmarks.append(Benchmark(
+        'pae_encode_multiple/mixed', lambda: pae_encode_multiple(pairs),
+        len(pae_encode_multiple(pairs))
+    ))
+
+    for type_name, num_type in NUMBER_TYPES:
+        values = list(range(256)) * 4
+        benchmarks += _codec_benchmarks(f'number/{type_name}', 200, num_type)
+        packed = PAEHomogeneousList(
+            num_type, settings=PAEListSettings(prefix_if_constant=False)
+        )
+        benchmarks += _codec_benchmarks(
+            f'list/{type_name}x1024', values, packed
+        )
+        prefixed = PAEHomogeneousList(
+            num_type, settings=PAEListSettings(prefix_if_constant=True)
+        )
+        benchmarks += _codec_benchmarks(
+            f'list/prefixed-{type_name}x1024', values, prefixed
+        )
+
+    wide_bytes = [os.urandom(24) for _ in range(10000)]
+    benchmarks += _codec_benchmarks(
+        'list/wide-bytes', wide_bytes, PAEHomogeneousList(PAEBytes())
+    )
+    wide_strings = ['label %d' % i for i in range(10000)]
+    benchmarks += _codec_benchmarks(
+        'list/wide-strings', wide_strings, PAEHomogeneousList(PAEString())
+    )
+
+    record_type = PAEHeterogeneousList([
+        PAE_ULLONG, PAEString(), PAEBytes(),
+        PAEHomogeneousList(PAE_USHORT), PAE_UCHAR,
+    ])
+    records = [
+        [i, 'name %d' % i, os.urandom(16), [1, 2, 3], i % 256]
+        for i in range(1000)
+    ]
+    benchmarks += _codec_benchmarks(
+        'list/records', records, PAEHomogeneousList(record_type)
+    )
+    wide_htrg = PAEHeterogeneousList([PAEBytes(), PAE_UINT] * 100)
+    benchmarks += _codec_benchmarks(
+        'list/wide-heterogeneous', [b'abc', 7] * 100, wide_htrg
+    )
+    deep_value, deep_type = _deep_list(12)
+    benchmarks += _codec_benchmarks('list/deep', deep_value, deep_type)
+
+    big = [os.urandom(4 * 1024 * 1024) for _ in range(4)]
+    benchmarks += _codec_benchmarks(
+        'bytes/4x4MiB', big, PAEHomogeneousList(PAEBytes())
+    )
+    return benchmarks
+
+
+def run_benchmark(benchmark: Benchmark, repeat: int,
+                  min_time: float) -> Result:
+    timer = timeit.Timer(benchmark.func)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(1, int(number * min_time / elapsed))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    ops = 1 / best
+
+    tracemalloc.start()
+    try:
+        benchmark.func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return Result(
+        name=benchmark.name, ops_per_sec=ops,
+        mb_per_sec=ops * benchmark.nbytes / 1e6, peak_memory=peak,
+    )
+
+
+def compare(old_results: dict, new_results: List[Result],
+            threshold: float) -> List[str]:
+    old_by_name = {r['name']: r for r in old_results['results']}
+    regressions = []
+    print()
+    print(f'{"benchmark":<40} {"old ops/s":>12} {"new ops/s":>12} '
+          f'{"change":>8}')
+    for result in new_results:
+        old = old_by_name.get(result.name)
+        if old is None:
+            continue
+        change = result.ops_per_sec / old['ops_per_sec'] - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(result.name)
+            flag = '  REGRESSION'
+        print(f'{result.name:<40} {old["ops_per_sec"]:>12.1f} '
+              f'{result.ops_per_sec:>12.1f} {change:>+8.1%}{flag}')
+    return regressions
+
+
+def _metadata() -> dict:
+    return {
+        'python_pae_version': python_pae.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '-k', '--filter', metavar='REGEX',
+        help='only run benchmarks whose name matches this expression'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='number of timing runs per benchmark, best one is kept'
+    )
+    parser.add_argument(
+        '--min-time', type=float, default=0.2,
+        help='minimal duration of a timing run in seconds'
+    )
+    parser.add_argument(
+        '--save', metavar='FILE', help='write the results to a JSON file'
+    )
+    parser.add_argument(
+        '--compare', metavar='FILE',
+        help='compare the results with those in a JSON file'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative slowdown that counts as a regression (default: 0.1)'
+    )
+    args = parser.parse_args(argv)
+
+    old_results = None
+    if args.compare:
+        with open(args.compare) as inf:
+            old_results = json.load(inf)
+
+    benchmarks = build_benchmarks()
+    if args.filter:
+        pattern = re.compile(args.filter)
+        benchmarks = [b for b in benchmarks if pattern.search(b.name)]
+
+    print(f'{"benchmark":<40} {"ops/s":>12} {"MB/s":>10} {"peak KiB":>10}')
+    results = []
+    for benchmark in benchmarks:
+        result = run_benchmark(benchmark, args.repeat, args.min_time)
+        results.append(result)
+        print(f'{result.name:<40} {result.ops_per_sec:>12.1f} '
+              f'{result.mb_per_sec:>10.2f} {result.peak_memory / 1024:>10.1f}')
+
+    if args.save:
+        with open(args.save, 'w') as outf:
+            json.dump({
+                'metadata': _metadata(),
+                'results': [asdict(r) for r in results],
+            }, outf, indent=2)
+
+    if old_results is not None:
+        regressions = compare(old_results, results, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} benchmark(s) regressed by more than '
+                  f'{args.threshold:.0%}: {", ".join(regressions)}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
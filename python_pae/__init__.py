@@ -7,17 +7,23 @@ This is the main entry point for the PAE encoding/decoding API.
 
 __version__ = '0.1.0'
 
-from typing import List
+from typing import List, Any, Iterable, Optional
 
 from .pae_types import PAEBytes, PAEHomogeneousList, PAEHeterogeneousList
-from .encode import marshal, unmarshal, PAEListSettings
+from .encode import (
+    marshal, unmarshal, marshal_to_digest, PAEListSettings, PAEPreEncoded
+)
 from .abstract import PAEDecodeError
-from .number import PAENumberType, PAE_ULLONG
+from .limits import PAEDecodeLimits, decode_limits, _current_budget
+from .instrument import _current_tracer
+from .number import PAENumberType, PAE_ULLONG, _STRUCT_NUMS
 
 __all__ = [
-    'pae_encode', 'pae_encode_multiple',
-    'marshal', 'unmarshal', 'PAEListSettings',
-    'PAEDecodeError',
+    'pae_encode', 'pae_encode_batch', 'pae_decode', 'pae_encode_multiple',
+    'pae_digest', 'pae_encode_multiple_digest',
+    'marshal', 'unmarshal', 'marshal_to_digest', 'PAEListSettings',
+    'PAEPreEncoded',
+    'PAEDecodeError', 'PAEDecodeLimits', 'decode_limits',
 ]
 
 
@@ -38,9 +44,75 @@ def pae_encode(lst: List[bytes], size_t: PAENumberType = PAE_ULLONG) -> bytes:
         The PAE-encoded list as a byte string.
     """
 
-    settings = PAEListSettings(size_type=size_t)
-    lst_type = PAEHomogeneousList(PAEBytes(), settings=settings)
-    return marshal(lst, lst_type)
+    pack = _fast_path_pack(size_t)
+    if pack is not None:
+        encoded = _encode_bytes_list(lst, pack)
+        if encoded is not None:
+            return encoded
+    return marshal(lst, _bytes_list_type(size_t))
+
+
+def pae_encode_batch(lists: Iterable[List[bytes]],
+                     size_t: PAENumberType = PAE_ULLONG) -> List[bytes]:
+    """
+    Encode several lists of byte strings in PAE.
+
+    This is equivalent to ``[pae_encode(lst, size_t) for lst in lists]``,
+    but a little faster.
+
+    :param lists:
+        An iterable of lists of byte strings.
+    :param size_t:
+        Numeric type to use for the lists' sizes and their members' length
+        prefixes.
+    :return:
+        A list of PAE-encoded lists.
+    """
+
+    pack = _fast_path_pack(size_t)
+    if pack is None:
+        return [pae_encode(lst, size_t) for lst in lists]
+    result = []
+    append = result.append
+    for lst in lists:
+        encoded = _encode_bytes_list(lst, pack)
+        if encoded is None:
+            encoded = marshal(lst, _bytes_list_type(size_t))
+        append(encoded)
+    return result
+
+
+def pae_decode(packed: bytes,
+               size_t: PAENumberType = PAE_ULLONG) -> List[bytes]:
+    """
+    Decode a PAE-encoded list of byte strings.
+    Inverse operation of :func:`pae_encode`.
+
+    :param packed:
+        The byte string to be processed. Any object that supports the buffer
+        protocol is accepted.
+    :param size_t:
+        Numeric type used for the list's size and its members' length
+        prefixes.
+    :return:
+        A list of byte strings.
+    :raises PAEDecodeError:
+        if an error occurs in the decoding process.
+    """
+
+    size_struct = None
+    if _current_budget() is None:
+        size_struct = _fast_path_struct(size_t)
+    if size_struct is not None:
+        if type(packed) is not bytes:
+            packed = bytes(packed)
+        decoded = _decode_bytes_list(packed, size_struct)
+        if decoded is not None:
+            return decoded
+    # Either we can't use the fast path, or the input is malformed.
+    # In the latter case, the generic decoder will produce the
+    # appropriate error.
+    return unmarshal(packed, _bytes_list_type(size_t))
 
 
 def pae_encode_multiple(value_type_pairs,
@@ -59,10 +131,125 @@ def pae_encode_multiple(value_type_pairs,
         The PAE-encoded list as a byte string.
     """
 
+    values, lst_type = _split_value_type_pairs(value_type_pairs, size_t)
+    return marshal(values, lst_type)
+
+
+def pae_digest(lst: List[bytes], hasher: Any,
+               size_t: PAENumberType = PAE_ULLONG) -> int:
+    """
+    Encode a list of byte strings in PAE, and feed the result into
+    a hash or MAC object.
+
+    This is equivalent to ``hasher.update(pae_encode(lst, size_t))``,
+    but the encoded list is never held in memory in its entirety.
+
+    :param lst:
+        A list of byte strings.
+    :param hasher:
+        An object with an ``update()`` method, or an iterable of such
+        objects. See :func:`~python_pae.encode.marshal_to_digest`.
+    :param size_t:
+        Numeric type to use for the list's size and its members' length
+        prefixes.
+    :return:
+        The number of bytes fed into the hasher.
+    """
+
+    return marshal_to_digest(lst, _bytes_list_type(size_t), hasher)
+
+
+def pae_encode_multiple_digest(value_type_pairs, hasher: Any,
+                               size_t: PAENumberType = PAE_ULLONG) -> int:
+    """
+    Encode a list of multiple typed values in PAE, and feed the result into
+    a hash or MAC object.
+
+    This is equivalent to
+    ``hasher.update(pae_encode_multiple(value_type_pairs, size_t))``,
+    but the encoded list is never held in memory in its entirety.
+
+    :param value_type_pairs:
+        A list of tuples of the form ``(v, t)``, where ``v`` is a value,
+        and ``t`` is a :class:`~python_pae.abstract.PAEType` implementation
+        for that value type.
+    :param hasher:
+        An object with an ``update()`` method, or an iterable of such
+        objects. See :func:`~python_pae.encode.marshal_to_digest`.
+    :param size_t:
+        Numeric type to use for the list's size and its members' length
+        prefixes.
+    :return:
+        The number of bytes fed into the hasher.
+    """
+
+    values, lst_type = _split_value_type_pairs(value_type_pairs, size_t)
+    return marshal_to_digest(values, lst_type, hasher)
+
+
+def _fast_path_struct(size_t: PAENumberType):
+    # The fast path doesn't support instrumentation, or number types
+    # with custom encoding logic.
+    if _current_tracer() is not None or type(size_t) is not PAENumberType \
+            or not 0 <= size_t.value < len(_STRUCT_NUMS):
+        return None
+    return size_t._struct
+
+
+def _fast_path_pack(size_t: PAENumberType):
+    size_struct = _fast_path_struct(size_t)
+    return None if size_struct is None else size_struct.pack
+
+
+def _encode_bytes_list(lst, pack) -> Optional[bytes]:
+    # returns None if the list contains values other than byte strings
+    parts = [pack(len(lst))]
+    append = parts.append
+    for item in lst:
+        item_type = type(item)
+        if item_type is not bytes and item_type is not bytearray:
+            return None
+        append(pack(len(item)))
+        append(item)
+    return b''.join(parts)
+
+
+def _decode_bytes_list(packed: bytes, size_struct) -> Optional[List[bytes]]:
+    # returns None if the input is malformed
+    size_len = size_struct.size
+    unpack_from = size_struct.unpack_from
+    end = len(packed)
+    if end < size_len:
+        return None
+    count, = unpack_from(packed, 0)
+    pos = size_len
+    if pos + count * size_len > end:
+        return None
+    result = []
+    append = result.append
+    for _ in range(count):
+        item_start = pos + size_len
+        if item_start > end:
+            return None
+        item_end = item_start + unpack_from(packed, pos)[0]
+        if item_end > end:
+            return None
+        append(packed[item_start:item_end])
+        pos = item_end
+    if pos != end:
+        return None
+    return result
+
+
+def _bytes_list_type(size_t: PAENumberType) -> PAEHomogeneousList:
+    settings = PAEListSettings(size_type=size_t)
+    return PAEHomogeneousList(PAEBytes(), settings=settings)
+
+
+def _split_value_type_pairs(value_type_pairs, size_t: PAENumberType):
     settings = PAEListSettings(size_type=size_t)
     if value_type_pairs:
         values, types = zip(*value_type_pairs)
     else:
         values = types = ()
-    lst_type = PAEHeterogeneousList(types, settings=settings)
-    return marshal(values, lst_type)
+    return values, PAEHeterogeneousList(types, settings=settings)
@@ -46,6 +46,24 @@ class PAEType(Generic[T]):
         """
         raise NotImplementedError
 
+    def encoded_length(self, value: T) -> Optional[int]:
+        """
+        Compute the number of bytes that :meth:`write` would produce for
+        a value, without actually serialising it.
+
+        The default implementation returns :attr:`constant_length`.
+        Subclasses that can compute their output length cheaply should
+        override this method, since it allows length-prefixed values to be
+        written to a stream strictly sequentially.
+
+        :param value:
+            The value to measure.
+        :return:
+            The length of the serialised value, or ``None`` if it cannot be
+            determined in advance.
+        """
+        return self.constant_length
+
     def read(self, stream: IO, length: int) -> T:
         """
         Read a value from a stream, length prefix *not* included, and decode it.
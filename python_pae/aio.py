@@ -0,0 +1,300 @@
+"""
+This module provides :mod:`asyncio` counterparts to the encoding and
+decoding functions in :mod:`python_pae.encode`, operating on
+:class:`asyncio.StreamReader` and :class:`asyncio.StreamWriter` objects.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import asyncio
+from io import BytesIO
+from itertools import repeat
+from typing import TypeVar, Optional, Union
+
+from .abstract import PAEType, PAEDecodeError
+from .encode import (
+    PAEListSettings, PAEPreEncoded, marshal, prefixed_length,
+    _read_with_errh, _check_pre_encoded
+)
+from .limits import _current_budget
+from .pae_types import (
+    PAEHomogeneousList, PAEHeterogeneousList, _is_tree_node, _measure_tree,
+    _memoised_length
+)
+
+__all__ = ['marshal_async', 'unmarshal_async', 'read_pae_async']
+
+
+T = TypeVar('T')
+
+PAEListType = Union[PAEHomogeneousList, PAEHeterogeneousList]
+
+_LIST_TYPES = (PAEHomogeneousList, PAEHeterogeneousList)
+
+
+class _StreamWriterSink:
+    """
+    Adapter to make an :class:`asyncio.StreamWriter` usable as a
+    (non-seekable) output stream for :meth:`.PAEType.write`.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self._writer = writer
+
+    def write(self, data) -> int:
+        self._writer.write(data)
+        if isinstance(data, memoryview):
+            return data.nbytes
+        return len(data)
+
+    def seekable(self) -> bool:
+        return False
+
+
+def _item_length(item, item_type: PAEType, settings: PAEListSettings,
+                 length_t, lengths: dict) -> Optional[int]:
+    # Like prefixed_length(), but nested lists are measured once per call
+    # to marshal_async, instead of once per nesting level.
+    if type(item) is PAEPreEncoded or not _is_tree_node(item_type):
+        return prefixed_length(
+            item, item_type, length_t,
+            prefix_if_constant=settings.prefix_if_constant
+        )
+    try:
+        item_len = _memoised_length(lengths, item, item_type)
+    except KeyError:
+        item_len = _measure_tree(item, item_type, lengths)
+    if item_len is None:
+        return None
+    return item_len + length_t.constant_length
+
+
+async def _write_value(value, pae_type: PAEType, sink: _StreamWriterSink,
+                       writer: asyncio.StreamWriter, lengths: dict) -> int:
+    if type(value) is PAEPreEncoded:
+        _check_pre_encoded(value, pae_type)
+        return sink.write(value.encoded)
+    elif type(pae_type) not in _LIST_TYPES:
+        return pae_type.write(value, sink)
+
+    settings: PAEListSettings = pae_type.settings
+    size_t = settings.size_type
+    length_t = settings.length_type or size_t
+    if isinstance(pae_type, PAEHeterogeneousList):
+        if len(value) != len(pae_type.component_types):
+            raise ValueError(
+                f"Wrong number of components, expected "
+                f"{len(pae_type.component_types)} but got {len(value)}."
+            )
+        item_types = pae_type.component_types
+    else:
+        item_types = repeat(pae_type.child_type, len(value))
+
+    count = size_t.write(len(value), sink)
+    for item, item_type in zip(value, item_types):
+        const_len = item_type.constant_length
+        prefixed = settings.prefix_if_constant or const_len is None
+        item_len = _item_length(item, item_type, settings, length_t, lengths)
+        if item_len is None:
+            # can't determine the length in advance -> encode in memory
+            encoded = marshal(item, item_type)
+            count += length_t.write(len(encoded), sink)
+            count += sink.write(encoded)
+        else:
+            if prefixed:
+                item_len -= length_t.constant_length
+                count += length_t.write(item_len, sink)
+            written = await _write_value(
+                item, item_type, sink, writer, lengths
+            )
+            if written != item_len:
+                raise IOError(
+                    f"Expected to write {item_len} bytes,"
+                    f"but wrote {written}."
+                )
+            count += written
+        await writer.drain()
+    return count
+
+
+async def marshal_async(value: T, pae_type: PAEType[T],
+                        writer: asyncio.StreamWriter) -> int:
+    """
+    Serialise a value and write it to an :class:`asyncio.StreamWriter`.
+
+    The output is written sequentially, and the writer is drained
+    after every list element to respect flow control.
+
+    :param value:
+        The value to be processed.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param writer:
+        The stream writer to write to.
+    :return:
+        The number of bytes written.
+    """
+    written = await _write_value(
+        value, pae_type, _StreamWriterSink(writer), writer, {}
+    )
+    await writer.drain()
+    return written
+
+
+async def _read_exactly(reader: asyncio.StreamReader, size: int) -> bytes:
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        raise PAEDecodeError(
+            f"Expected {size} bytes, but only {len(e.partial)} were available"
+        ) from e
+
+
+async def read_pae_async(reader: asyncio.StreamReader,
+                         settings: PAEListSettings, expected_length=None):
+    """
+    Asynchronous generator to read a (possibly heterogeneous) PAE-encoded
+    list from an :class:`asyncio.StreamReader`.
+
+    The protocol is the same as that of
+    :func:`~python_pae.encode.read_pae_coro`, except that values are
+    passed in using ``asend()`` instead of ``send()``:
+
+        1. First, the generator parses and yields the number of list
+           elements.
+        2. Then, the caller should ``await agen.asend()`` a
+           :class:`.PAEType` object, after which the generator will yield
+           a value.
+        3. Repeat step 2 for each element of the list.
+
+    :param reader:
+        The stream reader to read from.
+    :param settings:
+        List encoding settings.
+    :param expected_length:
+        The expected byte length of the encoded list payload.
+        If ``None``, the length is not enforced.
+    :raises python_pae.PAEDecodeError:
+        if an error occurs in the decoding process.
+    :return:
+        An asynchronous generator object.
+    """
+    size_t = settings.size_type
+    length_t = settings.length_type or size_t
+    size_len = size_t.constant_length
+    part_count = size_t.unpack(await _read_exactly(reader, size_len))
+    bytes_read = size_len
+    budget = _current_budget()
+    if budget is not None:
+        budget.add_elements(part_count)
+    if not part_count and expected_length is not None \
+            and bytes_read != expected_length:
+        raise PAEDecodeError(
+            f"Expected a payload of length {expected_length},"
+            f"but read {bytes_read} bytes; trailing data."
+        )
+    next_pae_type: PAEType
+    # noinspection PyTypeChecker
+    next_pae_type = yield part_count
+    for ix in range(part_count):
+        const_len = next_pae_type.constant_length
+        if settings.prefix_if_constant or const_len is None:
+            pref_len = length_t.constant_length
+            try:
+                prefix = await _read_exactly(reader, pref_len)
+            except PAEDecodeError as e:
+                raise PAEDecodeError(
+                    f"Failed to read length prefix for value of type "
+                    f"{next_pae_type}"
+                ) from e
+            length = length_t.unpack(prefix)
+            bytes_read += pref_len + length
+        else:
+            length = const_len
+            bytes_read += length
+        if budget is not None:
+            budget.check_field_length(length)
+        if expected_length is not None:
+            if bytes_read > expected_length:
+                raise PAEDecodeError(
+                    f"Expected a payload of length {expected_length}; next "
+                    f"item too long: would need at least {bytes_read}"
+                )
+            elif ix == part_count - 1 and bytes_read != expected_length:
+                raise PAEDecodeError(
+                    f"Expected a payload of length {expected_length},"
+                    f"but read {bytes_read} bytes; trailing data."
+                )
+        next_pae_type = yield await _read_value(reader, next_pae_type, length)
+
+
+async def _read_list(reader: asyncio.StreamReader, pae_type: PAEListType,
+                     length: Optional[int]) -> list:
+    budget = _current_budget()
+    if budget is None:
+        return await _read_list_items(reader, pae_type, length)
+    budget.enter_list()
+    try:
+        return await _read_list_items(reader, pae_type, length)
+    finally:
+        budget.exit_list()
+
+
+async def _read_list_items(reader: asyncio.StreamReader,
+                           pae_type: PAEListType,
+                           length: Optional[int]) -> list:
+    coro = read_pae_async(reader, pae_type.settings, expected_length=length)
+    part_count = await coro.__anext__()
+    if isinstance(pae_type, PAEHeterogeneousList):
+        item_types = pae_type.component_types
+        if len(item_types) != part_count:
+            raise PAEDecodeError(
+                f"Wrong number of components, expected "
+                f"{len(item_types)} but got {part_count}."
+            )
+        result = [await coro.asend(item_type) for item_type in item_types]
+    else:
+        # Counted loop instead of repeat(), since the count comes from
+        # the input and may not fit in a C ssize_t.
+        child_type = pae_type.child_type
+        result = []
+        for _ in range(part_count):
+            result.append(await coro.asend(child_type))
+    await coro.aclose()
+    return result
+
+
+async def _read_value(reader: asyncio.StreamReader, pae_type: PAEType,
+                      length: int):
+    if type(pae_type) in _LIST_TYPES:
+        return await _read_list(reader, pae_type, length)
+    packed = await _read_exactly(reader, length)
+    return _read_with_errh(pae_type, BytesIO(packed), length)
+
+
+async def unmarshal_async(reader: asyncio.StreamReader, pae_type: PAEType[T],
+                          length: Optional[int] = None) -> T:
+    """
+    Read a value from an :class:`asyncio.StreamReader` and decode it.
+
+    :param reader:
+        The stream reader to read from.
+    :param pae_type:
+        The :class:`.PAEType` that provides the deserialisation logic.
+    :param length:
+        The length of the encoded value.
+        If ``None``, lists of the built-in list types are read until their
+        last element, and other values are read until the end of the stream.
+    :return:
+        A decoded value.
+    :raises python_pae.PAEDecodeError:
+        if an error occurs in the decoding process.
+    """
+    if type(pae_type) in _LIST_TYPES:
+        return await _read_list(reader, pae_type, length)
+    if length is None:
+        packed = await reader.read()
+        length = len(packed)
+    else:
+        packed = await _read_exactly(reader, length)
+    return _read_with_errh(pae_type, BytesIO(packed), length)
@@ -0,0 +1,314 @@
+"""
+This module provides functions to encode or decode many independent values
+at once, optionally spreading the work over a
+:class:`concurrent.futures.Executor`.
+
+Values are processed in chunks, and the results are returned in input order.
+Errors are reported per item, so that one malformed payload doesn't abort
+the rest of the batch.
+
+Large lists can also be decoded in parallel with :func:`unmarshal_parallel`.
+When using a process pool, the encoded list is copied into shared memory
+once, and workers decode ranges of elements from there.
+
+All PAE types in this library can be pickled, so both thread pools and
+process pools are supported. Keep in mind that context-dependent settings
+such as :func:`~python_pae.limits.decode_limits`,
+:func:`~python_pae.instrument.instrument` and
+:func:`~python_pae.cache.encoding_cache` don't carry over to worker threads
+or processes. Decoding limits can be passed to :func:`unmarshal_many`
+explicitly.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Generic, Iterable, List, Optional, TypeVar
+
+from .abstract import PAEType
+from .encode import marshal, unmarshal, _as_byte_view, _read_with_errh
+from .instrument import _current_tracer
+from .lazy import _scan_offsets
+from .limits import PAEDecodeLimits, _current_budget
+from .pae_types import PAEHomogeneousList
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: nocover
+    # Python 3.7
+    shared_memory = None
+
+__all__ = [
+    'PAEBatchResult', 'marshal_many', 'unmarshal_many', 'unmarshal_parallel',
+    'DEFAULT_CHUNK_SIZE',
+]
+
+T = TypeVar('T')
+
+DEFAULT_CHUNK_SIZE = 64
+"""
+Default number of items per unit of work.
+"""
+
+
+@dataclass(frozen=True)
+class PAEBatchResult(Generic[T]):
+    """
+    Outcome of processing a single item in a batch.
+    """
+
+    value: Optional[T] = None
+    """
+    The result, if the operation succeeded.
+    """
+
+    error: Optional[Exception] = None
+    """
+    The exception raised while processing the item, if any.
+    """
+
+    @property
+    def ok(self) -> bool:
+        """
+        ``True`` if the operation succeeded.
+        """
+        return self.error is None
+
+    def unwrap(self) -> T:
+        """
+        Return the result, or raise the error that occurred.
+
+        :return:
+            The result of the operation.
+        """
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def _marshal_chunk(values: list, pae_type: PAEType) -> List[PAEBatchResult]:
+    results = []
+    for value in values:
+        try:
+            results.append(PAEBatchResult(value=marshal(value, pae_type)))
+        except Exception as e:
+            results.append(PAEBatchResult(error=e))
+    return results
+
+
+def _unmarshal_chunk(blobs: list, pae_type: PAEType,
+                     limits: Optional[PAEDecodeLimits]) \
+        -> List[PAEBatchResult]:
+    results = []
+    for blob in blobs:
+        try:
+            value = unmarshal(blob, pae_type, limits=limits)
+            results.append(PAEBatchResult(value=value))
+        except Exception as e:
+            results.append(PAEBatchResult(error=e))
+    return results
+
+
+def _run_chunked(func, items: Iterable, args: tuple,
+                 executor: Optional[Executor],
+                 chunk_size: int) -> List[PAEBatchResult]:
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    items = list(items)
+    chunks = [
+        items[ix:ix + chunk_size] for ix in range(0, len(items), chunk_size)
+    ]
+    if executor is None:
+        chunk_results = [func(chunk, *args) for chunk in chunks]
+    else:
+        futures = [executor.submit(func, chunk, *args) for chunk in chunks]
+        chunk_results = [future.result() for future in futures]
+    return [result for chunk in chunk_results for result in chunk]
+
+
+def marshal_many(values: Iterable[T], pae_type: PAEType[T],
+                 executor: Optional[Executor] = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE) \
+        -> List[PAEBatchResult[bytes]]:
+    """
+    Encode many values of the same type.
+
+    :param values:
+        The values to be encoded.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param executor:
+        Executor to submit chunks of work to. If ``None``, all values are
+        encoded in the current thread.
+    :param chunk_size:
+        The number of values per chunk.
+    :return:
+        A list of :class:`PAEBatchResult` objects holding the encoded values,
+        in the same order as the input.
+    """
+    return _run_chunked(
+        _marshal_chunk, values, (pae_type,), executor, chunk_size
+    )
+
+
+def unmarshal_many(blobs: Iterable[bytes], pae_type: PAEType[T],
+                   executor: Optional[Executor] = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE,
+                   limits: Optional[PAEDecodeLimits] = None) \
+        -> List[PAEBatchResult[T]]:
+    """
+    Decode many values of the same type.
+
+    :param blobs:
+        The byte strings to be decoded. When using a process pool,
+        these must be picklable, so :class:`memoryview` objects
+        are not allowed.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param executor:
+        Executor to submit chunks of work to. If ``None``, all values are
+        decoded in the current thread.
+    :param chunk_size:
+        The number of values per chunk.
+    :param limits:
+        Resource limits applied to every value separately
+        (see :func:`~python_pae.limits.decode_limits`).
+    :return:
+        A list of :class:`PAEBatchResult` objects holding the decoded values,
+        in the same order as the input.
+    """
+    return _run_chunked(
+        _unmarshal_chunk, blobs, (pae_type, limits), executor, chunk_size
+    )
+
+
+def _attach_shared_memory(name: str):
+    try:
+        # Python 3.13+: the block is owned by the parent process, which
+        # takes care of unlinking it, so there's no need to track it here.
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Older versions always register the block with the resource
+        # tracker. Pool workers share their parent's tracker, so this
+        # merely duplicates the parent's registration, and we must not
+        # unregister it here.
+        return shared_memory.SharedMemory(name=name)
+
+
+def _decode_elements(view: memoryview, base: int, offsets: array,
+                     child_type: PAEType) -> list:
+    result = []
+    append = result.append
+    for ix in range(0, len(offsets), 2):
+        start = offsets[ix] - base
+        end = offsets[ix + 1] - base
+        # release the slice right away, so that shared memory blocks
+        # can be closed afterwards
+        with view[start:end] as chunk:
+            append(_read_with_errh(child_type, BytesIO(chunk), end - start))
+    return result
+
+
+def _decode_range(source, base: int, offsets: array,
+                  child_type: PAEType) -> list:
+    # source is either a buffer, or the name of a shared memory block
+    if not isinstance(source, str):
+        return _decode_elements(
+            _as_byte_view(source), base, offsets, child_type
+        )
+    shm = _attach_shared_memory(source)
+    try:
+        return _decode_elements(shm.buf, base, offsets, child_type)
+    finally:
+        shm.close()
+
+
+def unmarshal_parallel(packed, pae_type: PAEHomogeneousList,
+                       executor: Optional[Executor] = None,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> list:
+    """
+    Decode a homogeneous list, spreading the elements over an executor.
+
+    The list's length prefixes are scanned up front, after which ranges of
+    ``chunk_size`` elements are decoded in parallel. With a
+    :class:`~concurrent.futures.ProcessPoolExecutor`, the encoded list is
+    copied into a :mod:`multiprocessing.shared_memory` block once, so it
+    doesn't have to be pickled for every worker. Other executors are
+    assumed to run in the current process, and decode straight from
+    ``packed``.
+
+    .. note::
+        If decoding limits or instrumentation are active in the current
+        context, the list is decoded in the current thread instead, using
+        :func:`~python_pae.encode.unmarshal`.
+
+    :param packed:
+        The byte string to be processed. Any object that supports the buffer
+        protocol is accepted.
+    :param pae_type:
+        A :class:`.PAEHomogeneousList` type.
+    :param executor:
+        Executor to submit chunks of work to. If ``None``, all elements are
+        decoded in the current thread.
+    :param chunk_size:
+        The number of elements per chunk.
+    :return:
+        The decoded list.
+    :raises python_pae.PAEDecodeError:
+        if an error occurs in the decoding process. If several elements
+        are malformed, the error for the first one is raised.
+    """
+    if not isinstance(pae_type, PAEHomogeneousList):
+        raise TypeError(
+            f"Parallel decoding requires a homogeneous list type, "
+            f"not {pae_type}"
+        )
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be positive")
+    if _current_budget() is not None or _current_tracer() is not None:
+        return unmarshal(packed, pae_type)
+
+    view = _as_byte_view(packed)
+    offsets = _scan_offsets(view, 0, len(view), pae_type)
+    child_type = pae_type.child_type
+    step = 2 * chunk_size
+    ranges = [offsets[ix:ix + step] for ix in range(0, len(offsets), step)]
+    if executor is None:
+        return [
+            value for chunk in ranges
+            for value in _decode_elements(view, 0, chunk, child_type)
+        ]
+
+    shm = None
+    if isinstance(executor, ProcessPoolExecutor) and len(ranges) > 1:
+        if shared_memory is not None:
+            shm = shared_memory.SharedMemory(create=True, size=len(view))
+            shm.buf[:len(view)] = view
+    futures = []
+    try:
+        for chunk in ranges:
+            if shm is not None:
+                args = (shm.name, 0, chunk)
+            elif isinstance(executor, ProcessPoolExecutor):
+                # no shared memory available, so only send the relevant
+                # part of the buffer
+                base = chunk[0]
+                args = (bytes(view[base:chunk[-1]]), base, chunk)
+            else:
+                args = (view, 0, chunk)
+            futures.append(
+                executor.submit(_decode_range, *args, child_type)
+            )
+        return [value for future in futures for value in future.result()]
+    finally:
+        # If a chunk failed, the remaining workers may still need the
+        # shared buffer, so stop them (or let them finish) first.
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,220 @@
+"""
+This module implements an opt-in cache for the encodings of list elements,
+which speeds up encoding when the same values occur over and over again.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+from .abstract import PAEType
+from .encode import PAEPreEncoded, marshal
+
+__all__ = [
+    'PAEEncodingCache', 'PAECacheStats', 'encoding_cache', 'LRU', 'FIFO',
+]
+
+
+LRU = 'lru'
+"""
+Eviction policy that discards the least recently used entry first.
+"""
+
+FIFO = 'fifo'
+"""
+Eviction policy that discards the oldest entry first.
+"""
+
+# Only values of these (immutable) types are cached.
+_CACHEABLE_TYPES = (str, int, tuple)
+
+# Tuples are only cached if their elements are of these types, or tuples
+# themselves.
+_ELEMENT_TYPES = (str, int, bytes)
+
+
+def _cache_key(value):
+    # Tag a tuple's elements with their exact types, so that e.g. (1, 'a'),
+    # (True, 'a') and (1.0, 'a') are not conflated. Returns None if the
+    # tuple can't be cached.
+    keys = []
+    for item in value:
+        item_type = type(item)
+        if item_type is tuple:
+            item = _cache_key(item)
+            if item is None:
+                return None
+        elif item_type not in _ELEMENT_TYPES:
+            return None
+        keys.append((item_type, item))
+    return tuple(keys)
+
+
+@dataclass(frozen=True)
+class PAECacheStats:
+    """
+    Usage statistics for a :class:`PAEEncodingCache`.
+    """
+
+    hits: int
+    """
+    Number of lookups that were answered from the cache.
+    """
+
+    misses: int
+    """
+    Number of lookups that required the value to be encoded.
+    """
+
+    evictions: int
+    """
+    Number of entries that were discarded to make room for new ones.
+    """
+
+    entries: int
+    """
+    Number of entries currently in the cache.
+    """
+
+    size: int
+    """
+    Total size of the encoded values currently in the cache.
+    """
+
+
+class PAEEncodingCache:
+    """
+    Size-bounded cache mapping values to their encodings.
+    Instances of this class can safely be shared between threads.
+
+    Only strings, integers and tuples are cached, and only if their type
+    doesn't have a constant length, since fixed-width values are cheap to
+    encode anyway. The elements of cached tuples must themselves be
+    strings, integers, byte strings or tuples.
+
+    :param max_entries:
+        Maximal number of entries.
+    :param max_size:
+        Maximal total size of the cached encodings in bytes, or ``None``
+        if there's no such limit.
+    :param policy:
+        Eviction policy, either :const:`LRU` or :const:`FIFO`.
+    """
+
+    def __init__(self, max_entries: int = 1024,
+                 max_size: Optional[int] = None, policy: str = LRU):
+        if policy not in (LRU, FIFO):
+            raise ValueError(f"Unknown eviction policy {policy!r}")
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.policy = policy
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = self._evictions = self._size = 0
+
+    def lookup(self, value, pae_type: PAEType):
+        """
+        Look up the encoding of a value, encoding and caching it
+        if necessary.
+
+        :param value:
+            The value to be processed.
+        :param pae_type:
+            The :class:`.PAEType` that provides the serialisation logic.
+        :return:
+            A :class:`.PAEPreEncoded` object, or ``value`` itself if it can't
+            be cached.
+        """
+        value_type = type(value)
+        if value_type not in _CACHEABLE_TYPES \
+                or pae_type.constant_length is not None:
+            return value
+        value_key = value
+        if value_type is tuple:
+            value_key = _cache_key(value)
+            if value_key is None:
+                return value
+        key = (pae_type, value_type, value_key)
+        with self._lock:
+            try:
+                result = self._entries[key]
+            except KeyError:
+                self._misses += 1
+            else:
+                self._hits += 1
+                if self.policy == LRU:
+                    self._entries.move_to_end(key)
+                return result
+
+        # encode outside of the lock
+        result = PAEPreEncoded(marshal(value, pae_type), pae_type)
+        self._store(key, result)
+        return result
+
+    def _store(self, key, result: PAEPreEncoded):
+        size = len(result)
+        max_size = self.max_size
+        if max_size is not None and size > max_size:
+            return
+        with self._lock:
+            entries = self._entries
+            if key in entries:
+                # another thread got there first
+                return
+            entries[key] = result
+            self._size += size
+            while len(entries) > self.max_entries \
+                    or (max_size is not None and self._size > max_size):
+                _, evicted = entries.popitem(last=False)
+                self._size -= len(evicted)
+                self._evictions += 1
+
+    @property
+    def stats(self) -> PAECacheStats:
+        """
+        Current usage statistics.
+        """
+        with self._lock:
+            return PAECacheStats(
+                hits=self._hits, misses=self._misses,
+                evictions=self._evictions, entries=len(self._entries),
+                size=self._size
+            )
+
+    def clear(self):
+        """
+        Remove all entries and reset the statistics.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._hits = self._misses = self._evictions = self._size = 0
+
+
+_CACHE: ContextVar[Optional[PAEEncodingCache]] = ContextVar(
+    'python_pae_encoding_cache', default=None
+)
+
+_current_cache = _CACHE.get
+
+
+@contextmanager
+def encoding_cache(cache: PAEEncodingCache):
+    """
+    Context manager that makes the built-in list types use an encoding cache
+    for their elements in the current context (see :mod:`contextvars`).
+
+    The output is identical to that produced without a cache.
+
+    :param cache:
+        The cache to use.
+    """
+    token = _CACHE.set(cache)
+    try:
+        yield
+    finally:
+        _CACHE.reset(token)
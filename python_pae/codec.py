@@ -0,0 +1,544 @@
+"""
+This module implements a compiler that turns a tree of PAE types into
+a specialised codec.
+
+The codecs produced by :func:`compile` analyse the structure of a schema
+once, and then encode and decode values without going through the
+stream-based machinery in :mod:`python_pae.encode`.
+Their output is byte-for-byte identical to that of
+:func:`~python_pae.encode.marshal`.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import struct
+from typing import Generic, TypeVar, Callable, Any, List, Tuple, Optional
+
+from .abstract import PAEType, PAEDecodeError
+from .number import PAENumberType, _STRUCT_NUMS
+from .encode import (
+    marshal, unmarshal, PAEListSettings, PAEPreEncoded, _check_pre_encoded
+)
+from .limits import _current_budget
+from .instrument import _current_tracer
+from .pae_types import (
+    PAEBytes, PAEString, PAEHomogeneousList, PAEHeterogeneousList
+)
+
+__all__ = ['PAECodec', 'compile']
+
+
+T = TypeVar('T')
+
+# An encoder takes a value and returns its serialised form, without
+# length prefix.
+_Encoder = Callable[[Any], bytes]
+# A decoder takes a buffer and the bounds of the serialised value in that
+# buffer, and returns the decoded value.
+_Decoder = Callable[[memoryview, int, int], Any]
+
+
+class PAECodec(Generic[T]):
+    """
+    Specialised encoder/decoder for a particular :class:`.PAEType`.
+
+    Instances of this class should be created using :func:`compile`.
+    """
+
+    def __init__(self, pae_type: PAEType[T],
+                 encoder: _Encoder, decoder: _Decoder):
+        self.pae_type = pae_type
+        self._encoder = encoder
+        self._decoder = decoder
+
+    def encode(self, value: T) -> bytes:
+        """
+        Serialise a value into bytes.
+        Equivalent to :func:`~python_pae.encode.marshal`.
+
+        .. note::
+            If instrumentation is active (see
+            :func:`~python_pae.instrument.instrument`), the value is encoded
+            using :func:`~python_pae.encode.marshal` instead.
+
+        :param value:
+            The value to be processed.
+        :return:
+            A byte string representing the value passed in.
+        """
+        if _current_tracer() is not None or type(value) is PAEPreEncoded:
+            return marshal(value, self.pae_type)
+        result = self._encoder(value)
+        if type(result) is not bytes:
+            result = bytes(result)
+        return result
+
+    def decode(self, packed: bytes) -> T:
+        """
+        Decode a byte string back into a value.
+        Equivalent to :func:`~python_pae.encode.unmarshal`.
+
+        .. note::
+            If decoding limits are in effect (see
+            :func:`~python_pae.limits.decode_limits`) or instrumentation is
+            active (see :func:`~python_pae.instrument.instrument`), the value
+            is decoded using :func:`~python_pae.encode.unmarshal` instead.
+
+        :param packed:
+            The byte string to be processed. Any object that supports the
+            buffer protocol is accepted.
+        :return:
+            A decoded value.
+        :raises python_pae.PAEDecodeError:
+            if an error occurs in the decoding process.
+        """
+        if _current_budget() is not None or _current_tracer() is not None:
+            return unmarshal(packed, self.pae_type)
+        view = memoryview(packed)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        try:
+            return self._decoder(view, 0, len(view))
+        except PAEDecodeError:
+            raise
+        except (ValueError, struct.error) as e:
+            raise PAEDecodeError(
+                f"Failed to read value for PAE type {self.pae_type}"
+            ) from e
+
+    def __repr__(self):
+        return f'<PAECodec for {self.pae_type}>'
+
+
+def compile(pae_type: PAEType[T]) -> PAECodec[T]:
+    """
+    Analyse a PAE type tree and produce a codec for it.
+
+    The built-in types (:class:`.PAEBytes`, :class:`.PAEString`,
+    :class:`.PAENumberType`, :class:`.PAEHomogeneousList` and
+    :class:`.PAEHeterogeneousList`) are compiled into specialised
+    routines. Runs of fixed-width fields are packed and unpacked with
+    a single :class:`struct.Struct`.
+    Any other type (including subclasses of the built-in types) is
+    handled through its own :meth:`~.PAEType.write` and
+    :meth:`~.PAEType.read` methods.
+
+    .. note::
+        The type tree should not be modified after compilation.
+
+    :param pae_type:
+        The :class:`.PAEType` to compile.
+    :return:
+        A :class:`PAECodec` object.
+    """
+    encoder, decoder = _compile_node(pae_type)
+    return PAECodec(pae_type, encoder, decoder)
+
+
+def _number_code(pae_type: PAEType) -> Optional[str]:
+    if type(pae_type) is PAENumberType and \
+            0 <= pae_type.value < len(_STRUCT_NUMS):
+        return _STRUCT_NUMS[pae_type.value]
+    return None
+
+
+def _check_bounds(needed: int, available: int):
+    if needed > available:
+        raise PAEDecodeError(
+            f"Expected a payload of length {available}; next "
+            f"item too long: would need at least {needed}"
+        )
+
+
+def _check_trailing(consumed: int, available: int):
+    if consumed != available:
+        raise PAEDecodeError(
+            f"Expected a payload of length {available},"
+            f"but read {consumed} bytes; trailing data."
+        )
+
+
+def _compile_node(pae_type: PAEType) -> Tuple[_Encoder, _Decoder]:
+    node_type = type(pae_type)
+    if node_type is PAEBytes:
+        return _compile_bytes()
+    elif node_type is PAEString:
+        return _compile_string()
+    elif _number_code(pae_type) is not None:
+        return _compile_number(pae_type)
+    elif node_type is PAEHomogeneousList:
+        codes = _list_codes(pae_type.settings)
+        if codes is not None:
+            return _compile_homogeneous(pae_type, *codes)
+    elif node_type is PAEHeterogeneousList:
+        codes = _list_codes(pae_type.settings)
+        if codes is not None:
+            return _compile_heterogeneous(pae_type, *codes)
+    return _compile_generic(pae_type)
+
+
+def _compile_generic(pae_type: PAEType):
+
+    def encode(value):
+        return marshal(value, pae_type)
+
+    def decode(buf, start, end):
+        return unmarshal(buf[start:end], pae_type)
+
+    return encode, decode
+
+
+def _compile_bytes():
+
+    def encode(value):
+        if isinstance(value, memoryview) and value.format != 'B':
+            return value.cast('B')
+        return value
+
+    def decode(buf, start, end):
+        return bytes(buf[start:end])
+
+    return encode, decode
+
+
+def _compile_string():
+
+    def encode(value):
+        return value.encode('utf8')
+
+    def decode(buf, start, end):
+        return str(buf[start:end], 'utf8')
+
+    return encode, decode
+
+
+def _compile_number(pae_type: PAENumberType):
+    num_struct = struct.Struct('<' + _number_code(pae_type))
+    width = num_struct.size
+    unpack_from = num_struct.unpack_from
+
+    def decode(buf, start, end):
+        if end - start != width:
+            raise PAEDecodeError(
+                f"Expected {width} bytes for value of type {pae_type}, "
+                f"got {end - start}."
+            )
+        return unpack_from(buf, start)[0]
+
+    return num_struct.pack, decode
+
+
+def _list_codes(settings: PAEListSettings) -> Optional[Tuple[str, str]]:
+    size_t = settings.size_type
+    length_t = settings.length_type or size_t
+    size_code = _number_code(size_t)
+    length_code = _number_code(length_t)
+    if size_code is None or length_code is None:
+        return None
+    return size_code, length_code
+
+
+def _compile_homogeneous(pae_type: PAEHomogeneousList,
+                         size_code: str, length_code: str):
+    settings = pae_type.settings
+    size_struct = struct.Struct('<' + size_code)
+    length_struct = struct.Struct('<' + length_code)
+    size_len = size_struct.size
+    pref_len = length_struct.size
+    child_type = pae_type.child_type
+    child_code = _number_code(child_type)
+
+    if child_code is not None and not settings.prefix_if_constant:
+        return _compile_homogeneous_packed(pae_type, size_struct, child_code)
+    elif child_code is not None:
+        return _compile_homogeneous_fixed(
+            pae_type, size_struct, length_code, child_code
+        )
+
+    child_encode, child_decode = _compile_node(child_type)
+    const_len = child_type.constant_length
+    prefixed = const_len is None or settings.prefix_if_constant
+    # minimal number of bytes taken up by an item
+    min_item_len = pref_len if prefixed else const_len
+    size_pack = size_struct.pack
+    size_unpack_from = size_struct.unpack_from
+    length_pack = length_struct.pack
+    length_unpack_from = length_struct.unpack_from
+
+    def encode(value):
+        parts = [size_pack(len(value))]
+        append = parts.append
+        for item in value:
+            if type(item) is PAEPreEncoded:
+                _check_pre_encoded(item, child_type)
+                encoded = item.encoded
+            else:
+                encoded = child_encode(item)
+            if prefixed:
+                append(length_pack(len(encoded)))
+            elif len(encoded) != const_len:
+                raise IOError(
+                    f"Expected to write {const_len} bytes,"
+                    f"but wrote {len(encoded)}."
+                )
+            append(encoded)
+        return b''.join(parts)
+
+    def decode(buf, start, end):
+        _check_bounds(start + size_len, end)
+        count, = size_unpack_from(buf, start)
+        pos = start + size_len
+        _check_bounds(pos + count * min_item_len, end)
+        result = []
+        append = result.append
+        for _ in range(count):
+            if prefixed:
+                _check_bounds(pos + pref_len, end)
+                item_len, = length_unpack_from(buf, pos)
+                pos += pref_len
+            else:
+                item_len = const_len
+            item_end = pos + item_len
+            _check_bounds(item_end, end)
+            append(child_decode(buf, pos, item_end))
+            pos = item_end
+        _check_trailing(pos - start, end - start)
+        return result
+
+    return encode, decode
+
+
+def _has_pre_encoded(values) -> bool:
+    # only checked after a failure, to keep the fast path fast
+    return any(type(item) is PAEPreEncoded for item in values)
+
+
+def _compile_homogeneous_packed(pae_type: PAEHomogeneousList,
+                                size_struct: struct.Struct, child_code: str):
+    # fixed-width numbers without length prefixes: the whole list can be
+    # processed in one go
+    size_len = size_struct.size
+    width = struct.calcsize('<' + child_code)
+    size_pack = size_struct.pack
+    size_unpack_from = size_struct.unpack_from
+    pack = struct.pack
+    unpack_from = struct.unpack_from
+
+    def encode(value):
+        count = len(value)
+        try:
+            packed = pack(f'<{count}{child_code}', *value)
+        except struct.error:
+            if not _has_pre_encoded(value):
+                raise
+            # the generic path reports the error
+            return marshal(value, pae_type)
+        return size_pack(count) + packed
+
+    def decode(buf, start, end):
+        _check_bounds(start + size_len, end)
+        count, = size_unpack_from(buf, start)
+        pos = start + size_len
+        _check_bounds(pos + count * width, end)
+        _check_trailing(size_len + count * width, end - start)
+        return list(unpack_from(f'<{count}{child_code}', buf, pos))
+
+    return encode, decode
+
+
+def _compile_homogeneous_fixed(pae_type: PAEHomogeneousList,
+                               size_struct: struct.Struct,
+                               length_code: str, child_code: str):
+    # fixed-width numbers with length prefixes
+    size_len = size_struct.size
+    item_struct = struct.Struct('<' + length_code + child_code)
+    item_len = item_struct.size
+    width = struct.calcsize('<' + child_code)
+    size_pack = size_struct.pack
+    size_unpack_from = size_struct.unpack_from
+    item_pack = item_struct.pack
+    item_iter_unpack = item_struct.iter_unpack
+
+    def encode(value):
+        parts = [size_pack(len(value))]
+        try:
+            parts.extend([item_pack(width, item) for item in value])
+        except struct.error:
+            if not _has_pre_encoded(value):
+                raise
+            # pre-encoded numbers can't be packed with the struct, so fall
+            # back to the generic path
+            return marshal(value, pae_type)
+        return b''.join(parts)
+
+    def decode(buf, start, end):
+        _check_bounds(start + size_len, end)
+        count, = size_unpack_from(buf, start)
+        pos = start + size_len
+        _check_bounds(pos + count * item_len, end)
+        _check_trailing(size_len + count * item_len, end - start)
+        result = []
+        append = result.append
+        for item_pref, item in item_iter_unpack(buf[pos:end]):
+            if item_pref != width:
+                raise PAEDecodeError(
+                    f"Expected a length prefix of {width} for value of "
+                    f"type {pae_type.child_type}, got {item_pref}."
+                )
+            append(item)
+        return result
+
+    return encode, decode
+
+
+class _FixedSegment:
+    """
+    Run of fixed-width fields in a heterogeneous list, processed using
+    a single struct.
+    """
+
+    def __init__(self):
+        self.format = '<'
+        # template for the struct's arguments; None for slots that
+        # need to be filled in with values from the list
+        self.template: List[Optional[int]] = []
+        # (argument position, component index) pairs
+        self.slots: List[Tuple[int, int]] = []
+
+    def add_constant(self, code: str, value: int):
+        self.format += code
+        self.template.append(value)
+
+    def add_value(self, code: str, index: int):
+        self.format += code
+        self.slots.append((len(self.template), index))
+        self.template.append(None)
+
+
+def _compile_heterogeneous(pae_type: PAEHeterogeneousList,
+                           size_code: str, length_code: str):
+    settings = pae_type.settings
+    component_types = pae_type.component_types
+    component_count = len(component_types)
+    length_struct = struct.Struct('<' + length_code)
+    pref_len = length_struct.size
+    length_pack = length_struct.pack
+    length_unpack_from = length_struct.unpack_from
+
+    # the list's size is constant, so it always starts a fixed segment
+    first_segment = _FixedSegment()
+    first_segment.add_constant(size_code, component_count)
+    segments: list = [first_segment]
+    for ix, component_type in enumerate(component_types):
+        code = _number_code(component_type)
+        if code is not None:
+            segment = segments[-1]
+            if not isinstance(segment, _FixedSegment):
+                segment = _FixedSegment()
+                segments.append(segment)
+            if settings.prefix_if_constant:
+                segment.add_constant(
+                    length_code, component_type.constant_length
+                )
+            segment.add_value(code, ix)
+        else:
+            child_encode, child_decode = _compile_node(component_type)
+            const_len = component_type.constant_length
+            prefixed = const_len is None or settings.prefix_if_constant
+            segments.append(
+                (ix, prefixed, const_len, child_encode, child_decode)
+            )
+
+    # Segments are tagged with a boolean indicating whether they're fixed.
+    # Fixed segments are (True, struct, template, slots, constants),
+    # variable ones are (False, ix, prefixed, const_len, encode, decode).
+    compiled_segments = [
+        (True, struct.Struct(seg.format), seg.template, seg.slots,
+         [(ix, v) for ix, v in enumerate(seg.template) if v is not None])
+        if isinstance(seg, _FixedSegment) else (False,) + seg
+        for seg in segments
+    ]
+    size_struct = struct.Struct('<' + size_code)
+    size_len = size_struct.size
+    size_unpack_from = size_struct.unpack_from
+
+    def encode(value):
+        if len(value) != component_count:
+            raise ValueError(
+                f"Wrong number of components, expected "
+                f"{component_count} but got {len(value)}."
+            )
+        parts = []
+        append = parts.append
+        for seg in compiled_segments:
+            if seg[0]:
+                _, seg_struct, template, slots, _ = seg
+                args = template.copy()
+                for arg_ix, value_ix in slots:
+                    item = value[value_ix]
+                    if type(item) is PAEPreEncoded:
+                        # pre-encoded numbers can't be packed with the
+                        # struct, so fall back to the generic path
+                        return marshal(value, pae_type)
+                    args[arg_ix] = item
+                append(seg_struct.pack(*args))
+            else:
+                _, ix, prefixed, const_len, child_encode, _ = seg
+                item = value[ix]
+                if type(item) is PAEPreEncoded:
+                    _check_pre_encoded(item, component_types[ix])
+                    encoded = item.encoded
+                else:
+                    encoded = child_encode(item)
+                if prefixed:
+                    append(length_pack(len(encoded)))
+                elif len(encoded) != const_len:
+                    raise IOError(
+                        f"Expected to write {const_len} bytes,"
+                        f"but wrote {len(encoded)}."
+                    )
+                append(encoded)
+        return b''.join(parts)
+
+    def decode(buf, start, end):
+        _check_bounds(start + size_len, end)
+        count, = size_unpack_from(buf, start)
+        if count != component_count:
+            raise PAEDecodeError(
+                f"Wrong number of components, expected "
+                f"{component_count} but got {count}."
+            )
+        result = [None] * component_count
+        pos = start
+        for seg in compiled_segments:
+            if seg[0]:
+                _, seg_struct, _, slots, constants = seg
+                seg_end = pos + seg_struct.size
+                _check_bounds(seg_end, end)
+                unpacked = seg_struct.unpack_from(buf, pos)
+                for arg_ix, expected in constants:
+                    if unpacked[arg_ix] != expected:
+                        raise PAEDecodeError(
+                            f"Expected a length prefix of {expected} for "
+                            f"a fixed-width component of {pae_type}, "
+                            f"got {unpacked[arg_ix]}."
+                        )
+                for arg_ix, value_ix in slots:
+                    result[value_ix] = unpacked[arg_ix]
+                pos = seg_end
+            else:
+                _, ix, prefixed, const_len, _, child_decode = seg
+                if prefixed:
+                    _check_bounds(pos + pref_len, end)
+                    item_len, = length_unpack_from(buf, pos)
+                    pos += pref_len
+                else:
+                    item_len = const_len
+                item_end = pos + item_len
+                _check_bounds(item_end, end)
+                result[ix] = child_decode(buf, pos, item_end)
+                pos = item_end
+        _check_trailing(pos - start, end - start)
+        return result
+
+    return encode, decode
@@ -7,18 +7,22 @@ PAE values.
 
 import os
 import struct
-from dataclasses import dataclass
+from dataclasses import dataclass, is_dataclass
 from io import BytesIO
-from typing import IO, TypeVar, Optional
+from typing import IO, TypeVar, Optional, Union, Iterable, Any, Generic
 
 from .abstract import PAEType, PAEDecodeError
+from .limits import PAEDecodeLimits, decode_limits, _current_budget
+from .instrument import ENCODE, DECODE, _current_tracer
 
 from .number import PAENumberType, PAE_ULLONG
 
 __all__ = [
-    'marshal', 'unmarshal',
-    'write_prefixed', 'read_prefixed_coro', 'read_pae_coro',
-    'PAEListSettings'
+    'marshal', 'unmarshal', 'marshal_to_digest', 'marshal_into',
+    'encoded_size', 'BufferReader', 'BufferWriter',
+    'write_prefixed', 'prefixed_length', 'read_prefixed_coro',
+    'read_pae_coro', 'PAEListReader',
+    'PAEListSettings', 'PAEPreEncoded',
 ]
 
 
@@ -54,6 +58,150 @@ class PAEListSettings:
 T = TypeVar('T')
 
 
+def _is_seekable(stream: IO) -> bool:
+    seekable = getattr(stream, 'seekable', None)
+    return seekable is not None and seekable()
+
+
+class PAEPreEncoded(Generic[T]):
+    """
+    Wrapper for a value that has already been encoded, e.g. by another
+    party. Pre-encoded values can be passed to :func:`write_prefixed`,
+    :func:`marshal` and the other serialisation functions (and hence appear
+    as elements of lists) instead of the value they represent, in which case
+    their encoded form is written out verbatim.
+    The type they are written as must be structurally identical to
+    ``inner_type``, otherwise :class:`ValueError` is raised.
+
+    .. note::
+        Pre-encoded values can't be used as elements of lists of
+        numbers without length prefixes, since those are packed without
+        going through :func:`write_prefixed`.
+
+    :param encoded:
+        The encoded value, as an object supporting the buffer protocol.
+    :param inner_type:
+        The :class:`.PAEType` of the value that ``encoded`` represents.
+    :param validate:
+        If ``True``, check that ``encoded`` is a well-formed encoding of
+        a value of type ``inner_type``.
+        See :func:`~python_pae.validate.validate`.
+    :raises python_pae.PAEDecodeError:
+        if ``validate`` is ``True`` and the check fails.
+    """
+
+    def __init__(self, encoded, inner_type: PAEType[T],
+                 validate: bool = False):
+        if not isinstance(encoded, (bytes, bytearray)):
+            encoded = _as_byte_view(encoded)
+        self.encoded = encoded
+        self.inner_type = inner_type
+        if validate:
+            # imported here to avoid a circular import
+            from .validate import validate as _validate
+            _validate(encoded, inner_type)
+
+    def __len__(self):
+        return len(self.encoded)
+
+    def decode(self) -> T:
+        """
+        Decode the wrapped value.
+
+        :return:
+            The decoded value.
+        """
+        return unmarshal(self.encoded, self.inner_type)
+
+    def __repr__(self):
+        return (
+            f'<PAEPreEncoded {len(self.encoded)} bytes of {self.inner_type}>'
+        )
+
+
+def _same_pae_type(a, b) -> bool:
+    # PAE types don't implement __eq__, so compare them structurally,
+    # ignoring private attributes (e.g. precompiled structs)
+    if a is b:
+        return True
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        # e.g. component types passed as a list or as a tuple
+        return len(a) == len(b) and all(map(_same_pae_type, a, b))
+    if type(a) is not type(b):
+        return False
+    if (isinstance(a, PAEType) or is_dataclass(a)) and not _has_slots(a):
+        attrs_a, attrs_b = vars(a), vars(b)
+        return attrs_a.keys() == attrs_b.keys() and all(
+            key.startswith('_') or _same_pae_type(attr, attrs_b[key])
+            for key, attr in attrs_a.items()
+        )
+    # vars() doesn't cover attributes stored in slots
+    return a == b
+
+
+def _has_slots(obj) -> bool:
+    return any(cls.__dict__.get('__slots__') for cls in type(obj).__mro__)
+
+
+def _check_pre_encoded(value: PAEPreEncoded, pae_type: PAEType):
+    if not _same_pae_type(value.inner_type, pae_type):
+        raise ValueError(
+            f"Pre-encoded value of type {value.inner_type} cannot be used "
+            f"for type {pae_type}."
+        )
+
+
+def _write_unprefixed(value, pae_type: PAEType, stream: IO) -> int:
+    # entry point for top-level values, which may be pre-encoded
+    if type(value) is PAEPreEncoded:
+        _check_pre_encoded(value, pae_type)
+        stream.write(value.encoded)
+        return len(value)
+    return pae_type.write(value, stream)
+
+
+def _unprefixed_length(value, pae_type: PAEType) -> Optional[int]:
+    if type(value) is PAEPreEncoded:
+        _check_pre_encoded(value, pae_type)
+        return len(value)
+    return pae_type.encoded_length(value)
+
+
+def prefixed_length(value: T, pae_type: PAEType[T],
+                    length_type: PAENumberType,
+                    prefix_if_constant: bool = True) -> Optional[int]:
+    """
+    Compute the number of bytes that :func:`write_prefixed` would write
+    for a value, without serialising it.
+
+    :param value:
+        The value to measure.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param length_type:
+        Numeric type to use for the length prefix.
+    :param prefix_if_constant:
+        Flag toggling whether to apply the length prefix if the type
+        being written is a fixed-width type.
+        Defaults to ``True``.
+    :return:
+        The number of bytes (including the length prefix, if present),
+        or ``None`` if the type can't report its length in advance.
+    """
+    const_len = pae_type.constant_length
+    if const_len is not None:
+        if prefix_if_constant:
+            return const_len + length_type.constant_length
+        return const_len
+    if type(value) is PAEPreEncoded:
+        length = len(value)
+    else:
+        length = pae_type.encoded_length(value)
+        if length is None:
+            return None
+    return length + length_type.constant_length
+
+
 def write_prefixed(value: T, pae_type: PAEType[T],
                    stream: IO, length_type: PAENumberType,
                    prefix_if_constant: bool = True) -> int:
@@ -62,7 +210,10 @@ def write_prefixed(value: T, pae_type: PAEType[T],
     payload.
 
     .. note::
-        The output stream must be seekable for this to work.
+        If the type can report the length of its output through
+        :meth:`.PAEType.encoded_length`, the value is written strictly
+        sequentially. Otherwise, the output is either backpatched (if
+        the stream is seekable) or buffered in memory before being written.
 
     :param value:
         The value to write.
@@ -79,6 +230,25 @@ def write_prefixed(value: T, pae_type: PAEType[T],
     :return:
         The number of bytes written (including the length prefix, if present).
     """
+    tracer = _current_tracer()
+    if tracer is not None:
+        with tracer.span(ENCODE, pae_type) as span:
+            span.nbytes = _write_prefixed(
+                value, pae_type, stream, length_type, prefix_if_constant
+            )
+        return span.nbytes
+    return _write_prefixed(
+        value, pae_type, stream, length_type, prefix_if_constant
+    )
+
+
+def _write_prefixed(value: T, pae_type: PAEType[T],
+                    stream: IO, length_type: PAENumberType,
+                    prefix_if_constant: bool) -> int:
+    if type(value) is PAEPreEncoded:
+        return _write_pre_encoded(
+            value, pae_type, stream, length_type, prefix_if_constant
+        )
     if pae_type.constant_length is not None and not prefix_if_constant:
         # length is constant -> no prefix necessary
         total_written = pae_type.write(value, stream)
@@ -90,15 +260,48 @@ def write_prefixed(value: T, pae_type: PAEType[T],
         return total_written
 
     pref_len = length_type.constant_length
-    stream.write(bytes(pref_len))  # placeholder
-    total_written = pae_type.write(value, stream)
-    # backtrack to fill in length prefix
-    stream.seek(-total_written - pref_len, os.SEEK_CUR)
-    stream.write(length_type.pack(total_written))
-    stream.seek(total_written, os.SEEK_CUR)
+    length = pae_type.encoded_length(value)
+    if length is not None:
+        stream.write(length_type.pack(length))
+        total_written = pae_type.write(value, stream)
+        if total_written != length:
+            raise IOError(
+                f"Expected to write {length} bytes,"
+                f"but wrote {total_written}."
+            )
+    elif _is_seekable(stream):
+        stream.write(bytes(pref_len))  # placeholder
+        total_written = pae_type.write(value, stream)
+        # backtrack to fill in length prefix
+        stream.seek(-total_written - pref_len, os.SEEK_CUR)
+        stream.write(length_type.pack(total_written))
+        stream.seek(total_written, os.SEEK_CUR)
+    else:
+        buf = BytesIO()
+        total_written = pae_type.write(value, buf)
+        stream.write(length_type.pack(total_written))
+        stream.write(buf.getbuffer())
     return total_written + pref_len
 
 
+def _write_pre_encoded(value: PAEPreEncoded, pae_type: PAEType,
+                       stream: IO, length_type: PAENumberType,
+                       prefix_if_constant: bool) -> int:
+    _check_pre_encoded(value, pae_type)
+    length = len(value)
+    const_len = pae_type.constant_length
+    if const_len is not None and length != const_len:
+        raise ValueError(
+            f"Pre-encoded value of length {length} cannot be used for "
+            f"fixed-width type {pae_type}."
+        )
+    if const_len is None or prefix_if_constant:
+        stream.write(length_type.pack(length))
+        length += length_type.constant_length
+    stream.write(value.encoded)
+    return length
+
+
 def marshal(value: T, pae_type: PAEType[T]) -> bytes:
     """
     Serialise a value into bytes.
@@ -110,11 +313,203 @@ def marshal(value: T, pae_type: PAEType[T]) -> bytes:
     :return:
         A byte string representing the value passed in.
     """
+    if type(value) is PAEPreEncoded:
+        _check_pre_encoded(value, pae_type)
+        return bytes(value.encoded)
     out = BytesIO()
-    pae_type.write(value, out)
+    tracer = _current_tracer()
+    if tracer is not None:
+        with tracer.span(ENCODE, pae_type) as span:
+            span.nbytes = pae_type.write(value, out)
+    else:
+        pae_type.write(value, out)
     return out.getvalue()
 
 
+class _DigestSink:
+    """
+    Write-only stream that forwards everything written to it to the
+    ``update()`` method of one or more hash/MAC objects.
+    """
+
+    def __init__(self, hashers):
+        self._updates = [h.update for h in hashers]
+
+    def write(self, data) -> int:
+        for update in self._updates:
+            update(data)
+        if isinstance(data, memoryview):
+            return data.nbytes
+        return len(data)
+
+    def seekable(self) -> bool:
+        return False
+
+
+def marshal_to_digest(value: T, pae_type: PAEType[T],
+                      hasher: Union[Any, Iterable[Any]]) -> int:
+    """
+    Serialise a value and feed the result into one or more hash or MAC
+    objects, without building the full encoded byte string in memory.
+
+    :param value:
+        The value to be processed.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param hasher:
+        An object with an ``update()`` method, such as a
+        :mod:`hashlib` hash object or an :class:`hmac.HMAC` object.
+        An iterable of such objects is also accepted, in which case all
+        of them receive the same input.
+    :return:
+        The number of bytes fed into each hasher.
+    """
+    if hasattr(hasher, 'update'):
+        hasher = (hasher,)
+    return _write_unprefixed(value, pae_type, _DigestSink(hasher))
+
+
+class _CountingSink:
+    """
+    Write-only stream that discards its input, but keeps track of the
+    number of bytes written.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def write(self, data) -> int:
+        size = data.nbytes if isinstance(data, memoryview) else len(data)
+        self.count += size
+        return size
+
+    def seekable(self) -> bool:
+        return False
+
+
+def encoded_size(value: T, pae_type: PAEType[T]) -> int:
+    """
+    Compute the exact length of the output of :func:`marshal`.
+
+    If the type can't report the length of a value in advance
+    (see :meth:`.PAEType.encoded_length`), the value is serialised,
+    but the output is discarded.
+
+    :param value:
+        The value to be processed.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :return:
+        The length of the serialised value.
+    """
+    length = _unprefixed_length(value, pae_type)
+    if length is None:
+        sink = _CountingSink()
+        pae_type.write(value, sink)
+        length = sink.count
+    return length
+
+
+class BufferWriter:
+    """
+    Binary output stream that writes into a preallocated, fixed-size buffer,
+    such as a :class:`bytearray`, a writable :class:`memoryview` or
+    a :class:`mmap.mmap` object.
+
+    :param buffer:
+        A writable object supporting the buffer protocol.
+    :param offset:
+        The position at which to start writing.
+    """
+
+    def __init__(self, buffer, offset: int = 0):
+        view = _as_byte_view(buffer)
+        if view.readonly:
+            raise TypeError("Buffer is read-only")
+        self._view = view
+        self._pos = offset
+
+    def __len__(self):
+        return len(self._view)
+
+    def write(self, data) -> int:
+        if isinstance(data, memoryview):
+            data = _as_byte_view(data)
+            size = data.nbytes
+        else:
+            size = len(data)
+        start = self._pos
+        end = start + size
+        if end > len(self._view):
+            raise ValueError(
+                f"Buffer too small: need {end} bytes, "
+                f"but only {len(self._view)} are available."
+            )
+        self._view[start:end] = data
+        self._pos = end
+        return size
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence value {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readable(self) -> bool:
+        return False
+
+    def seekable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+
+def marshal_into(value: T, pae_type: PAEType[T], buffer,
+                 offset: int = 0) -> int:
+    """
+    Serialise a value into a preallocated buffer.
+
+    Use :func:`encoded_size` to find out how much space is required.
+
+    :param value:
+        The value to be processed.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param buffer:
+        A writable object supporting the buffer protocol, such as a
+        :class:`bytearray`, a writable :class:`memoryview` or
+        a :class:`mmap.mmap` object.
+    :param offset:
+        The position in the buffer at which to start writing.
+    :return:
+        The number of bytes written.
+    :raises ValueError:
+        if the buffer is too small. If the length of the value's encoding
+        can be determined in advance, this is checked before anything is
+        written.
+    """
+    writer = BufferWriter(buffer, offset)
+    length = _unprefixed_length(value, pae_type)
+    if length is not None and offset + length > len(writer):
+        raise ValueError(
+            f"Buffer too small: need {offset + length} bytes, "
+            f"but only {len(writer)} are available."
+        )
+    return _write_unprefixed(value, pae_type, writer)
+
+
 def _read_with_errh(pae_type, stream, length):
     try:
         value = pae_type.read(stream, length)
@@ -165,26 +560,392 @@ def read_prefixed_coro(pae_type: PAEType[T], stream: IO,
         total_length = pref_length + length
     else:
         length = total_length = pae_type.constant_length
+    budget = _current_budget()
+    if budget is not None:
+        budget.check_field_length(length)
     yield total_length
 
-    yield _read_with_errh(pae_type, stream, length)
+    tracer = _current_tracer()
+    if tracer is None:
+        yield _read_with_errh(pae_type, stream, length)
+        return
+    with tracer.span(DECODE, pae_type) as span:
+        value = _read_with_errh(pae_type, stream, length)
+        span.nbytes = total_length
+    yield value
 
 
-def unmarshal(packed: bytes, pae_type: PAEType[T]) -> T:
+def _as_byte_view(packed) -> memoryview:
+    view = memoryview(packed)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
+class BufferReader:
+    """
+    Read-only binary stream over a buffer, such as a :class:`bytes`,
+    :class:`bytearray`, :class:`mmap.mmap` or :class:`memoryview` object.
+
+    Unlike :class:`io.BytesIO`, this class does not copy the underlying
+    buffer, and its :meth:`read` method returns :class:`memoryview` slices
+    instead of fresh :class:`bytes` objects.
+
+    .. note::
+        As long as any of the slices returned by :meth:`read` are alive,
+        the underlying buffer cannot be resized or closed.
+
+    :param buffer:
+        An object supporting the buffer protocol.
+    """
+
+    def __init__(self, buffer):
+        self._view = _as_byte_view(buffer)
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def read(self, size: Optional[int] = -1) -> memoryview:
+        start = self._pos
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._pos = end
+        return self._view[start:end]
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence value {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+
+def unmarshal(packed: bytes, pae_type: PAEType[T],
+              zero_copy: bool = False,
+              limits: Optional[PAEDecodeLimits] = None) -> T:
     """
     Decode a byte string back into a value.
     Inverse operation of :func:`marshal`.
 
     :param packed:
-        The byte string to be processed.
+        The byte string to be processed. Any object that supports the buffer
+        protocol is accepted.
     :param pae_type:
         The :class:`.PAEType` that provides the deserialisation logic.
+    :param zero_copy:
+        If ``True``, the input is not copied, and raw byte string fields
+        (see :class:`~python_pae.pae_types.PAEBytes`) are returned as
+        :class:`memoryview` slices of ``packed``. See :class:`BufferReader`.
+    :param limits:
+        Resource limits to enforce while decoding the value.
+        See :func:`~python_pae.limits.decode_limits`.
     :return:
         A decoded value.
     :raises python_pae.PAEDecodeError:
         if an error occurs in the decoding process.
     """
-    return _read_with_errh(pae_type, BytesIO(packed), length=len(packed))
+    if limits is not None:
+        with decode_limits(limits):
+            return unmarshal(packed, pae_type, zero_copy=zero_copy)
+    if zero_copy:
+        stream = BufferReader(packed)
+        length = len(stream)
+    else:
+        stream = BytesIO(packed)
+        length = len(packed)
+    tracer = _current_tracer()
+    if tracer is None:
+        return _read_with_errh(pae_type, stream, length=length)
+    with tracer.span(DECODE, pae_type) as span:
+        value = _read_with_errh(pae_type, stream, length=length)
+        span.nbytes = length
+    return value
+
+
+_SKIP_CHUNK_SIZE = 64 * 1024
+
+
+class PAEListReader:
+    """
+    Cursor to read a (possibly heterogeneous) PAE-encoded list
+    element by element.
+
+    The list's size is read when the cursor is created, and made available
+    as :attr:`count`. The caller should then process the elements in order,
+    using :meth:`read_next` or :meth:`skip_next`, and call :meth:`finish`
+    at the end.
+
+    Like :func:`read_pae_coro`, this allows for a degree of freedom in the
+    schema (e.g. optional fields), since the type of each element only
+    needs to be known when it is read.
+
+    :param stream:
+        The stream to read from.
+    :param settings:
+        List encoding settings.
+    :param expected_length:
+        The expected byte length of the encoded list payload.
+        If ``None``, the length is not enforced.
+    :raises python_pae.PAEDecodeError:
+        if an error occurs in the decoding process.
+    """
+
+    def __init__(self, stream: IO, settings: PAEListSettings,
+                 expected_length: Optional[int] = None):
+        size_t = settings.size_type
+        self._stream = stream
+        self._length_t = settings.length_type or size_t
+        self._prefix_if_constant = settings.prefix_if_constant
+        self._expected_length = expected_length
+        self._budget = budget = _current_budget()
+        self._tracer = tracer = _current_tracer()
+        # length of the next element's payload and of the element
+        # as a whole, if its length prefix has already been read
+        self._next_length: Optional[int] = None
+        self._next_total_length = 0
+
+        try:
+            count = size_t.read(stream, size_t.constant_length)
+        except (IOError, ValueError, struct.error) as e:
+            raise PAEDecodeError(
+                f"Failed to read value for list size of PAE type {size_t}"
+            ) from e
+
+        self.count: int = count
+        """
+        The number of elements in the list.
+        """
+
+        self.index = 0
+        """
+        The index of the next element.
+        """
+
+        self.bytes_read = size_t.constant_length
+        """
+        The number of bytes of the list's payload consumed so far,
+        including the length prefix of the next element if it has already
+        been read.
+        """
+
+        if budget is not None:
+            budget.add_elements(self.count)
+        if tracer is not None:
+            tracer.record_elements(self.count)
+
+    def peek_length(self, pae_type: Optional[PAEType] = None) -> int:
+        """
+        Determine the length of the next element, reading its length prefix
+        if necessary. The element itself is not consumed.
+
+        .. note::
+            The idea is that the caller can abort the parse based on the
+            length value.
+
+        :param pae_type:
+            The type of the next element. This can only be omitted if
+            all elements of the list have a length prefix, i.e. if
+            :attr:`~.PAEListSettings.prefix_if_constant` is ``True``.
+        :return:
+            The length of the next element, length prefix not included.
+        :raises python_pae.PAEDecodeError:
+            if an error occurs in the decoding process.
+        """
+        length = self._next_length
+        if length is not None:
+            return length
+        index = self.index
+        if index >= self.count:
+            raise IndexError("No elements left to read")
+        if self._prefix_if_constant:
+            const_len = None
+        elif pae_type is None:
+            raise ValueError(
+                "The type of the next element is required to determine "
+                "its length"
+            )
+        else:
+            const_len = pae_type.constant_length
+        if const_len is None:
+            length = self._read_length_prefix(self._stream.read, pae_type)
+            total_length = self._length_t.constant_length + length
+        else:
+            length = total_length = const_len
+        bytes_read = self.bytes_read + total_length
+        self.bytes_read = bytes_read
+        self._check_next(index, length, bytes_read)
+        self._next_length = length
+        self._next_total_length = total_length
+        return length
+
+    def _read_length_prefix(self, read, pae_type: Optional[PAEType]) -> int:
+        length_t = self._length_t
+        try:
+            return length_t.unpack(read(length_t.constant_length))
+        except (IOError, ValueError, struct.error) as e:
+            raise PAEDecodeError(
+                f"Failed to read length prefix for value of type "
+                f"{pae_type}"
+            ) from e
+
+    def _check_next(self, index: int, length: int, bytes_read: int):
+        # Check the length of the element at the given index against the
+        # limits, and the list's payload length up to and including that
+        # element against the expected length.
+        budget = self._budget
+        if budget is not None:
+            budget.check_field_length(length)
+        expected_length = self._expected_length
+        if expected_length is not None:
+            if bytes_read > expected_length:
+                raise PAEDecodeError(
+                    f"Expected a payload of length {expected_length}; next "
+                    f"item too long: would need at least {bytes_read}"
+                )
+            elif index == self.count - 1:
+                # before reading the last item, check for trailing data
+                self._check_trailing_data(bytes_read)
+
+    def _check_trailing_data(self, bytes_read: int):
+        expected_length = self._expected_length
+        if expected_length is not None and bytes_read != expected_length:
+            raise PAEDecodeError(
+                f"Expected a payload of length {expected_length},"
+                f"but read {bytes_read} bytes; trailing data."
+            )
+
+    def _advance(self) -> int:
+        # Consume the next element (whose length must already be known),
+        # leaving its payload to be read by the caller.
+        length = self._next_length
+        self._next_length = None
+        self.index += 1
+        return length
+
+    def read_next(self, pae_type: PAEType[T]) -> T:
+        """
+        Read and decode the next element.
+
+        :param pae_type:
+            The :class:`.PAEType` that provides the deserialisation logic.
+        :return:
+            The decoded value.
+        :raises python_pae.PAEDecodeError:
+            if an error occurs in the decoding process.
+        """
+        if self._next_length is None:
+            self.peek_length(pae_type)
+        length = self._advance()
+        tracer = self._tracer
+        if tracer is None:
+            return _read_with_errh(pae_type, self._stream, length)
+        with tracer.span(DECODE, pae_type) as span:
+            value = _read_with_errh(pae_type, self._stream, length)
+            span.nbytes = self._next_total_length
+        return value
+
+    def _read_leaves(self, items: Iterable, append):
+        # Fast path for reading a run of elements, used by the built-in
+        # list types when instrumentation is inactive. The items are pairs
+        # of a type and a flag; elements are decoded and passed to append()
+        # until a flagged element is encountered, which is consumed without
+        # reading its payload. Returns the type and payload length of that
+        # element, or None once the items run out.
+        stream = self._stream
+        read = stream.read
+        read_length_prefix = self._read_length_prefix
+        pref_length = self._length_t.constant_length
+        prefix_if_constant = self._prefix_if_constant
+        check_next = self._check_next
+        index = self.index
+        bytes_read = self.bytes_read
+        for pae_type, leave_to_caller in items:
+            const_len = None if prefix_if_constant \
+                else pae_type.constant_length
+            if const_len is None:
+                length = read_length_prefix(read, pae_type)
+                bytes_read += pref_length + length
+            else:
+                length = const_len
+                bytes_read += length
+            check_next(index, length, bytes_read)
+            index += 1
+            if leave_to_caller:
+                self.index = index
+                self.bytes_read = bytes_read
+                return pae_type, length
+            append(_read_with_errh(pae_type, stream, length))
+        self.index = index
+        self.bytes_read = bytes_read
+        return None
+
+    def skip_next(self, pae_type: Optional[PAEType] = None) -> int:
+        """
+        Skip over the next element without decoding it.
+
+        :param pae_type:
+            The type of the next element.
+            See :meth:`peek_length` for when this is required.
+        :return:
+            The length of the element that was skipped, length prefix not
+            included.
+        :raises python_pae.PAEDecodeError:
+            if an error occurs in the decoding process.
+        """
+        if self._next_length is None:
+            self.peek_length(pae_type)
+        length = self._advance()
+        stream = self._stream
+        if _is_seekable(stream):
+            stream.seek(length, os.SEEK_CUR)
+            return length
+        remaining = length
+        while remaining:
+            chunk = stream.read(min(remaining, _SKIP_CHUNK_SIZE))
+            if not chunk:
+                raise PAEDecodeError(
+                    f"Expected {length} bytes, but only "
+                    f"{length - remaining} were available"
+                )
+            remaining -= len(chunk)
+        return length
+
+    def finish(self):
+        """
+        Check that the list's payload was consumed exactly.
+        All elements must have been read or skipped at this point.
+
+        :raises python_pae.PAEDecodeError:
+            if there is trailing data.
+        """
+        if self.index != self.count or self._next_length is not None:
+            raise ValueError(
+                f"Only {self.index} of {self.count} list elements "
+                f"were processed"
+            )
+        self._check_trailing_data(self.bytes_read)
 
 
 def read_pae_coro(stream: IO, settings: PAEListSettings, expected_length=None):
@@ -201,6 +962,10 @@ def read_pae_coro(stream: IO, settings: PAEListSettings, expected_length=None):
     The coroutine-based approach allows for a degree of freedom in the schema
     (e.g. optional fields), while still parsing on an on-demand basis.
 
+    .. note::
+        This coroutine is a thin wrapper around :class:`PAEListReader`,
+        which offers the same functionality with less overhead.
+
     :param stream:
         The stream to read from.
     :param settings:
@@ -213,36 +978,13 @@ def read_pae_coro(stream: IO, settings: PAEListSettings, expected_length=None):
     :return:
         A generator object.
     """
-    size_t = settings.size_type
-    length_t = settings.length_type or size_t
-    part_count = size_t.read(stream, size_t.constant_length)
-    bytes_read = size_t.constant_length
+    reader = PAEListReader(stream, settings, expected_length=expected_length)
+    part_count = reader.count
+    if not part_count:
+        reader.finish()
     next_pae_type: PAEType
     # noinspection PyTypeChecker
     next_pae_type = yield part_count
-    for ix in range(part_count):
-        part_coro = read_prefixed_coro(
-            next_pae_type, stream, length_t,
-            prefix_if_constant=settings.prefix_if_constant
-        )
-        try:
-            part_len: int = next(part_coro)
-        except StopIteration as e:  # pragma: nocover
-            raise RuntimeError("Coroutine protocol violation") from e
-        bytes_read += part_len
-        if expected_length is not None:
-            if bytes_read > expected_length:
-                raise PAEDecodeError(
-                    f"Expected a payload of length {expected_length}; next "
-                    f"item too long: would need at least {bytes_read}"
-                )
-            elif ix == part_count - 1 and bytes_read != expected_length:
-                # before yielding the last item, check for trailing data
-                raise PAEDecodeError(
-                    f"Expected a payload of length {expected_length},"
-                    f"but read {bytes_read} bytes; trailing data."
-                )
-        try:
-            next_pae_type = yield next(part_coro)
-        except StopIteration as e:  # pragma: nocover
-            raise RuntimeError("Coroutine protocol violation") from e
+    read_next = reader.read_next
+    for _ in range(part_count):
+        next_pae_type = yield read_next(next_pae_type)
@@ -0,0 +1,148 @@
+"""
+This module provides functions to encode PAE values to files and decode them
+from files, using memory mapping where possible.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import io
+import mmap
+import os
+from typing import TypeVar, Union, IO
+
+from .abstract import PAEType
+from .encode import (
+    unmarshal, _read_with_errh, _write_unprefixed, _unprefixed_length,
+    _is_seekable
+)
+from .lazy import unmarshal_lazy
+
+__all__ = ['marshal_file', 'unmarshal_file']
+
+
+T = TypeVar('T')
+
+PathOrFile = Union[str, os.PathLike, IO]
+
+
+def _fileno(fileobj) -> int:
+    try:
+        return fileobj.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return -1
+
+
+def _map_for_reading(fileobj):
+    # Returns the file's contents and the offset at which the data starts,
+    # which is the current position in the file (like marshal_file).
+    # The file position is moved to the end, as with fileobj.read().
+    fileno = _fileno(fileobj)
+    if fileno == -1 or not _is_seekable(fileobj):
+        # not backed by an OS-level file, or e.g. a pipe
+        return fileobj.read(), 0
+    offset = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END)
+    if size <= offset:
+        # nothing to map (and empty files can't be mapped at all)
+        return b'', 0
+    try:
+        # mmap offsets must be aligned, so map the whole file instead
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), offset
+    except (OSError, ValueError):
+        # not a mappable file
+        fileobj.seek(offset)
+        return fileobj.read(), 0
+
+
+def unmarshal_file(file: PathOrFile, pae_type: PAEType[T],
+                   lazy: bool = False, zero_copy: bool = False):
+    """
+    Decode the contents of a file.
+
+    The file is memory-mapped, so only the parts of the file that are
+    actually accessed are read from disk. This is especially effective in
+    combination with the ``lazy`` and ``zero_copy`` options.
+
+    .. note::
+        If ``lazy`` or ``zero_copy`` is set, the result refers to the
+        memory-mapped file, which stays mapped until the result is garbage
+        collected.
+
+    :param file:
+        A path to a file, or a binary file object opened for reading.
+        File objects are read from their current position until the end.
+        File objects that are not backed by an OS-level file descriptor,
+        or that can't be memory-mapped (e.g. pipes), are read into memory.
+    :param pae_type:
+        The :class:`.PAEType` that provides the deserialisation logic.
+    :param lazy:
+        Decode lists lazily. See :func:`~python_pae.lazy.unmarshal_lazy`.
+    :param zero_copy:
+        Return raw byte string fields as :class:`memoryview` slices of
+        the mapped file.
+    :return:
+        A decoded value.
+    :raises python_pae.PAEDecodeError:
+        if an error occurs in the decoding process.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as fileobj:
+            mapped, offset = _map_for_reading(fileobj)
+    else:
+        mapped, offset = _map_for_reading(file)
+
+    if isinstance(mapped, mmap.mmap) and not (lazy or zero_copy):
+        # The mmap object is file-like, so we can read from it directly
+        # without copying the entire file. Since none of the values refer to
+        # it after decoding, we can close it afterwards.
+        with mapped:
+            mapped.seek(offset)
+            return _read_with_errh(pae_type, mapped, len(mapped) - offset)
+    if offset:
+        mapped = memoryview(mapped)[offset:]
+    if lazy:
+        return unmarshal_lazy(mapped, pae_type, zero_copy=zero_copy)
+    elif zero_copy:
+        return unmarshal(mapped, pae_type, zero_copy=True)
+    return unmarshal(mapped, pae_type)
+
+
+def marshal_file(value: T, pae_type: PAEType[T], file: PathOrFile) -> int:
+    """
+    Serialise a value into a file.
+
+    If the output length can be determined in advance (see
+    :meth:`.PAEType.encoded_length`), and ``file`` is a path, the file
+    is sized up front and written through a memory map. Otherwise, the
+    output is written sequentially.
+
+    :param value:
+        The value to be processed.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param file:
+        A path to a file, which will be created or truncated,
+        or a binary file object opened for writing.
+        File objects are written to from their current position.
+    :return:
+        The number of bytes written.
+    """
+    if not isinstance(file, (str, os.PathLike)):
+        return _write_unprefixed(value, pae_type, file)
+
+    length = _unprefixed_length(value, pae_type)
+    if not length:
+        with open(file, 'wb') as fileobj:
+            return _write_unprefixed(value, pae_type, fileobj)
+
+    with open(file, 'w+b') as fileobj:
+        fileobj.truncate(length)
+        with mmap.mmap(fileobj.fileno(), length) as mapped:
+            written = _write_unprefixed(value, pae_type, mapped)
+            if written != length:
+                raise IOError(
+                    f"Expected to write {length} bytes,"
+                    f"but wrote {written}."
+                )
+            mapped.flush()
+    return written
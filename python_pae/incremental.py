@@ -0,0 +1,338 @@
+"""
+This module implements an incremental, push-based ("sans-I/O") decoder
+for PAE-encoded lists.
+
+Data can be fed into a :class:`PAEPushParser` in arbitrarily sized chunks,
+and the parser reports its progress through a series of events.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, List, Optional, Tuple, Union
+
+from .abstract import PAEType, PAEDecodeError
+from .encode import _read_with_errh
+from .pae_types import PAEHomogeneousList, PAEHeterogeneousList
+
+__all__ = [
+    'PAEPushParser', 'PAEParseEvent',
+    'ListStart', 'ElementLength', 'ElementValue', 'ListEnd',
+]
+
+
+Path = Tuple[int, ...]
+
+PAEListType = Union[PAEHomogeneousList, PAEHeterogeneousList]
+
+_LIST_TYPES = (PAEHomogeneousList, PAEHeterogeneousList)
+
+
+@dataclass(frozen=True)
+class PAEParseEvent:
+    """
+    Base class for events emitted by :class:`PAEPushParser`.
+    """
+
+    path: Path
+    """
+    Position of the list or element to which the event pertains,
+    as a tuple of indices starting from the outermost list.
+    The outermost list has path ``()``.
+    """
+
+
+@dataclass(frozen=True)
+class ListStart(PAEParseEvent):
+    """
+    Emitted when the header of a list has been parsed.
+    """
+
+    count: int
+    """
+    The number of elements in the list.
+    """
+
+
+@dataclass(frozen=True)
+class ElementLength(PAEParseEvent):
+    """
+    Emitted when the length of a list element is known, before its
+    payload is read.
+    """
+
+    length: int
+    """
+    The length of the element's payload, length prefix not included.
+    """
+
+
+@dataclass(frozen=True)
+class ElementValue(PAEParseEvent):
+    """
+    Emitted when a list element has been decoded.
+    """
+
+    value: Any
+    """
+    The decoded value.
+    """
+
+
+@dataclass(frozen=True)
+class ListEnd(PAEParseEvent):
+    """
+    Emitted when all elements of a list have been decoded.
+    """
+    pass
+
+
+class _ListFrame:
+
+    def __init__(self, pae_type: PAEListType, path: Path,
+                 length: Optional[int]):
+        self.pae_type = pae_type
+        self.path = path
+        # expected payload length of the list, if known
+        self.length = length
+        settings = pae_type.settings
+        self.size_t = settings.size_type
+        self.length_t = settings.length_type or self.size_t
+        self.prefix_if_constant = settings.prefix_if_constant
+        # bytes of the list payload consumed so far (including the
+        # prefixes and payloads of elements that are being read)
+        self.consumed = 0
+        self.count: Optional[int] = None
+        self.values: List[Any] = []
+        # length of the element currently being read, if known
+        self.pending_length: Optional[int] = None
+
+    def item_type(self) -> PAEType:
+        pae_type = self.pae_type
+        if isinstance(pae_type, PAEHeterogeneousList):
+            return pae_type.component_types[len(self.values)]
+        return pae_type.child_type
+
+
+class PAEPushParser:
+    """
+    Incremental decoder that accepts input in chunks of arbitrary size.
+
+    If ``pae_type`` is a :class:`.PAEHomogeneousList` or a
+    :class:`.PAEHeterogeneousList`, the parser emits events as soon as
+    the corresponding data is available:
+
+     * :class:`ListStart` when the size of a (possibly nested) list has been
+       read;
+     * :class:`ElementLength` when the length of a list element has been
+       read, before its payload arrives;
+     * :class:`ElementValue` when a list element has been decoded;
+     * :class:`ListEnd` after all elements of a list have been decoded.
+
+    The same length checks are applied as in
+    :func:`~python_pae.encode.read_pae_coro`, as soon as the relevant
+    lengths are known. Since the outermost list is not length-prefixed,
+    any data following it is treated as trailing data.
+
+    For other types, the input is buffered until :meth:`close` is called.
+
+    :param pae_type:
+        The :class:`.PAEType` that provides the deserialisation logic.
+    :param max_field_length:
+        If not ``None``, reject elements with a payload length exceeding
+        this value as soon as their length prefix is read.
+    """
+
+    def __init__(self, pae_type: PAEType,
+                 max_field_length: Optional[int] = None):
+        self.pae_type = pae_type
+        self.max_field_length = max_field_length
+        self._buf = bytearray()
+        self._pos = 0
+        self._stack: List[_ListFrame] = []
+        self._done = False
+        self._result = None
+        if type(pae_type) in _LIST_TYPES:
+            self._stack.append(_ListFrame(pae_type, (), None))
+
+    @property
+    def done(self) -> bool:
+        """
+        ``True`` if the outermost list has been completely decoded.
+        """
+        return self._done
+
+    def feed(self, chunk) -> List[PAEParseEvent]:
+        """
+        Feed data into the parser.
+
+        :param chunk:
+            A chunk of data, in the form of an object supporting the
+            buffer protocol.
+        :return:
+            A list of events triggered by the new data.
+        :raises python_pae.PAEDecodeError:
+            if an error occurs in the decoding process.
+        """
+        if not chunk:
+            return []
+        if self._done:
+            raise PAEDecodeError(
+                "Unexpected data after end of list; trailing data."
+            )
+        self._buf += chunk
+        if not self._stack:
+            # not a list, buffer until the end
+            return []
+        events: List[PAEParseEvent] = []
+        try:
+            self._process(events)
+        finally:
+            # discard consumed data
+            del self._buf[:self._pos]
+            self._pos = 0
+        if self._done and self._buf:
+            raise PAEDecodeError(
+                "Unexpected data after end of list; trailing data."
+            )
+        return events
+
+    def close(self):
+        """
+        Signal the end of the input.
+
+        :return:
+            The decoded value.
+        :raises python_pae.PAEDecodeError:
+            if the input is incomplete, or if an error occurs in the
+            decoding process.
+        """
+        if self._done:
+            return self._result
+        elif self._stack:
+            raise PAEDecodeError(
+                f"Unexpected end of input while decoding list at path "
+                f"{self._stack[-1].path}."
+            )
+        buf = bytes(self._buf)
+        self._result = _read_with_errh(self.pae_type, BytesIO(buf), len(buf))
+        self._done = True
+        return self._result
+
+    def _available(self) -> int:
+        return len(self._buf) - self._pos
+
+    def _take(self, size: int) -> bytearray:
+        start = self._pos
+        self._pos = start + size
+        return self._buf[start:start + size]
+
+    def _process(self, events: List[PAEParseEvent]):
+        stack = self._stack
+        while stack:
+            frame = stack[-1]
+            if frame.count is None:
+                if not self._read_header(frame, events):
+                    return
+                continue
+
+            item_type = frame.item_type()
+            if frame.pending_length is None:
+                item_length = self._read_item_length(frame, item_type)
+                if item_length is None:
+                    return
+                path = frame.path + (len(frame.values),)
+                events.append(ElementLength(path, item_length))
+                if type(item_type) in _LIST_TYPES:
+                    stack.append(_ListFrame(item_type, path, item_length))
+                    continue
+                frame.pending_length = item_length
+
+            item_length = frame.pending_length
+            if self._available() < item_length:
+                return
+            value = _read_with_errh(
+                item_type, BytesIO(self._take(item_length)), item_length
+            )
+            frame.pending_length = None
+            self._add_value(frame, value, events)
+
+    def _read_header(self, frame: _ListFrame, events) -> bool:
+        size_t = frame.size_t
+        size_len = size_t.constant_length
+        if self._available() < size_len:
+            return False
+        self._check_item_fits(frame, size_len)
+        count = size_t.unpack(self._take(size_len))
+        pae_type = frame.pae_type
+        if isinstance(pae_type, PAEHeterogeneousList) \
+                and len(pae_type.component_types) != count:
+            raise PAEDecodeError(
+                f"Wrong number of components, expected "
+                f"{len(pae_type.component_types)} but got {count}."
+            )
+        frame.consumed = size_len
+        frame.count = count
+        events.append(ListStart(frame.path, count))
+        if not count:
+            self._finish_list(frame, events)
+        return True
+
+    def _read_item_length(self, frame: _ListFrame,
+                          item_type: PAEType) -> Optional[int]:
+        const_len = item_type.constant_length
+        if frame.prefix_if_constant or const_len is None:
+            length_t = frame.length_t
+            pref_len = length_t.constant_length
+            if self._available() < pref_len:
+                return None
+            self._check_item_fits(frame, pref_len)
+            item_length = length_t.unpack(self._take(pref_len))
+            frame.consumed += pref_len
+        else:
+            item_length = const_len
+        max_length = self.max_field_length
+        if max_length is not None and item_length > max_length:
+            raise PAEDecodeError(
+                f"Element of length {item_length} exceeds maximum of "
+                f"{max_length}."
+            )
+        self._check_item_fits(frame, item_length)
+        frame.consumed += item_length
+        if frame.length is not None and len(frame.values) == frame.count - 1 \
+                and frame.consumed != frame.length:
+            # last item, check for trailing data
+            raise PAEDecodeError(
+                f"Expected a payload of length {frame.length},"
+                f"but read {frame.consumed} bytes; trailing data."
+            )
+        return item_length
+
+    @staticmethod
+    def _check_item_fits(frame: _ListFrame, size: int):
+        if frame.length is not None and frame.consumed + size > frame.length:
+            raise PAEDecodeError(
+                f"Expected a payload of length {frame.length}; next "
+                f"item too long: would need at least {frame.consumed + size}"
+            )
+
+    def _add_value(self, frame: _ListFrame, value, events):
+        events.append(ElementValue(frame.path + (len(frame.values),), value))
+        frame.values.append(value)
+        if len(frame.values) == frame.count:
+            self._finish_list(frame, events)
+
+    def _finish_list(self, frame: _ListFrame, events):
+        if frame.length is not None and frame.consumed != frame.length:
+            raise PAEDecodeError(
+                f"Expected a payload of length {frame.length},"
+                f"but read {frame.consumed} bytes; trailing data."
+            )
+        events.append(ListEnd(frame.path))
+        self._stack.pop()
+        if self._stack:
+            self._add_value(self._stack[-1], frame.values, events)
+        else:
+            self._done = True
+            self._result = frame.values
@@ -0,0 +1,275 @@
+"""
+This module provides opt-in instrumentation for the encoder and decoder.
+
+Within an :func:`instrument` block, an event is emitted for every value
+that is encoded or decoded through :func:`~python_pae.encode.marshal`,
+:func:`~python_pae.encode.unmarshal`,
+:func:`~python_pae.encode.write_prefixed` or
+:func:`~python_pae.encode.read_prefixed_coro` (i.e. also for all elements
+of the built-in list types). Events are passed to one or more sinks, which
+are simply callables that take a :class:`PAETraceEvent`.
+
+When no sinks are installed, the cost of the instrumentation hooks is
+limited to a context variable lookup per value.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .abstract import PAEType
+
+__all__ = [
+    'PAETraceEvent', 'PAETypeStats', 'PAECounters',
+    'instrument', 'collecting', 'ENCODE', 'DECODE',
+]
+
+
+ENCODE = 'encode'
+"""
+Value of :attr:`PAETraceEvent.operation` for encoding operations.
+"""
+
+DECODE = 'decode'
+"""
+Value of :attr:`PAETraceEvent.operation` for decoding operations.
+"""
+
+
+@dataclass(frozen=True)
+class PAETraceEvent:
+    """
+    Describes the encoding or decoding of a single value.
+    """
+
+    operation: str
+    """
+    Either :const:`ENCODE` or :const:`DECODE`.
+    """
+
+    pae_type: PAEType
+    """
+    The type of the value.
+    """
+
+    path: Tuple[int, ...]
+    """
+    Position of the value, as a tuple of indices starting from the outermost
+    value being encoded or decoded, which has path ``()``.
+    """
+
+    nbytes: int
+    """
+    The number of bytes written or read, including the length prefix
+    (if any).
+    """
+
+    elements: Optional[int]
+    """
+    The number of elements, if the value is a list of one of the built-in
+    list types, ``None`` otherwise.
+    """
+
+    elapsed_ns: int
+    """
+    Time spent on encoding or decoding the value in nanoseconds, including
+    the time spent on its elements.
+    """
+
+
+Sink = Callable[[PAETraceEvent], None]
+
+
+class _Span:
+
+    def __init__(self, tracer: '_Tracer', operation: str, pae_type: PAEType):
+        self.tracer = tracer
+        self.operation = operation
+        self.pae_type = pae_type
+        self.nbytes: Optional[int] = None
+        self.elements: Optional[int] = None
+        self.children = 0
+        self.path: Tuple[int, ...] = ()
+        self.start = 0
+        self.stack: Optional[List['_Span']] = None
+
+    def __enter__(self):
+        stack = self.stack = self.tracer.stack
+        if stack:
+            parent = stack[-1]
+            self.path = parent.path + (parent.children,)
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter_ns() - self.start
+        stack = self.stack
+        if stack[-1] is self:
+            stack.pop()
+        else:
+            # discard this span, along with any spans that weren't closed
+            del stack[stack.index(self):]
+        if stack:
+            stack[-1].children += 1
+        if exc_type is None and self.nbytes is not None:
+            event = PAETraceEvent(
+                operation=self.operation, pae_type=self.pae_type,
+                path=self.path, nbytes=self.nbytes, elements=self.elements,
+                elapsed_ns=elapsed
+            )
+            for sink in self.tracer.sinks:
+                sink(event)
+
+
+class _Tracer:
+
+    def __init__(self, sinks: Tuple[Sink, ...]):
+        self.sinks = sinks
+        # The tracer is shared by all threads that inherit the context it
+        # was installed in (e.g. through asyncio.to_thread()), so every
+        # thread keeps its own stack of open spans.
+        self._local = threading.local()
+
+    @property
+    def stack(self) -> List[_Span]:
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def span(self, operation: str, pae_type: PAEType) -> _Span:
+        return _Span(self, operation, pae_type)
+
+    def record_elements(self, count: int):
+        stack = self.stack
+        if stack:
+            stack[-1].elements = count
+
+
+_TRACER: ContextVar[Optional[_Tracer]] = ContextVar(
+    'python_pae_tracer', default=None
+)
+
+_current_tracer = _TRACER.get
+
+
+def _record_elements(count: int):
+    tracer = _TRACER.get()
+    if tracer is not None:
+        tracer.record_elements(count)
+
+
+@contextmanager
+def instrument(*sinks: Sink):
+    """
+    Context manager that passes trace events for all encoding and decoding
+    operations in the current context (see :mod:`contextvars`) to the
+    sinks provided. Sinks installed by enclosing :func:`instrument` blocks
+    remain active.
+
+    Sinks are called synchronously, so they should be fast.
+
+    :param sinks:
+        Callables that take a :class:`PAETraceEvent` as their only argument,
+        e.g. a :class:`PAECounters` object.
+    """
+    outer = _TRACER.get()
+    if outer is not None:
+        sinks = outer.sinks + sinks
+    token = _TRACER.set(_Tracer(sinks))
+    try:
+        yield
+    finally:
+        _TRACER.reset(token)
+
+
+@contextmanager
+def collecting():
+    """
+    Context manager that collects the trace events emitted in the current
+    context in a list.
+
+    :return:
+        A list, to which events are appended as they occur.
+    """
+    events: List[PAETraceEvent] = []
+    with instrument(events.append):
+        yield events
+
+
+@dataclass
+class PAETypeStats:
+    """
+    Aggregated statistics for a particular type and operation.
+    """
+
+    count: int = 0
+    """
+    The number of values processed.
+    """
+
+    nbytes: int = 0
+    """
+    The total number of bytes written or read.
+    """
+
+    elements: int = 0
+    """
+    The total number of list elements.
+    """
+
+    elapsed_ns: int = 0
+    """
+    The total time spent, in nanoseconds.
+    Time spent on elements of lists is also counted towards the lists
+    themselves.
+    """
+
+
+class PAECounters:
+    """
+    Sink that aggregates events by operation and type.
+    Instances of this class can safely be shared between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, PAEType], PAETypeStats] = {}
+
+    def __call__(self, event: PAETraceEvent):
+        key = (event.operation, event.pae_type)
+        with self._lock:
+            try:
+                stats = self._stats[key]
+            except KeyError:
+                stats = self._stats[key] = PAETypeStats()
+            stats.count += 1
+            stats.nbytes += event.nbytes
+            stats.elements += event.elements or 0
+            stats.elapsed_ns += event.elapsed_ns
+
+    def snapshot(self) -> Dict[Tuple[str, PAEType], PAETypeStats]:
+        """
+        Return a copy of the statistics gathered so far.
+
+        :return:
+            A dictionary mapping pairs of an operation
+            (:const:`ENCODE` or :const:`DECODE`) and a :class:`.PAEType`
+            to :class:`PAETypeStats` objects.
+        """
+        with self._lock:
+            return {k: replace(v) for k, v in self._stats.items()}
+
+    def reset(self):
+        """
+        Discard the statistics gathered so far.
+        """
+        with self._lock:
+            self._stats.clear()
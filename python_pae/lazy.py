@@ -0,0 +1,252 @@
+"""
+This module implements lazy decoding of PAE-encoded lists.
+
+A lazily decoded list only parses the length prefixes of its elements
+up front. The elements themselves are decoded when they are accessed.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+from array import array
+from io import BytesIO
+from itertools import repeat
+from typing import Sequence, TypeVar, Union, Optional
+
+from .abstract import PAEType, PAEDecodeError
+from .encode import BufferReader, _as_byte_view, _read_with_errh
+from .pae_types import PAEHomogeneousList, PAEHeterogeneousList
+
+__all__ = ['PAELazyList', 'unmarshal_lazy']
+
+
+T = TypeVar('T')
+
+PAEListType = Union[PAEHomogeneousList, PAEHeterogeneousList]
+
+_LIST_TYPES = (PAEHomogeneousList, PAEHeterogeneousList)
+
+
+def _scan_offsets(view: memoryview, start: int, end: int,
+                  pae_type: PAEListType) -> array:
+    # Parse the list header and all length prefixes, and return
+    # the start and end offsets of each element's payload, interleaved.
+    settings = pae_type.settings
+    size_t = settings.size_type
+    length_t = settings.length_type or size_t
+    size_len = size_t.constant_length
+    pref_len = length_t.constant_length
+
+    if start + size_len > end:
+        raise PAEDecodeError(
+            f"Expected a payload of length {end - start}; list size "
+            f"too long: would need at least {size_len}"
+        )
+    part_count = size_t.unpack_from(view, start)
+    pos = start + size_len
+
+    prefix_if_constant = settings.prefix_if_constant
+    if isinstance(pae_type, PAEHeterogeneousList):
+        item_types = pae_type.component_types
+        if len(item_types) != part_count:
+            raise PAEDecodeError(
+                f"Wrong number of components, expected "
+                f"{len(item_types)} but got {part_count}."
+            )
+    else:
+        child_type = pae_type.child_type
+        const_len = child_type.constant_length
+        if prefix_if_constant or const_len is None:
+            min_item_len = pref_len
+        else:
+            min_item_len = const_len
+        # fail early on absurd element counts
+        if pos + part_count * min_item_len > end:
+            raise PAEDecodeError(
+                f"Expected a payload of length {end - start}; "
+                f"{part_count} items would need at least "
+                f"{pos + part_count * min_item_len - start}"
+            )
+        item_types = repeat(child_type, part_count)
+
+    offsets = array('Q')
+    append = offsets.append
+    for item_type in item_types:
+        const_len = item_type.constant_length
+        if prefix_if_constant or const_len is None:
+            if pos + pref_len > end:
+                raise PAEDecodeError(
+                    f"Expected a payload of length {end - start}; next "
+                    f"item too long: would need at least "
+                    f"{pos + pref_len - start}"
+                )
+            item_len = length_t.unpack_from(view, pos)
+            pos += pref_len
+        else:
+            item_len = const_len
+        item_end = pos + item_len
+        if item_end > end:
+            raise PAEDecodeError(
+                f"Expected a payload of length {end - start}; next "
+                f"item too long: would need at least {item_end - start}"
+            )
+        append(pos)
+        append(item_end)
+        pos = item_end
+    if pos != end:
+        raise PAEDecodeError(
+            f"Expected a payload of length {end - start},"
+            f"but read {pos - start} bytes; trailing data."
+        )
+    return offsets
+
+
+class PAELazyList(Sequence):
+    """
+    Read-only view of a PAE-encoded list that decodes its elements
+    on demand.
+
+    The element offsets are computed (and the list's structure validated)
+    when the view is created. Errors in the elements themselves are only
+    raised when they are accessed.
+    Elements that are themselves lists of one of the built-in list types
+    are also decoded lazily.
+
+    Instances of this class should be created using :func:`unmarshal_lazy`.
+
+    .. note::
+        The view holds a reference to the buffer it was created from.
+
+    :param buffer:
+        A memoryview of the buffer containing the encoded data.
+    :param pae_type:
+        The type of the list.
+    :param start:
+        Start offset of the list's payload in the buffer.
+    :param end:
+        End offset of the list's payload in the buffer.
+    :param memoize:
+        Flag toggling whether to keep decoded elements around
+        for subsequent accesses.
+    :param zero_copy:
+        Flag toggling whether to return raw byte string fields as
+        :class:`memoryview` slices of the buffer.
+    """
+
+    def __init__(self, buffer: memoryview, pae_type: PAEListType,
+                 start: int, end: int, memoize: bool = True,
+                 zero_copy: bool = False):
+        self._buffer = buffer
+        self.pae_type = pae_type
+        self._offsets = _scan_offsets(buffer, start, end, pae_type)
+        self._cache: Optional[dict] = {} if memoize else None
+        self._memoize = memoize
+        self._zero_copy = zero_copy
+
+    def __len__(self):
+        return len(self._offsets) // 2
+
+    def _element_type(self, index: int) -> PAEType:
+        pae_type = self.pae_type
+        if isinstance(pae_type, PAEHeterogeneousList):
+            return pae_type.component_types[index]
+        return pae_type.child_type
+
+    def _normalise_index(self, index: int) -> int:
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("list index out of range")
+        return index
+
+    def raw(self, index: int) -> memoryview:
+        """
+        Return the encoded form of an element, without its length prefix.
+
+        :param index:
+            The index of the element.
+        :return:
+            A memoryview slice of the underlying buffer.
+        """
+        index = self._normalise_index(index)
+        offsets = self._offsets
+        return self._buffer[offsets[2 * index]:offsets[2 * index + 1]]
+
+    def _decode(self, index: int):
+        offsets = self._offsets
+        start = offsets[2 * index]
+        end = offsets[2 * index + 1]
+        element_type = self._element_type(index)
+        if type(element_type) in _LIST_TYPES:
+            return PAELazyList(
+                self._buffer, element_type, start, end,
+                memoize=self._memoize, zero_copy=self._zero_copy
+            )
+        chunk = self._buffer[start:end]
+        stream = BufferReader(chunk) if self._zero_copy else BytesIO(chunk)
+        return _read_with_errh(element_type, stream, end - start)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ix] for ix in range(*index.indices(len(self)))]
+        index = self._normalise_index(index)
+        cache = self._cache
+        if cache is None:
+            return self._decode(index)
+        try:
+            return cache[index]
+        except KeyError:
+            value = cache[index] = self._decode(index)
+            return value
+
+    def materialise(self) -> list:
+        """
+        Decode all elements, recursively replacing lazy views by lists.
+
+        :return:
+            A list of decoded values.
+        """
+        return [
+            item.materialise() if isinstance(item, PAELazyList) else item
+            for item in self
+        ]
+
+    def __repr__(self):
+        return f'<PAELazyList of {len(self)} items, type {self.pae_type}>'
+
+
+def unmarshal_lazy(packed, pae_type: PAEType[T], memoize: bool = True,
+                   zero_copy: bool = False) -> Union[T, PAELazyList]:
+    """
+    Decode a byte string lazily.
+
+    If ``pae_type`` is a :class:`.PAEHomogeneousList` or
+    :class:`.PAEHeterogeneousList`, the result is a :class:`PAELazyList`
+    view that decodes its elements on demand. Otherwise, the value is
+    decoded as usual.
+
+    :param packed:
+        The byte string to be processed. Any object that supports the buffer
+        protocol is accepted. It is not copied.
+    :param pae_type:
+        The :class:`.PAEType` that provides the deserialisation logic.
+    :param memoize:
+        Flag toggling whether lazy views should keep decoded elements
+        around for subsequent accesses.
+    :param zero_copy:
+        If ``True``, raw byte string fields are returned as
+        :class:`memoryview` slices of ``packed``.
+    :return:
+        A decoded value or a lazy view.
+    :raises python_pae.PAEDecodeError:
+        if an error occurs in the decoding process. Note that errors in the
+        elements of a list are only raised once those elements are accessed.
+    """
+    view = _as_byte_view(packed)
+    if type(pae_type) in _LIST_TYPES:
+        return PAELazyList(
+            view, pae_type, 0, len(view),
+            memoize=memoize, zero_copy=zero_copy
+        )
+    stream = BufferReader(view) if zero_copy else BytesIO(view)
+    return _read_with_errh(pae_type, stream, len(view))
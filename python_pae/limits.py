@@ -0,0 +1,136 @@
+"""
+This module defines resource limits that can be imposed on the decoder, to
+protect against maliciously crafted input.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+from .abstract import PAEDecodeError
+
+__all__ = ['PAEDecodeLimits', 'decode_limits']
+
+
+@dataclass(frozen=True)
+class PAEDecodeLimits:
+    """
+    Resource limits for the decoder. Limits that are set to ``None``
+    are not enforced.
+
+    The limits are checked as soon as the relevant sizes have been read
+    from the input, i.e. before any memory is allocated for the values
+    concerned.
+    """
+
+    max_elements: Optional[int] = None
+    """
+    Maximal number of list elements, counted across all (nested) lists.
+    """
+
+    max_depth: Optional[int] = None
+    """
+    Maximal nesting depth of lists. The outermost list is at depth 1.
+    """
+
+    max_field_length: Optional[int] = None
+    """
+    Maximal length of a single list element, length prefix not included.
+    """
+
+    max_total_bytes: Optional[int] = None
+    """
+    Maximal cumulative length of the byte strings, text strings and
+    packed arrays that are decoded.
+    """
+
+
+class _DecodeBudget:
+
+    def __init__(self, limits: PAEDecodeLimits):
+        self.limits = limits
+        self.elements = 0
+        self.depth = 0
+        self.total_bytes = 0
+
+    def add_elements(self, count: int):
+        self.elements += count
+        max_elements = self.limits.max_elements
+        if max_elements is not None and self.elements > max_elements:
+            raise PAEDecodeError(
+                f"List with {count} elements exceeds the element budget; "
+                f"at most {max_elements} elements are allowed."
+            )
+
+    def check_field_length(self, length: int):
+        max_length = self.limits.max_field_length
+        if max_length is not None and length > max_length:
+            raise PAEDecodeError(
+                f"Element of length {length} exceeds maximum of "
+                f"{max_length}."
+            )
+
+    def add_bytes(self, nbytes: int):
+        self.total_bytes += nbytes
+        max_total = self.limits.max_total_bytes
+        if max_total is not None and self.total_bytes > max_total:
+            raise PAEDecodeError(
+                f"Decoding {nbytes} more bytes would exceed the budget of "
+                f"{max_total} bytes."
+            )
+
+    def enter_list(self):
+        depth = self.depth + 1
+        max_depth = self.limits.max_depth
+        if max_depth is not None and depth > max_depth:
+            raise PAEDecodeError(
+                f"Lists nested more than {max_depth} levels deep are "
+                f"not allowed."
+            )
+        self.depth = depth
+
+    def exit_list(self):
+        self.depth -= 1
+
+    def read_nested(self, read, stream, length):
+        self.enter_list()
+        try:
+            return read(stream, length)
+        finally:
+            self.exit_list()
+
+
+_BUDGET: ContextVar[Optional[_DecodeBudget]] = ContextVar(
+    'python_pae_decode_budget', default=None
+)
+
+_current_budget = _BUDGET.get
+
+
+@contextmanager
+def decode_limits(limits: PAEDecodeLimits):
+    """
+    Context manager that enforces decoding limits on all decoding operations
+    in the current context (see :mod:`contextvars`).
+
+    The budget is shared by all values decoded within the ``with`` block,
+    so e.g. the total number of list elements is bounded across all calls
+    to :func:`~python_pae.encode.unmarshal` in the block.
+
+    Limits apply to :func:`~python_pae.encode.unmarshal`,
+    :func:`~python_pae.encode.read_pae_coro` and everything built on top of
+    it (e.g. the built-in list types and
+    :func:`~python_pae.streaming.iter_unmarshal`), to compiled codecs and to
+    :func:`~python_pae.aio.unmarshal_async`.
+
+    :param limits:
+        The limits to enforce.
+    """
+    token = _BUDGET.set(_DecodeBudget(limits))
+    try:
+        yield
+    finally:
+        _BUDGET.reset(token)
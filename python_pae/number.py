@@ -5,7 +5,7 @@ This module defines the unsigned number types for our PAE encoding scheme.
 """
 
 import struct
-from typing import IO
+from typing import IO, List, Iterator
 
 from .abstract import PAEType
 
@@ -16,6 +16,26 @@ __all__ = [
 _STRUCT_NUMS = 'BHIQ'
 
 
+class _UnsupportedStruct:
+    """
+    Stand-in for :class:`struct.Struct` for integer widths that the
+    :mod:`struct` module doesn't support. All encoding and decoding
+    operations raise :class:`ValueError`.
+    """
+
+    format = None
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def unsupported(self, *args):
+        raise ValueError(
+            f"Encoding {8 * self.size}-bit integers is not supported"
+        )
+
+    pack = unpack = pack_into = unpack_from = iter_unpack = unsupported
+
+
 class PAENumberType(PAEType[int]):
     """
     Encodes various unsigned integer types.
@@ -23,23 +43,116 @@ class PAENumberType(PAEType[int]):
     """
 
     def __init__(self, value):
+        if not isinstance(value, int) or value < 0:
+            raise ValueError(
+                f"Number type width must be a non-negative integer "
+                f"exponent, not {value!r}"
+            )
         self.value = value
+        if value < len(_STRUCT_NUMS):
+            self._struct = struct.Struct(f'<{_STRUCT_NUMS[value]}')
+        else:
+            self._struct = _UnsupportedStruct(2 ** value)
+
+    def __reduce__(self):
+        # struct.Struct objects can't be pickled, so we recreate the type
+        # from scratch, but keep any attributes set by subclasses.
+        state = {k: v for k, v in vars(self).items() if k != '_struct'}
+        return type(self), (self.value,), state
+
+    def _bulk_code(self) -> str:
+        num_struct = self._struct
+        if num_struct.format is None:
+            num_struct.unsupported()
+        return num_struct.format[1:]
 
     @property
     def constant_length(self):
         return 2 ** self.value
 
     def unpack(self, packed: bytes):
-        return struct.unpack(f'<{_STRUCT_NUMS[self.value]}', packed)[0]
+        return self._struct.unpack(packed)[0]
 
     def pack(self, value: int):
-        return struct.pack(f'<{_STRUCT_NUMS[self.value]}', value)
+        return self._struct.pack(value)
+
+    def unpack_from(self, buffer, offset: int = 0) -> int:
+        """
+        Decode a single number from a buffer at the given offset.
+
+        :param buffer:
+            An object supporting the buffer protocol.
+        :param offset:
+            The offset at which to start reading.
+        :return:
+            The decoded number.
+        """
+        return self._struct.unpack_from(buffer, offset)[0]
+
+    def pack_into(self, buffer, offset: int, value: int):
+        """
+        Encode a single number into a writable buffer at the given offset.
+
+        :param buffer:
+            A writable object supporting the buffer protocol.
+        :param offset:
+            The offset at which to start writing.
+        :param value:
+            The number to encode.
+        """
+        self._struct.pack_into(buffer, offset, value)
+
+    def pack_many(self, values) -> bytes:
+        """
+        Encode a sequence of numbers as a contiguous run of fixed-width
+        values, without length prefixes.
+
+        :param values:
+            A sequence of numbers.
+        :return:
+            The encoded numbers.
+        """
+        code = self._bulk_code()
+        return struct.pack(f'<{len(values)}{code}', *values)
+
+    def unpack_many(self, packed: bytes) -> List[int]:
+        """
+        Decode a contiguous run of fixed-width values.
+        Inverse operation of :meth:`pack_many`.
+
+        :param packed:
+            An object supporting the buffer protocol. Its length must be
+            a multiple of :attr:`constant_length`.
+        :return:
+            A list of numbers.
+        """
+        code = self._bulk_code()
+        count, remainder = divmod(len(packed), self._struct.size)
+        if remainder:
+            raise struct.error(
+                f"Buffer length {len(packed)} is not a multiple of "
+                f"{self._struct.size}"
+            )
+        return list(struct.unpack(f'<{count}{code}', packed))
+
+    def iter_unpack(self, packed: bytes) -> Iterator[int]:
+        """
+        Lazily decode a contiguous run of fixed-width values.
+
+        :param packed:
+            An object supporting the buffer protocol. Its length must be
+            a multiple of :attr:`constant_length`.
+        :return:
+            An iterator over the decoded numbers.
+        """
+        return (value for value, in self._struct.iter_unpack(packed))
 
     def write(self, value: int, stream: IO) -> int:
-        return stream.write(self.pack(value))
+        return stream.write(self._struct.pack(value))
 
     def read(self, stream: IO, length: int) -> int:
-        return self.unpack(stream.read(self.constant_length))
+        num_struct = self._struct
+        return num_struct.unpack(stream.read(num_struct.size))[0]
 
     def __repr__(self):
         nickname = ''
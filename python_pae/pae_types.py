@@ -4,17 +4,29 @@ This module defines the serialisation logic for a number of basic types.
 .. (c) 2021 Matthias Valvekens
 """
 
-from typing import List, TypeVar, IO
+import os
+import sys
+from array import array
+from io import BytesIO
+from itertools import repeat
+from typing import List, TypeVar, IO, Optional
 
 from .abstract import PAEType, PAEDecodeError
 from .number import (
     PAENumberType, PAE_UCHAR, PAE_USHORT, PAE_UINT, PAE_ULLONG
 )
-from .encode import write_prefixed, read_pae_coro, PAEListSettings
+from .encode import (
+    write_prefixed, prefixed_length, PAEListReader, PAEListSettings,
+    PAEPreEncoded, _write_prefixed, _is_seekable
+)
+from .limits import _current_budget
+from .instrument import _record_elements, _current_tracer
+from .cache import _current_cache
 
 __all__ = [
     'PAEBytes', 'PAEString',
     'PAENumberType', 'PAEHomogeneousList', 'PAEHeterogeneousList',
+    'PAEPackedArray',
     'DEFAULT_HMG_LIST_SETTINGS', 'DEFAULT_HTRG_LIST_SETTINGS',
     'PAE_UCHAR', 'PAE_USHORT', 'PAE_UINT', 'PAE_ULLONG'
 ]
@@ -23,12 +35,24 @@ __all__ = [
 class PAEBytes(PAEType[bytes]):
     """
     Represents a raw byte string, encoded as the identity.
+
+    When reading from a :class:`~python_pae.encode.BufferReader`
+    (e.g. in :func:`~python_pae.encode.unmarshal` with ``zero_copy=True``),
+    values are returned as :class:`memoryview` objects.
     """
 
     def write(self, value: bytes, stream: IO) -> int:
         return stream.write(value)
 
+    def encoded_length(self, value: bytes) -> int:
+        if isinstance(value, memoryview):
+            return value.nbytes
+        return len(value)
+
     def read(self, stream: IO, length: int) -> bytes:
+        budget = _current_budget()
+        if budget is not None:
+            budget.add_bytes(length)
         return stream.read(length)
 
 
@@ -40,8 +64,16 @@ class PAEString(PAEType[str]):
     def write(self, value: str, stream: IO) -> int:
         return stream.write(value.encode('utf8'))
 
+    def encoded_length(self, value: str) -> int:
+        if value.isascii():
+            return len(value)
+        return len(value.encode('utf8'))
+
     def read(self, stream: IO, length: int) -> str:
-        return stream.read(length).decode('utf8')
+        budget = _current_budget()
+        if budget is not None:
+            budget.add_bytes(length)
+        return str(stream.read(length), 'utf8')
 
 
 S = TypeVar('S')
@@ -52,6 +84,21 @@ Default list settings for homogeneous lists.
 """
 
 
+def _check_packed_length(bytes_read: int, length: Optional[int]):
+    if length is None:
+        return
+    if bytes_read > length:
+        raise PAEDecodeError(
+            f"Expected a payload of length {length}; next "
+            f"item too long: would need at least {bytes_read}"
+        )
+    elif bytes_read != length:
+        raise PAEDecodeError(
+            f"Expected a payload of length {length},"
+            f"but read {bytes_read} bytes; trailing data."
+        )
+
+
 class PAEHomogeneousList(PAEType[List[S]]):
     """
     Homogeneous list of length-prefixed items.
@@ -68,11 +115,25 @@ class PAEHomogeneousList(PAEType[List[S]]):
         self.child_type = child_type
         self.settings = settings
 
+    def _packed_numbers(self) -> bool:
+        # Lists of numbers without length prefixes are encoded as one
+        # contiguous run of fixed-width values.
+        return isinstance(self.child_type, PAENumberType) \
+            and not self.settings.prefix_if_constant
+
     def write(self, value: List[S], stream: IO) -> int:
+        if self._packed_numbers():
+            return self._write_packed_numbers(value, stream)
+        if _current_tracer() is None:
+            return _write_tree(value, self, stream)
         settings = self.settings
         size_t = settings.size_type
         count = size_t.write(len(value), stream)
+        _record_elements(len(value))
+        cache = _current_cache()
         for item in value:
+            if cache is not None:
+                item = cache.lookup(item, self.child_type)
             count += write_prefixed(
                 item, self.child_type, stream,
                 length_type=settings.length_type or size_t,
@@ -80,16 +141,67 @@ class PAEHomogeneousList(PAEType[List[S]]):
             )
         return count
 
+    def _write_packed_numbers(self, value: List[S], stream: IO) -> int:
+        count = self.settings.size_type.write(len(value), stream)
+        _record_elements(len(value))
+        return count + stream.write(self.child_type.pack_many(value))
+
+    def encoded_length(self, value: List[S]) -> Optional[int]:
+        settings = self.settings
+        size_t = settings.size_type
+        length_t = settings.length_type or size_t
+        child_type = self.child_type
+        if child_type.constant_length is not None:
+            # all items have the same length, no need to look at them
+            item_len = child_type.constant_length
+            if settings.prefix_if_constant:
+                item_len += length_t.constant_length
+            return size_t.constant_length + item_len * len(value)
+        return _measure_tree(value, self, {})
+
     def read(self, stream: IO, length: int) -> List[S]:
-        coro = read_pae_coro(stream, self.settings, expected_length=length)
-        part_count = next(coro)
-        result = [None] * part_count
-        # I suppose [coro.send(self.child_type) for _ in coro] would also work,
-        # but that just feels evil.
-        for ix in range(part_count):
-            result[ix] = coro.send(self.child_type)
+        if _current_tracer() is None and not self._packed_numbers():
+            return _read_tree(stream, self, length)
+        budget = _current_budget()
+        if budget is not None:
+            return budget.read_nested(self._read, stream, length)
+        return self._read(stream, length)
+
+    def _read(self, stream: IO, length: int) -> List[S]:
+        if self._packed_numbers():
+            return self._read_packed_numbers(stream, length)
+        reader = PAEListReader(stream, self.settings, expected_length=length)
+        # The count hasn't been validated at this point, so we don't
+        # preallocate the result list.
+        result = []
+        append = result.append
+        child_type = self.child_type
+        read_next = reader.read_next
+        for _ in range(reader.count):
+            append(read_next(child_type))
+        reader.finish()
         return result
 
+    def _read_packed_numbers(self, stream: IO, length: int) -> List[S]:
+        size_t = self.settings.size_type
+        child_type: PAENumberType = self.child_type
+        part_count = size_t.read(stream, size_t.constant_length)
+        payload_length = part_count * child_type.constant_length
+        _check_packed_length(
+            size_t.constant_length + payload_length, length
+        )
+        budget = _current_budget()
+        if budget is not None:
+            budget.add_elements(part_count)
+        _record_elements(part_count)
+        payload = stream.read(payload_length)
+        if len(payload) != payload_length:
+            raise PAEDecodeError(
+                f"Expected {payload_length} bytes of list data, "
+                f"got {len(payload)}."
+            )
+        return child_type.unpack_many(payload)
+
 
 DEFAULT_HTRG_LIST_SETTINGS = PAEListSettings(prefix_if_constant=True)
 """
@@ -114,15 +226,21 @@ class PAEHeterogeneousList(PAEType[list]):
         self.settings = settings
 
     def write(self, value: list, stream: IO) -> int:
+        if _current_tracer() is None:
+            return _write_tree(value, self, stream)
         settings = self.settings
         size_t = settings.size_type
-        count = size_t.write(len(value), stream)
         if len(value) != len(self.component_types):
             raise ValueError(
                 f"Wrong number of components, expected "
                 f"{len(self.component_types)} but got {len(value)}."
             )
+        count = size_t.write(len(value), stream)
+        _record_elements(len(value))
+        cache = _current_cache()
         for item, pae_type in zip(value, self.component_types):
+            if cache is not None:
+                item = cache.lookup(item, pae_type)
             count += write_prefixed(
                 item, pae_type, stream,
                 length_type=settings.length_type or size_t,
@@ -130,17 +248,380 @@ class PAEHeterogeneousList(PAEType[list]):
             )
         return count
 
+    def encoded_length(self, value: list) -> Optional[int]:
+        return _measure_tree(value, self, {})
+
     def read(self, stream: IO, length: int) -> list:
-        coro = read_pae_coro(
-            stream, settings=self.settings, expected_length=length
-        )
-        part_count = next(coro)
+        if _current_tracer() is None:
+            return _read_tree(stream, self, length)
+        budget = _current_budget()
+        if budget is not None:
+            return budget.read_nested(self._read, stream, length)
+        return self._read(stream, length)
+
+    def _read(self, stream: IO, length: int) -> list:
+        reader = PAEListReader(stream, self.settings, expected_length=length)
+        part_count = reader.count
         if len(self.component_types) != part_count:
             raise PAEDecodeError(
                 f"Wrong number of components, expected "
                 f"{len(self.component_types)} but got {part_count}."
             )
-        result = [None] * part_count
-        for ix, pae_type in enumerate(self.component_types):
-            result[ix] = coro.send(pae_type)
+        result = [reader.read_next(pae_type)
+                  for pae_type in self.component_types]
+        reader.finish()
+        return result
+
+
+# Iterative encoding and decoding engine for nested lists.
+#
+# Nested values of the built-in list types are processed using an explicit
+# stack instead of recursing through write_prefixed() / read_pae_coro(),
+# so arbitrarily deep trees don't hit the recursion limit, and the lengths
+# of nested lists are computed once instead of once for every enclosing
+# list. Other types (including lists of numbers without length prefixes)
+# are treated as leaves, and handled by their own write() / read() methods.
+#
+# The engine isn't used while instrumentation is active, since trace
+# events are tied to the recursive structure of the code.
+
+
+def _is_tree_node(pae_type: PAEType) -> bool:
+    node_type = type(pae_type)
+    if node_type is PAEHeterogeneousList:
+        return True
+    return node_type is PAEHomogeneousList and not pae_type._packed_numbers()
+
+
+def _tree_children(value: list, pae_type):
+    # iterate over (item, item type, is tree node) triples
+    if type(pae_type) is PAEHeterogeneousList:
+        component_types = pae_type.component_types
+        if len(value) != len(component_types):
+            raise ValueError(
+                f"Wrong number of components, expected "
+                f"{len(component_types)} but got {len(value)}."
+            )
+        return zip(
+            value, component_types, map(_is_tree_node, component_types)
+        )
+    child_type = pae_type.child_type
+    return zip(
+        value, repeat(child_type), repeat(_is_tree_node(child_type))
+    )
+
+
+class _WriteFrame:
+    __slots__ = (
+        'items', 'length_t', 'prefix_if_constant', 'stream', 'total',
+        'expected', 'placeholder', 'parent_stream',
+    )
+
+    def __init__(self, value: list, pae_type):
+        settings = pae_type.settings
+        self.items = _tree_children(value, pae_type)
+        self.length_t = settings.length_type or settings.size_type
+        self.prefix_if_constant = settings.prefix_if_constant
+        self.stream: Optional[IO] = None
+        # bytes written (or measured) so far
+        self.total: Optional[int] = settings.size_type.constant_length
+        self.expected: Optional[int] = None
+        self.placeholder = False
+        self.parent_stream: Optional[IO] = None
+
+
+class _ReadFrame:
+    __slots__ = ('reader', 'items', 'result')
+
+    def __init__(self, reader: PAEListReader, items):
+        self.reader = reader
+        self.items = items
+        self.result = []
+
+
+def _memoised_length(lengths: dict, value: list, pae_type) -> Optional[int]:
+    # Look up a length recorded by _measure_tree(), raising KeyError if
+    # there is none. The memo keeps the measured values alive, so their ids
+    # can't be reused by other objects, but we still check that the entry
+    # belongs to this particular value.
+    measured, length = lengths[id(value), id(pae_type)]
+    if measured is not value:
+        raise KeyError(id(value))
+    return length
+
+
+def _measure_tree(value: list, pae_type, lengths: dict) -> Optional[int]:
+    # Compute the encoded length of a tree of lists, and record the lengths
+    # of all nested lists in a dictionary keyed by (id(value), id(type)).
+    # The entries are (value, length) pairs, see _memoised_length().
+    stack = [_WriteFrame(value, pae_type)]
+    entries = [(value, pae_type)]
+    while stack:
+        frame = stack[-1]
+        length_t = frame.length_t
+        total = frame.total
+        for item, item_type, is_node in frame.items:
+            if is_node and type(item) is not PAEPreEncoded:
+                try:
+                    item_len = _memoised_length(lengths, item, item_type)
+                except KeyError:
+                    frame.total = total
+                    stack.append(_WriteFrame(item, item_type))
+                    entries.append((item, item_type))
+                    break
+                if item_len is not None:
+                    item_len += length_t.constant_length
+            else:
+                item_len = prefixed_length(
+                    item, item_type, length_t,
+                    prefix_if_constant=frame.prefix_if_constant
+                )
+            if total is not None:
+                total = None if item_len is None else total + item_len
+        else:
+            stack.pop()
+            item, item_type = entries.pop()
+            lengths[id(item), id(item_type)] = (item, total)
+            if stack:
+                parent = stack[-1]
+                if parent.total is not None:
+                    parent.total = None if total is None \
+                        else parent.total + parent.length_t.constant_length \
+                        + total
+    return total
+
+
+def _open_write_frame(value: list, pae_type, stream: IO,
+                      length_t: PAENumberType, lengths: dict) -> _WriteFrame:
+    frame = _WriteFrame(value, pae_type)
+    try:
+        length = _memoised_length(lengths, value, pae_type)
+    except KeyError:
+        length = _measure_tree(value, pae_type, lengths)
+    if length is not None:
+        stream.write(length_t.pack(length))
+        frame.expected = length
+    elif _is_seekable(stream):
+        stream.write(bytes(length_t.constant_length))  # placeholder
+        frame.placeholder = True
+    else:
+        frame.parent_stream = stream
+        stream = BytesIO()
+    frame.stream = stream
+    frame.total = pae_type.settings.size_type.write(len(value), stream)
+    return frame
+
+
+def _close_write_frame(frame: _WriteFrame, length_t: PAENumberType) -> int:
+    # finish writing a nested list, and return the number of bytes written
+    # to the enclosing list's stream, including the length prefix
+    total = frame.total
+    pref_len = length_t.constant_length
+    if frame.expected is not None:
+        if total != frame.expected:
+            raise IOError(
+                f"Expected to write {frame.expected} bytes,"
+                f"but wrote {total}."
+            )
+    elif frame.placeholder:
+        # backtrack to fill in length prefix
+        stream = frame.stream
+        stream.seek(-total - pref_len, os.SEEK_CUR)
+        stream.write(length_t.pack(total))
+        stream.seek(total, os.SEEK_CUR)
+    else:
+        frame.parent_stream.write(length_t.pack(total))
+        frame.parent_stream.write(frame.stream.getbuffer())
+    return total + pref_len
+
+
+def _write_tree(value: list, pae_type, stream: IO) -> int:
+    cache = _current_cache()
+    lengths: dict = {}
+    frame = _WriteFrame(value, pae_type)
+    frame.stream = stream
+    frame.total = pae_type.settings.size_type.write(len(value), stream)
+    stack = [frame]
+    while True:
+        frame = stack[-1]
+        stream = frame.stream
+        length_t = frame.length_t
+        prefix_if_constant = frame.prefix_if_constant
+        for item, item_type, is_node in frame.items:
+            if cache is not None:
+                item = cache.lookup(item, item_type)
+            if is_node and type(item) is not PAEPreEncoded:
+                stack.append(_open_write_frame(
+                    item, item_type, stream, length_t, lengths
+                ))
+                break
+            frame.total += _write_prefixed(
+                item, item_type, stream, length_t, prefix_if_constant
+            )
+        else:
+            stack.pop()
+            if not stack:
+                return frame.total
+            parent = stack[-1]
+            parent.total += _close_write_frame(frame, parent.length_t)
+
+
+def _open_read_frame(stream: IO, pae_type, length: int,
+                     budget) -> _ReadFrame:
+    if budget is not None:
+        budget.enter_list()
+    reader = PAEListReader(stream, pae_type.settings, expected_length=length)
+    part_count = reader.count
+    if type(pae_type) is PAEHeterogeneousList:
+        component_types = pae_type.component_types
+        if len(component_types) != part_count:
+            raise PAEDecodeError(
+                f"Wrong number of components, expected "
+                f"{len(component_types)} but got {part_count}."
+            )
+        items = zip(component_types, map(_is_tree_node, component_types))
+    else:
+        child_type = pae_type.child_type
+        item = (child_type, _is_tree_node(child_type))
+        if part_count <= sys.maxsize:
+            items = repeat(item, part_count)
+        else:
+            # Too large for repeat(); reading will fail long before the
+            # count is exhausted, but the error should be a PAEDecodeError.
+            items = (item for _ in range(part_count))
+    return _ReadFrame(reader, items)
+
+
+def _read_tree(stream: IO, pae_type, length: int) -> list:
+    budget = _current_budget()
+    start_depth = budget.depth if budget is not None else 0
+    try:
+        stack = [_open_read_frame(stream, pae_type, length, budget)]
+        while True:
+            frame = stack[-1]
+            reader = frame.reader
+            node = reader._read_leaves(frame.items, frame.result.append)
+            if node is not None:
+                item_type, item_len = node
+                stack.append(
+                    _open_read_frame(stream, item_type, item_len, budget)
+                )
+            else:
+                reader.finish()
+                stack.pop()
+                if budget is not None:
+                    budget.exit_list()
+                if not stack:
+                    return frame.result
+                stack[-1].result.append(frame.result)
+    finally:
+        if budget is not None:
+            budget.depth = start_depth
+
+
+_ARRAY_TYPECODES = {}
+for _typecode in 'BHILQ':
+    _ARRAY_TYPECODES.setdefault(array(_typecode).itemsize, _typecode)
+del _typecode
+
+
+class PAEPackedArray(PAEType[array]):
+    """
+    Homogeneous list of fixed-width unsigned integers, backed by
+    an :class:`array.array`.
+
+    The encoding is the same as that of a :class:`PAEHomogeneousList`
+    of the same number type without length prefixes, but values are
+    serialised and deserialised in bulk, without creating a Python object
+    for every list element.
+
+    Values can be any object supporting the buffer protocol with an item
+    size that matches the number type, such as an :class:`array.array`
+    object with the appropriate type code. Other iterables of integers
+    are also accepted, but they are converted to an array first.
+    The encoded length of iterables without a length (e.g. generators)
+    can't be determined in advance.
+    Decoded values are always returned as :class:`array.array` objects.
+
+    :param number_type:
+        The type of the list's elements.
+    :param settings:
+        Encoding settings for the list.
+        :attr:`~.PAEListSettings.prefix_if_constant` must be ``False``.
+    """
+
+    def __init__(self, number_type: PAENumberType,
+                 settings: PAEListSettings = DEFAULT_HMG_LIST_SETTINGS):
+        if settings.prefix_if_constant:
+            raise ValueError(
+                "Packed arrays cannot have length prefixes on their items"
+            )
+        try:
+            self.typecode = _ARRAY_TYPECODES[number_type.constant_length]
+        except KeyError:
+            raise ValueError(f"No array type available for {number_type}")
+        self.number_type = number_type
+        self.settings = settings
+
+    def _as_byte_view(self, value) -> memoryview:
+        try:
+            view = memoryview(value)
+        except TypeError:
+            view = memoryview(array(self.typecode, value))
+        return self._check_view(view)
+
+    def _check_view(self, view: memoryview) -> memoryview:
+        if view.ndim != 1 or view.itemsize != \
+                self.number_type.constant_length:
+            raise ValueError(
+                f"Expected a one-dimensional buffer with item size "
+                f"{self.number_type.constant_length}."
+            )
+        return view
+
+    def write(self, value, stream: IO) -> int:
+        view = self._as_byte_view(value)
+        count = self.settings.size_type.write(len(view), stream)
+        _record_elements(len(view))
+        if sys.byteorder == 'big':
+            swapped = array(self.typecode, view.tobytes())
+            swapped.byteswap()
+            return count + stream.write(memoryview(swapped).cast('B'))
+        return count + stream.write(view.cast('B'))
+
+    def encoded_length(self, value) -> Optional[int]:
+        try:
+            nbytes = self._check_view(memoryview(value)).nbytes
+        except TypeError:
+            # Don't convert the value here, since it may be an iterator,
+            # which can only be consumed once.
+            try:
+                count = len(value)
+            except TypeError:
+                return None
+            nbytes = count * self.number_type.constant_length
+        return self.settings.size_type.constant_length + nbytes
+
+    def read(self, stream: IO, length: int) -> array:
+        size_t = self.settings.size_type
+        part_count = size_t.read(stream, size_t.constant_length)
+        payload_length = part_count * self.number_type.constant_length
+        _check_packed_length(
+            size_t.constant_length + payload_length, length
+        )
+        budget = _current_budget()
+        if budget is not None:
+            budget.add_elements(part_count)
+            budget.add_bytes(payload_length)
+        _record_elements(part_count)
+        payload = stream.read(payload_length)
+        if len(payload) != payload_length:
+            raise PAEDecodeError(
+                f"Expected {payload_length} bytes of array data, "
+                f"got {len(payload)}."
+            )
+        result = array(self.typecode)
+        result.frombytes(payload)
+        if sys.byteorder == 'big':
+            result.byteswap()
         return result
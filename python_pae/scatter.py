@@ -0,0 +1,167 @@
+"""
+This module implements scatter-gather encoding: instead of a single byte
+string, the encoder produces a list of buffers that can be handed to
+vectored I/O primitives such as :func:`os.writev` and
+:meth:`socket.socket.sendmsg`.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import os
+import socket
+from typing import TypeVar, List, Callable, Sequence
+
+from .abstract import PAEType
+from .encode import _write_unprefixed
+
+__all__ = ['marshal_buffers', 'writev_all', 'sendmsg_all']
+
+
+T = TypeVar('T')
+
+DEFAULT_COPY_THRESHOLD = 512
+"""
+Default size (in bytes) below which chunks of output are coalesced into
+a single buffer instead of being passed through by reference.
+"""
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):  # pragma: nocover
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:  # pragma: nocover
+    _IOV_MAX = 1024
+
+
+class _BufferListSink:
+    """
+    Write-only stream that collects the chunks written to it in a list.
+    Small chunks are copied and coalesced, large ones are kept by reference.
+    """
+
+    def __init__(self, copy_threshold: int):
+        self.buffers: list = []
+        self._pending = bytearray()
+        self._copy_threshold = copy_threshold
+
+    def write(self, data) -> int:
+        if isinstance(data, memoryview):
+            if data.format != 'B' or data.ndim != 1:
+                data = data.cast('B')
+            size = data.nbytes
+        else:
+            size = len(data)
+        if size < self._copy_threshold:
+            self._pending += data
+        else:
+            self._flush_pending()
+            self.buffers.append(data)
+        return size
+
+    def _flush_pending(self):
+        if self._pending:
+            self.buffers.append(bytes(self._pending))
+            self._pending.clear()
+
+    def seekable(self) -> bool:
+        return False
+
+    def getbuffers(self) -> list:
+        self._flush_pending()
+        return self.buffers
+
+
+def marshal_buffers(value: T, pae_type: PAEType[T],
+                    copy_threshold: int = DEFAULT_COPY_THRESHOLD) -> list:
+    """
+    Serialise a value into a list of buffers, whose concatenation is
+    the output of :func:`~python_pae.encode.marshal`.
+
+    Length prefixes and other small pieces of output are gathered in freshly
+    allocated byte strings, but large chunks of data passed to the output
+    stream by the types being serialised (e.g. the values of
+    :class:`~python_pae.pae_types.PAEBytes` fields) are included by
+    reference, without being copied.
+
+    .. warning::
+        Since the caller's own objects may be part of the output, they should
+        not be modified until the buffers have been consumed.
+
+    :param value:
+        The value to be processed.
+    :param pae_type:
+        The :class:`.PAEType` that provides the serialisation logic.
+    :param copy_threshold:
+        Chunks smaller than this number of bytes are copied and coalesced
+        with adjacent small chunks.
+    :return:
+        A list of objects supporting the buffer protocol.
+    """
+    sink = _BufferListSink(copy_threshold)
+    _write_unprefixed(value, pae_type, sink)
+    return sink.getbuffers()
+
+
+def _send_all(send: Callable[[Sequence], int], buffers) -> int:
+    views: List[memoryview] = []
+    for buf in buffers:
+        view = memoryview(buf)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        if view.nbytes:
+            views.append(view)
+    total = 0
+    ix = 0
+    while ix < len(views):
+        sent = send(views[ix:ix + _IOV_MAX])
+        total += sent
+        # skip over the buffers that were sent in their entirety
+        while ix < len(views) and sent >= views[ix].nbytes:
+            sent -= views[ix].nbytes
+            ix += 1
+        if sent:
+            # partial write
+            views[ix] = views[ix][sent:]
+    return total
+
+
+def writev_all(fd: int, buffers) -> int:
+    """
+    Write a list of buffers to a file descriptor using :func:`os.writev`,
+    retrying until all data has been written.
+
+    .. note::
+        This function is only available on platforms that support
+        :func:`os.writev`. If ``fd`` is non-blocking, :class:`BlockingIOError`
+        may be raised, in which case it is not known how much data was
+        written.
+
+    :param fd:
+        A file descriptor.
+    :param buffers:
+        A list of objects supporting the buffer protocol, such as the
+        output of :func:`marshal_buffers`.
+    :return:
+        The number of bytes written.
+    """
+    return _send_all(lambda bufs: os.writev(fd, bufs), buffers)
+
+
+def sendmsg_all(sock: socket.socket, buffers) -> int:
+    """
+    Send a list of buffers over a socket using
+    :meth:`socket.socket.sendmsg`, retrying until all data has been sent.
+
+    .. note::
+        This function is only available on platforms that support
+        :meth:`socket.socket.sendmsg`. The socket should be in blocking mode.
+
+    :param sock:
+        A connected socket.
+    :param buffers:
+        A list of objects supporting the buffer protocol, such as the
+        output of :func:`marshal_buffers`.
+    :return:
+        The number of bytes sent.
+    """
+    return _send_all(sock.sendmsg, buffers)
@@ -0,0 +1,165 @@
+"""
+This module provides tools to process homogeneous lists one element
+at a time, without holding the entire list in memory.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import os
+import shutil
+from tempfile import SpooledTemporaryFile
+from typing import IO, Iterable, Iterator, Optional, TypeVar
+
+from .abstract import PAEDecodeError
+from .encode import PAEListReader, write_prefixed, _is_seekable
+from .limits import _current_budget
+from .pae_types import PAEHomogeneousList
+from .validate import _CountingReader
+
+__all__ = ['iter_unmarshal', 'marshal_iter']
+
+
+S = TypeVar('S')
+
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+"""
+Default amount of output (in bytes) that :func:`marshal_iter` buffers in
+memory before spilling over to a temporary file.
+"""
+
+
+def _write_items(items: Iterable[S], pae_type: PAEHomogeneousList[S],
+                 stream: IO, count: Optional[int] = None):
+    settings = pae_type.settings
+    length_t = settings.length_type or settings.size_type
+    child_type = pae_type.child_type
+    written = item_count = 0
+    for item in items:
+        if count is not None and item_count == count:
+            raise ValueError(f"Expected {count} items, but got more.")
+        written += write_prefixed(
+            item, child_type, stream, length_type=length_t,
+            prefix_if_constant=settings.prefix_if_constant
+        )
+        item_count += 1
+    if count is not None and item_count != count:
+        raise ValueError(f"Expected {count} items, but got {item_count}.")
+    return item_count, written
+
+
+def marshal_iter(items: Iterable[S], pae_type: PAEHomogeneousList[S],
+                 stream: IO, count: Optional[int] = None,
+                 spool_size: int = DEFAULT_SPOOL_SIZE) -> int:
+    """
+    Serialise the items produced by an iterable as a homogeneous list,
+    writing them to a stream as they arrive.
+
+    The list's size precedes its elements in the output, so it has to be
+    filled in after the fact unless it is known in advance:
+
+     * if ``count`` is specified, the output is written strictly
+       sequentially without any buffering;
+     * otherwise, if ``stream`` is seekable, a placeholder is written and
+       the size is backpatched at the end;
+     * otherwise, the elements are buffered in a
+       :class:`~tempfile.SpooledTemporaryFile`, which only spills to disk
+       once its contents exceed ``spool_size`` bytes.
+
+    :param items:
+        An iterable of list elements, e.g. a generator.
+    :param pae_type:
+        The type of the list.
+    :param stream:
+        The output stream to write to.
+    :param count:
+        The number of items produced by ``items``, if known.
+    :param spool_size:
+        Maximal number of bytes to buffer in memory when writing to a
+        non-seekable stream without a known ``count``.
+    :return:
+        The number of bytes written.
+    :raises ValueError:
+        if ``count`` is specified, but does not match the number of items.
+    """
+    size_t = pae_type.settings.size_type
+    size_len = size_t.constant_length
+    if count is not None:
+        stream.write(size_t.pack(count))
+        _, written = _write_items(items, pae_type, stream, count)
+    elif _is_seekable(stream):
+        stream.write(bytes(size_len))  # placeholder
+        count, written = _write_items(items, pae_type, stream)
+        # backtrack to fill in the size
+        stream.seek(-written - size_len, os.SEEK_CUR)
+        stream.write(size_t.pack(count))
+        stream.seek(written, os.SEEK_CUR)
+    else:
+        with SpooledTemporaryFile(max_size=spool_size) as spool:
+            count, written = _write_items(items, pae_type, spool)
+            stream.write(size_t.pack(count))
+            spool.seek(0)
+            shutil.copyfileobj(spool, stream)
+    return written + size_len
+
+
+def iter_unmarshal(stream: IO, pae_type: PAEHomogeneousList[S],
+                   length: Optional[int] = None) -> Iterator[S]:
+    """
+    Decode a homogeneous list from a stream, yielding its elements one by
+    one as they are read.
+
+    The list's elements are not retained, so memory usage only depends on
+    the size of the individual elements.
+    The checks on the length of the list's payload are the same as in
+    :func:`~python_pae.encode.unmarshal`, but errors pertaining to
+    the list as a whole are only raised at the end of the iteration.
+
+    :param stream:
+        The stream to read from.
+    :param pae_type:
+        The type of the list.
+    :param length:
+        The length of the encoded list. If ``None``, the list is expected
+        to extend until the end of the stream.
+    :return:
+        An iterator over the list's elements.
+    :raises python_pae.PAEDecodeError:
+        if an error occurs in the decoding process.
+    """
+    budget = _current_budget()
+    if budget is None:
+        yield from _iter_items(stream, pae_type, length)
+        return
+    budget.enter_list()
+    try:
+        yield from _iter_items(stream, pae_type, length)
+    finally:
+        budget.exit_list()
+
+
+def _iter_items(stream: IO, pae_type: PAEHomogeneousList[S],
+                length: Optional[int]) -> Iterator[S]:
+    if length is None and _is_seekable(stream):
+        # the list extends until the end of the stream, so length prefixes
+        # can be checked against the remaining size
+        pos = stream.tell()
+        length = stream.seek(0, os.SEEK_END) - pos
+        stream.seek(pos)
+    counter = _CountingReader(stream)
+    reader = PAEListReader(counter, pae_type.settings, expected_length=length)
+    child_type = pae_type.child_type
+    for _ in range(reader.count):
+        value = reader.read_next(child_type)
+        # the stream may end before the list's payload does
+        if counter.bytes_read != reader.bytes_read:
+            raise PAEDecodeError(
+                f"Expected {reader.bytes_read} bytes, but only "
+                f"{counter.bytes_read} were available"
+            )
+        yield value
+
+    reader.finish()
+    if length is None and stream.read(1):
+        raise PAEDecodeError(
+            "Unexpected data after end of list; trailing data."
+        )
@@ -0,0 +1,320 @@
+"""
+This module implements a validation-only decoder, which checks that
+PAE-encoded data is well-formed without materialising the decoded values.
+
+.. (c) 2021 Matthias Valvekens
+"""
+
+import os
+import sys
+from dataclasses import dataclass
+from itertools import repeat
+from typing import IO, List, Optional, Tuple, Union
+
+from .abstract import PAEType, PAEDecodeError
+from .encode import BufferReader, _is_seekable, _read_with_errh
+from .number import PAENumberType
+from .pae_types import (
+    PAEBytes, PAEString, PAEHomogeneousList, PAEHeterogeneousList,
+    _check_packed_length
+)
+
+__all__ = ['validate', 'PAEValidationSummary']
+
+
+PAEListType = Union[PAEHomogeneousList, PAEHeterogeneousList]
+
+_LIST_TYPES = (PAEHomogeneousList, PAEHeterogeneousList)
+
+_SKIP_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass(frozen=True)
+class PAEValidationSummary:
+    """
+    Summary of a successfully validated PAE value.
+    """
+
+    total_size: int
+    """
+    The total length of the encoded value.
+    """
+
+    element_counts: Tuple[int, ...]
+    """
+    The number of list elements at each nesting level.
+    The first entry is the number of elements of the outermost list,
+    the second one is the total number of elements of all lists nested
+    directly inside it, and so forth.
+    Empty if the value is not a list.
+    """
+
+
+class _ValidationState:
+
+    def __init__(self, stream: IO):
+        self.stream = stream
+        self.skip_by_seeking = _is_seekable(stream)
+        self.element_counts: List[int] = []
+
+    def count_elements(self, depth: int, count: int):
+        counts = self.element_counts
+        if len(counts) == depth:
+            counts.append(0)
+        counts[depth] += count
+
+
+def _skip(state: _ValidationState, length: int):
+    stream = state.stream
+    if state.skip_by_seeking:
+        # the caller guarantees that the data is present
+        stream.seek(length, os.SEEK_CUR)
+        return
+    remaining = length
+    while remaining:
+        chunk = stream.read(min(remaining, _SKIP_CHUNK_SIZE))
+        if not chunk:
+            raise PAEDecodeError(
+                f"Expected {length} bytes, but only {length - remaining} "
+                f"were available"
+            )
+        remaining -= len(chunk)
+
+
+def _read_exactly(stream: IO, length: int):
+    data = stream.read(length)
+    if len(data) != length:
+        raise PAEDecodeError(
+            f"Expected {length} bytes, but only {len(data)} were available"
+        )
+    return data
+
+
+class _ListFrame:
+    __slots__ = (
+        'settings', 'length_t', 'item_types', 'bytes_read', 'length', 'depth'
+    )
+
+    def __init__(self, settings, item_types, bytes_read: int,
+                 length: Optional[int], depth: int):
+        self.settings = settings
+        self.length_t = settings.length_type or settings.size_type
+        self.item_types = item_types
+        self.bytes_read = bytes_read
+        self.length = length
+        self.depth = depth
+
+
+def _open_list(pae_type: PAEListType, state: _ValidationState,
+               depth: int, length: Optional[int]) -> Optional[_ListFrame]:
+    # Read a list's size, and return a frame to validate its items with,
+    # or None if there's nothing left to validate.
+    stream = state.stream
+    settings = pae_type.settings
+    size_t = settings.size_type
+    size_len = size_t.constant_length
+    part_count = size_t.unpack(_read_exactly(stream, size_len))
+    state.count_elements(depth, part_count)
+    if isinstance(pae_type, PAEHeterogeneousList):
+        item_types = pae_type.component_types
+        if len(item_types) != part_count:
+            raise PAEDecodeError(
+                f"Wrong number of components, expected "
+                f"{len(item_types)} but got {part_count}."
+            )
+        item_types = iter(item_types)
+    elif pae_type._packed_numbers():
+        payload_length = part_count * pae_type.child_type.constant_length
+        _check_packed_length(size_len + payload_length, length)
+        _skip(state, payload_length)
+        return None
+    elif part_count <= sys.maxsize:
+        item_types = repeat(pae_type.child_type, part_count)
+    else:
+        # Too large for repeat(); validation will fail long before the
+        # count is exhausted.
+        child_type = pae_type.child_type
+        item_types = (child_type for _ in range(part_count))
+    return _ListFrame(settings, item_types, size_len, length, depth)
+
+
+def _validate_list(pae_type: PAEListType, state: _ValidationState,
+                   depth: int, length: Optional[int]):
+    # Nested lists are validated using an explicit stack, like in
+    # the decoding engine in pae_types, so deeply nested values don't hit
+    # the recursion limit.
+    frame = _open_list(pae_type, state, depth, length)
+    stack = [frame] if frame is not None else []
+    stream = state.stream
+    while stack:
+        frame = stack[-1]
+        settings = frame.settings
+        length_t = frame.length_t
+        pref_len = length_t.constant_length
+        length = frame.length
+        # Same checks as in read_pae_coro, but without the overhead of
+        # decoding values.
+        for item_type in frame.item_types:
+            const_len = item_type.constant_length
+            if settings.prefix_if_constant or const_len is None:
+                try:
+                    item_length = length_t.unpack(
+                        _read_exactly(stream, pref_len)
+                    )
+                except PAEDecodeError as e:
+                    raise PAEDecodeError(
+                        f"Failed to read length prefix for value of type "
+                        f"{item_type}"
+                    ) from e
+                frame.bytes_read += pref_len + item_length
+            else:
+                item_length = const_len
+                frame.bytes_read += item_length
+            if length is not None and frame.bytes_read > length:
+                raise PAEDecodeError(
+                    f"Expected a payload of length {length}; next "
+                    f"item too long: would need at least {frame.bytes_read}"
+                )
+            if type(item_type) in _LIST_TYPES:
+                child = _open_list(
+                    item_type, state, frame.depth + 1, item_length
+                )
+                if child is not None:
+                    stack.append(child)
+                    break
+            else:
+                _validate_leaf(item_type, state, item_length)
+        else:
+            _check_packed_length(frame.bytes_read, length)
+            stack.pop()
+
+
+def _validate_value(pae_type: PAEType, state: _ValidationState, depth: int,
+                    length: Optional[int]):
+    if type(pae_type) in _LIST_TYPES:
+        _validate_list(pae_type, state, depth, length)
+    else:
+        _validate_leaf(pae_type, state, length)
+
+
+def _validate_leaf(pae_type: PAEType, state: _ValidationState,
+                   length: Optional[int]):
+    pae_type_cls = type(pae_type)
+    if pae_type_cls is PAEBytes:
+        # any byte sequence is valid
+        _skip(state, length)
+    elif isinstance(pae_type, PAENumberType):
+        # any byte sequence of the right length is valid
+        if length != pae_type.constant_length:
+            raise PAEDecodeError(
+                f"Expected {pae_type.constant_length} bytes for value of "
+                f"type {pae_type}, but got {length}"
+            )
+        _skip(state, length)
+    elif pae_type_cls is PAEString:
+        data = _read_exactly(state.stream, length)
+        try:
+            str(data, 'utf8')
+        except UnicodeDecodeError as e:
+            raise PAEDecodeError(f"Invalid UTF-8 in string: {e}") from e
+    else:
+        # no shortcuts available
+        _read_with_errh(pae_type, state.stream, length)
+
+
+_READ_CHUNK_SIZE = 64 * 1024
+
+
+class _CountingReader:
+    """
+    Non-seekable stream wrapper that keeps track of the number of bytes read.
+
+    Large reads are split into chunks, so that a bogus length prefix in the
+    input can't make the underlying stream allocate a huge buffer up front.
+    """
+
+    def __init__(self, stream: IO):
+        self._stream = stream
+        self.bytes_read = 0
+
+    def read(self, size: int = -1):
+        if size <= _READ_CHUNK_SIZE:
+            data = self._stream.read(size)
+        else:
+            chunks = []
+            while size > 0:
+                chunk = self._stream.read(min(size, _READ_CHUNK_SIZE))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size -= len(chunk)
+            data = b''.join(chunks)
+        self.bytes_read += len(data)
+        return data
+
+    def seekable(self) -> bool:
+        return False
+
+
+def validate(packed_or_stream, pae_type: PAEType,
+             length: Optional[int] = None) -> PAEValidationSummary:
+    """
+    Check that an encoded value is well-formed, without decoding it.
+
+    All structural checks performed by :func:`~python_pae.encode.unmarshal`
+    are carried out (list sizes, length prefixes, trailing data), and strings
+    are checked to be valid UTF-8. The payloads of
+    :class:`~python_pae.pae_types.PAEBytes` and numeric values are skipped
+    over. Values of other types are decoded and discarded.
+
+    :param packed_or_stream:
+        An object supporting the buffer protocol, or a binary stream.
+        Buffers are not copied. Seekable streams are read from their
+        current position until the end, unless ``length`` is specified.
+    :param pae_type:
+        The :class:`.PAEType` describing the structure of the data.
+    :param length:
+        The length of the encoded value, if not the entire input.
+        Required for non-seekable streams, unless ``pae_type`` is one of the
+        built-in list types, in which case the stream is read until the end
+        of the list.
+    :return:
+        A :class:`PAEValidationSummary`.
+    :raises python_pae.PAEDecodeError:
+        if the data is not well-formed.
+    """
+    if hasattr(packed_or_stream, 'read'):
+        stream = packed_or_stream
+    else:
+        stream = BufferReader(packed_or_stream)
+    state = _ValidationState(stream)
+
+    if state.skip_by_seeking:
+        start = stream.tell()
+        available = stream.seek(0, os.SEEK_END) - start
+        stream.seek(start)
+        if length is None:
+            length = available
+        elif length > available:
+            raise PAEDecodeError(
+                f"Expected {length} bytes, but only {available} "
+                f"were available"
+            )
+    elif length is None and type(pae_type) not in _LIST_TYPES:
+        raise ValueError("length must be specified for non-seekable streams")
+
+    if length is not None:
+        _validate_value(pae_type, state, 0, length)
+        total_size = length
+    else:
+        # read until the end of the list, and make sure nothing follows
+        counter = state.stream = _CountingReader(stream)
+        _validate_value(pae_type, state, 0, None)
+        if stream.read(1):
+            raise PAEDecodeError(
+                "Unexpected data after end of list; trailing data."
+            )
+        total_size = counter.bytes_read
+    return PAEValidationSummary(
+        total_size=total_size, element_counts=tuple(state.element_counts)
+    )
@@ -4,7 +4,18 @@ PAE encoding/decoding tests.
 .. (c) 2021 Matthias Valvekens
 """
 
+import array
+import asyncio
+import copy
+import hashlib
+import hmac
+import mmap
+import os
+import pickle
+import socket
 import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from io import BytesIO
 from typing import IO
 
@@ -12,14 +23,35 @@ import pytest
 
 from python_pae import (
     pae_encode, unmarshal, marshal, pae_encode_multiple,
-    PAEDecodeError
+    PAEDecodeError, marshal_to_digest, pae_digest,
+    pae_encode_multiple_digest, PAEDecodeLimits, decode_limits,
+    PAEPreEncoded, pae_encode_batch, pae_decode
 )
 from python_pae.abstract import PAEType
+from python_pae.codec import compile as compile_codec
+from python_pae.lazy import unmarshal_lazy, PAELazyList
+from python_pae.files import marshal_file, unmarshal_file
+from python_pae.aio import marshal_async, unmarshal_async, read_pae_async
+from python_pae.scatter import marshal_buffers, writev_all, sendmsg_all
+from python_pae.streaming import iter_unmarshal, marshal_iter
+from python_pae.validate import validate, PAEValidationSummary
+import python_pae.batch
+from python_pae.batch import marshal_many, unmarshal_many, unmarshal_parallel
+from python_pae.cache import (
+    PAEEncodingCache, PAECacheStats, encoding_cache, LRU, FIFO
+)
+from python_pae.instrument import (
+    instrument, collecting, PAECounters, ENCODE, DECODE
+)
+from python_pae.incremental import (
+    PAEPushParser, ListStart, ListEnd, ElementLength, ElementValue
+)
 from python_pae.number import PAE_USHORT, PAE_ULLONG, PAE_UCHAR, PAE_UINT, \
     PAENumberType
-from python_pae.encode import write_prefixed, PAEListSettings
+from python_pae.encode import write_prefixed, PAEListSettings, \
+    BufferReader, marshal_into, encoded_size, PAEListReader, read_pae_coro
 from python_pae.pae_types import PAEBytes, PAEHomogeneousList, \
-    PAEHeterogeneousList, PAEString
+    PAEHeterogeneousList, PAEString, PAEPackedArray
 
 # Default list encoding settings for our tests
 NO_CONST_PREFIX = PAEListSettings(
@@ -351,3 +383,2395 @@ def test_number_str_known():
 
 def test_number_str_generic():
     assert str(PAENumberType(4)) == '<uint128>'
+
+
+class NonSeekableStream:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def seekable(self):
+        return False
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+class OpaqueBytes(PAEType[bytes]):
+    # does not report its output length in advance
+
+    def write(self, value: bytes, stream: IO) -> int:
+        return stream.write(value)
+
+    def read(self, stream: IO, length: int) -> bytes:
+        return stream.read(length)
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_encoded_length_nested(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    assert lst_type.encoded_length(inp) == len(expected_out)
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_encode_nested_non_seekable(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    out = NonSeekableStream()
+    written = lst_type.write(inp, out)
+    assert out.getvalue() == expected_out
+    assert written == len(expected_out)
+
+
+def test_encoded_length_str_non_ascii():
+    assert PAEString().encoded_length('テスト') == 9
+    assert PAEString().encoded_length('abc') == 3
+
+
+@pytest.mark.parametrize('stream_type', [BytesIO, NonSeekableStream])
+def test_encode_length_unknown_fallback(stream_type):
+    lst_type = PAEHomogeneousList(OpaqueBytes(), settings=WITH_CONST_PREFIX)
+    assert lst_type.encoded_length([b'12', b'345']) is None
+    out = stream_type()
+    lst_type.write([b'12', b'345'], out)
+    assert out.getvalue() == b'\x02\x00\x02\x0012\x03\x00345'
+
+
+def test_encode_wrong_length_reported():
+    class LyingBytes(PAEBytes):
+        def encoded_length(self, value: bytes) -> int:
+            return len(value) + 1
+
+    with pytest.raises(IOError, match='but wrote'):
+        write_prefixed(
+            b'abc', LyingBytes(), BytesIO(), length_type=PAE_USHORT
+        )
+
+
+@pytest.mark.parametrize('inp', [
+    [b'12', b'345'], [], [b'\x00' * 100000, b'', b'abc'],
+])
+def test_pae_digest(inp):
+    h = hashlib.sha256()
+    written = pae_digest(inp, h)
+    expected = pae_encode(inp)
+    assert written == len(expected)
+    assert h.digest() == hashlib.sha256(expected).digest()
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_pae_encode_multiple_digest(inp, types, expected_out):
+    h = hmac.new(b'secret', digestmod='sha256')
+    pae_encode_multiple_digest(zip(inp, types), h, size_t=PAE_USHORT)
+    expected = hmac.new(b'secret', expected_out, digestmod='sha256')
+    assert h.digest() == expected.digest()
+
+
+def test_marshal_to_digest_multiple_hashers():
+    lst_type = PAEHomogeneousList(OpaqueBytes(), settings=WITH_CONST_PREFIX)
+    h1 = hashlib.sha256()
+    h2 = hashlib.sha512()
+    written = marshal_to_digest([b'12', b'345'], lst_type, [h1, h2])
+    expected = b'\x02\x00\x02\x0012\x03\x00345'
+    assert written == len(expected)
+    assert h1.digest() == hashlib.sha256(expected).digest()
+    assert h2.digest() == hashlib.sha512(expected).digest()
+
+
+def _to_bytes_deep(value):
+    if isinstance(value, memoryview):
+        return bytes(value)
+    elif isinstance(value, list):
+        return [_to_bytes_deep(x) for x in value]
+    return value
+
+
+@pytest.mark.parametrize('wrap', [bytes, bytearray, memoryview])
+@pytest.mark.parametrize('expected_out,types,inp', NESTED_HETEROGENEOUS_TESTS)
+def test_decode_nested_zero_copy(inp, types, expected_out, wrap):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    decoded = unmarshal(wrap(inp), lst_type, zero_copy=True)
+    assert isinstance(decoded[-1], (memoryview, str))
+    assert _to_bytes_deep(decoded) == expected_out
+
+
+def test_decode_zero_copy_shares_buffer():
+    buf = bytearray(b'\x02\x00\x02\x0012\x03\x00345')
+    lst_type = PAEHomogeneousList(PAEBytes(), WITH_CONST_PREFIX)
+    decoded = unmarshal(buf, lst_type, zero_copy=True)
+    buf[4] = ord('x')
+    assert bytes(decoded[0]) == b'x2'
+    assert bytes(decoded[1]) == b'345'
+
+
+def test_decode_zero_copy_mmap():
+    packed = b'\x02\x00\x02\x0012\x03\x00345'
+    mm = mmap.mmap(-1, len(packed))
+    mm.write(packed)
+    lst_type = PAEHomogeneousList(PAEBytes(), WITH_CONST_PREFIX)
+    decoded = unmarshal(mm, lst_type, zero_copy=True)
+    assert [bytes(x) for x in decoded] == [b'12', b'345']
+
+
+def test_decode_zero_copy_non_byte_format():
+    packed = array.array('H')
+    packed.frombytes(b'\x01\x00\x02\x0012')
+    lst_type = PAEHomogeneousList(PAEBytes(), WITH_CONST_PREFIX)
+    decoded = unmarshal(packed, lst_type, zero_copy=True)
+    assert [bytes(x) for x in decoded] == [b'12']
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\x02\x00\x01\x00\x00\x00\x05\x00123',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=WITH_CONST_PREFIX)),
+    (b'\x01\x00\x01\x00',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX))
+])
+def test_decode_payload_too_short_zero_copy(inp, pae_type):
+    with pytest.raises(PAEDecodeError, match='Expected.*next item'):
+        unmarshal(inp, pae_type, zero_copy=True)
+
+
+def test_buffer_reader_seek():
+    reader = BufferReader(b'0123456789')
+    assert len(reader) == 10
+    assert bytes(reader.read(3)) == b'012'
+    reader.seek(2, 1)
+    assert reader.tell() == 5
+    reader.seek(-2, 2)
+    assert bytes(reader.read()) == b'89'
+    assert bytes(reader.read(5)) == b''
+    reader.seek(0)
+    assert bytes(reader.read(20)) == b'0123456789'
+    with pytest.raises(ValueError):
+        reader.seek(-1)
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_codec_nested(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    codec = compile_codec(lst_type)
+    assert codec.encode(inp) == expected_out
+    assert codec.decode(expected_out) == inp
+
+
+@pytest.mark.parametrize('inp,types,expected_out',
+                         TEST_ENCODE_HETEROGENEOUS_NO_PREFIX)
+def test_codec_heterogeneous_const_no_prefix(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=NO_CONST_PREFIX
+    )
+    codec = compile_codec(lst_type)
+    assert codec.encode(inp) == expected_out
+    assert codec.decode(expected_out) == inp
+
+
+@pytest.mark.parametrize('settings', [
+    NO_CONST_PREFIX, WITH_CONST_PREFIX,
+    PAEListSettings(size_type=PAE_UINT, length_type=PAE_UCHAR),
+])
+@pytest.mark.parametrize('child_type,value', [
+    (PAE_UINT, [1, 2, 3, 2 ** 32 - 1]),
+    (PAE_UCHAR, []),
+    (PAEBytes(), [b'12', b'', b'345']),
+    (PAEString(), ['テスト', 'abc']),
+    (OpaqueBytes(), [b'12', b'', b'345']),
+    (PAEHomogeneousList(PAE_ULLONG), [[1, 2], [], [3]]),
+])
+def test_codec_homogeneous(child_type, value, settings):
+    lst_type = PAEHomogeneousList(child_type, settings=settings)
+    codec = compile_codec(lst_type)
+    encoded = marshal(value, lst_type)
+    assert codec.encode(value) == encoded
+    assert codec.decode(encoded) == value
+
+
+def test_codec_heterogeneous_fixed_runs():
+    lst_type = PAEHeterogeneousList(
+        [PAE_UINT, PAE_USHORT, PAEBytes(), PAE_UCHAR, PAE_ULLONG, PAEString()],
+        settings=WITH_CONST_PREFIX
+    )
+    value = [1, 2, b'abc', 3, 4, 'xyz']
+    codec = compile_codec(lst_type)
+    encoded = marshal(value, lst_type)
+    assert codec.encode(value) == encoded
+    assert codec.decode(encoded) == value
+
+
+def test_codec_leaf_types():
+    assert compile_codec(PAE_UINT).decode(b'\x01\x00\x00\x00') == 1
+    assert compile_codec(PAEString()).encode('abc') == b'abc'
+    assert compile_codec(PAEBytes()).encode(bytearray(b'abc')) == b'abc'
+    assert compile_codec(OpaqueBytes()).decode(b'abc') == b'abc'
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\x02\x00\x04\x00\x01\x00\x00\x00\x05\x00123',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=WITH_CONST_PREFIX)),
+    (b'\x01\x00\x01\x00',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)),
+    (b'\x05\x00\x01\x02\x03',
+     PAEHomogeneousList(PAE_UCHAR, settings=NO_CONST_PREFIX)),
+    (b'\x05\x00\x02\x00\x01\x00',
+     PAEHomogeneousList(PAE_USHORT, settings=WITH_CONST_PREFIX)),
+])
+def test_codec_payload_too_short(inp, pae_type):
+    with pytest.raises(PAEDecodeError, match='Expected.*next item'):
+        compile_codec(pae_type).decode(inp)
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\x02\x00\x01\x00\x00\x00\x05\x00123456',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=NO_CONST_PREFIX)),
+    (b'\x01\x00\x00\x001',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)),
+    (b'\x01\x00\x01\x02',
+     PAEHomogeneousList(PAE_UCHAR, settings=NO_CONST_PREFIX)),
+    (b'\x00\x00\x00',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)),
+])
+def test_codec_payload_too_long(inp, pae_type):
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        compile_codec(pae_type).decode(inp)
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\x01\x00\x01\x00\x00\x00',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=NO_CONST_PREFIX)),
+    (b'\x03\x00\x01\x00\x00\x00\x00\x00\x00\x00',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=NO_CONST_PREFIX)),
+])
+def test_codec_wrong_component_count(inp, pae_type):
+    with pytest.raises(PAEDecodeError, match='Wrong number of components'):
+        compile_codec(pae_type).decode(inp)
+    with pytest.raises(ValueError, match='Wrong number of components'):
+        compile_codec(pae_type).encode([1])
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\x02\x00\x03\x00\x01\x00\x00\x00\x00\x00',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=WITH_CONST_PREFIX)),
+    (b'\x01\x00\x03\x00\x01\x00',
+     PAEHomogeneousList(PAE_USHORT, settings=WITH_CONST_PREFIX)),
+])
+def test_codec_wrong_constant_prefix(inp, pae_type):
+    with pytest.raises(PAEDecodeError, match='length prefix'):
+        compile_codec(pae_type).decode(inp)
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\xee\xaa', PAEString()),
+    (b'\x01\x001', PAE_ULLONG),
+])
+def test_codec_payload_invalid(inp, pae_type):
+    with pytest.raises(PAEDecodeError):
+        compile_codec(pae_type).decode(inp)
+
+
+@pytest.mark.parametrize('num_type', [
+    PAE_UCHAR, PAE_USHORT, PAE_UINT, PAE_ULLONG
+])
+def test_number_bulk(num_type):
+    values = [0, 1, 2 ** (8 * num_type.constant_length) - 1, 17]
+    packed = num_type.pack_many(values)
+    assert packed == b''.join(num_type.pack(v) for v in values)
+    assert num_type.unpack_many(packed) == values
+    assert list(num_type.iter_unpack(packed)) == values
+    assert num_type.unpack_many(b'') == []
+
+
+def test_number_pack_into_unpack_from():
+    buf = bytearray(6)
+    PAE_UINT.pack_into(buf, 2, 0x01020304)
+    assert buf == b'\x00\x00\x04\x03\x02\x01'
+    assert PAE_UINT.unpack_from(buf, 2) == 0x01020304
+    assert PAE_USHORT.unpack_from(buf) == 0
+
+
+def test_number_unpack_many_wrong_length():
+    with pytest.raises(struct.error):
+        PAE_UINT.unpack_many(b'\x00\x00\x00')
+
+
+@pytest.mark.parametrize('op', [
+    lambda t: t.pack(1), lambda t: t.unpack(bytes(16)),
+    lambda t: t.pack_many([1]), lambda t: t.unpack_many(bytes(16)),
+    lambda t: t.read(BytesIO(bytes(16)), 16),
+])
+def test_number_unsupported_width(op):
+    with pytest.raises(ValueError, match='128-bit'):
+        op(PAENumberType(4))
+
+
+def test_number_unsupported_width_copy():
+    num_type = PAENumberType(4)
+    assert not hasattr(num_type._struct, 'nonexistent')
+    assert copy.deepcopy(num_type).constant_length == 16
+    assert pickle.loads(pickle.dumps(num_type)).constant_length == 16
+
+
+@pytest.mark.parametrize('value', [-1, 1.5, '2'])
+def test_number_invalid_width(value):
+    with pytest.raises(ValueError, match='non-negative integer'):
+        PAENumberType(value)
+
+
+@pytest.mark.parametrize('num_type', [
+    PAE_UCHAR, PAE_USHORT, PAE_UINT, PAE_ULLONG
+])
+def test_encode_number_list_packed(num_type):
+    values = list(range(200 // num_type.constant_length))
+    lst_type = PAEHomogeneousList(num_type, settings=NO_CONST_PREFIX)
+    encoded = marshal(values, lst_type)
+    assert encoded == PAE_USHORT.pack(len(values)) + b''.join(
+        num_type.pack(v) for v in values
+    )
+    assert unmarshal(encoded, lst_type) == values
+
+
+@pytest.mark.parametrize('inp,match', [
+    (b'\x03\x00\x01\x00\x02\x00', 'next item'),
+    (b'\x02\x00\x01\x00\x02\x00\x03', 'trailing data'),
+    (b'\x02', 'Failed to read value'),
+])
+def test_decode_number_list_packed_errors(inp, match):
+    lst_type = PAEHomogeneousList(PAE_USHORT, settings=NO_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError, match=match):
+        unmarshal(inp, lst_type)
+
+
+def test_decode_number_list_packed_truncated():
+    # the item claims 14 bytes, but the data ends after the second number
+    truncated = b'\x01\x00\x0e\x00\x03\x00' \
+        b'\x01\x00\x00\x00\x02\x00\x00\x00'
+    coro = read_pae_coro(BytesIO(truncated), NO_CONST_PREFIX)
+    assert next(coro) == 1
+    lst_type = PAEHomogeneousList(PAE_UINT, settings=NO_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError, match='12 bytes of list data'):
+        coro.send(lst_type)
+
+
+@pytest.mark.parametrize('num_type', [
+    PAE_UCHAR, PAE_USHORT, PAE_UINT, PAE_ULLONG
+])
+def test_packed_array_roundtrip(num_type):
+    values = list(range(200 // num_type.constant_length))
+    arr_type = PAEPackedArray(num_type, settings=NO_CONST_PREFIX)
+    lst_type = PAEHomogeneousList(num_type, settings=NO_CONST_PREFIX)
+    arr = array.array(arr_type.typecode, values)
+    encoded = marshal(arr, arr_type)
+    assert encoded == marshal(values, lst_type)
+    assert arr_type.encoded_length(arr) == len(encoded)
+    decoded = unmarshal(encoded, arr_type)
+    assert isinstance(decoded, array.array)
+    assert decoded == arr
+    assert unmarshal(encoded, lst_type) == values
+
+
+def test_packed_array_from_list_and_buffer():
+    arr_type = PAEPackedArray(PAE_USHORT, settings=NO_CONST_PREFIX)
+    expected = b'\x02\x00\x01\x00\x02\x01'
+    assert marshal([1, 0x102], arr_type) == expected
+    view = memoryview(b'\x01\x00\x02\x01').cast('H')
+    assert marshal(view, arr_type) == expected
+
+
+@pytest.mark.parametrize('stream_type', [BytesIO, NonSeekableStream])
+def test_packed_array_nested_generator(stream_type):
+    lst_type = PAEHeterogeneousList([PAEPackedArray(PAE_UINT), PAEBytes()])
+    expected = marshal([[0, 1, 2], b'x'], lst_type)
+    assert lst_type.encoded_length([(i for i in range(3)), b'x']) is None
+    assert marshal([(i for i in range(3)), b'x'], lst_type) == expected
+    out = stream_type()
+    lst_type.write([(i for i in range(3)), b'x'], out)
+    assert out.getvalue() == expected
+
+
+def test_packed_array_nested():
+    lst_type = PAEHeterogeneousList(
+        [PAEBytes(), PAEPackedArray(PAE_UINT)], settings=WITH_CONST_PREFIX
+    )
+    value = [b'abc', array.array('I', [1, 2, 3])]
+    decoded = unmarshal(marshal(value, lst_type), lst_type)
+    assert decoded == value
+
+
+def test_packed_array_wrong_itemsize():
+    arr_type = PAEPackedArray(PAE_USHORT)
+    with pytest.raises(ValueError, match='item size'):
+        marshal(b'\x01\x02', arr_type)
+
+
+def test_packed_array_prefix_not_allowed():
+    with pytest.raises(ValueError, match='length prefixes'):
+        PAEPackedArray(PAE_UINT, settings=WITH_CONST_PREFIX)
+
+
+def test_packed_array_unsupported_width():
+    with pytest.raises(ValueError, match='No array type'):
+        PAEPackedArray(PAENumberType(4), settings=NO_CONST_PREFIX)
+
+
+def test_packed_array_byteswapped(monkeypatch):
+    # pretend to be on a big-endian host
+    monkeypatch.setattr(python_pae.pae_types.sys, 'byteorder', 'big')
+    arr_type = PAEPackedArray(PAE_UINT, settings=NO_CONST_PREFIX)
+    arr = array.array('I', [1, 2, 3])
+    h = hashlib.sha256()
+    # the digest sink counts the objects passed to it by their length
+    assert marshal_to_digest(arr, arr_type, h) == 14
+    out = BytesIO()
+    assert arr_type.write(arr, out) == 14
+    assert unmarshal(out.getvalue(), arr_type) == arr
+
+
+@pytest.mark.parametrize('inp,match', [
+    (b'\x03\x00\x01\x00\x02\x00', 'next item'),
+    (b'\x02\x00\x01\x00\x02\x00\x03', 'trailing data'),
+    (b'\x02', 'Failed to read value'),
+])
+def test_packed_array_decode_errors(inp, match):
+    arr_type = PAEPackedArray(PAE_USHORT, settings=NO_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError, match=match):
+        unmarshal(inp, arr_type)
+
+
+@pytest.mark.parametrize('expected_out,types,inp', NESTED_HETEROGENEOUS_TESTS)
+def test_decode_nested_lazy(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    decoded = unmarshal_lazy(inp, lst_type)
+    assert isinstance(decoded, PAELazyList)
+    assert len(decoded) == len(expected_out)
+    assert isinstance(decoded[1], PAELazyList)
+    assert decoded.materialise() == expected_out
+    assert decoded[-1] == expected_out[-1]
+    assert decoded[:1] == expected_out[:1]
+
+
+def test_decode_lazy_on_demand():
+    class CountingBytes(PAEBytes):
+        reads = 0
+
+        def read(self, stream: IO, length: int) -> bytes:
+            CountingBytes.reads += 1
+            return super().read(stream, length)
+
+    lst_type = PAEHomogeneousList(CountingBytes(), WITH_CONST_PREFIX)
+    packed = b'\x03\x00\x01\x00a\x02\x00bc\x00\x00'
+    decoded = unmarshal_lazy(packed, lst_type)
+    assert CountingBytes.reads == 0
+    assert decoded[1] == b'bc'
+    assert decoded[1] == b'bc'
+    assert CountingBytes.reads == 1
+    assert bytes(decoded.raw(0)) == b'a'
+    not_memoized = unmarshal_lazy(packed, lst_type, memoize=False)
+    assert not_memoized[1] == not_memoized[1]
+    assert CountingBytes.reads == 3
+    with pytest.raises(IndexError):
+        decoded[3]
+
+
+def test_decode_lazy_zero_copy():
+    lst_type = PAEHomogeneousList(PAEBytes(), WITH_CONST_PREFIX)
+    packed = b'\x02\x00\x02\x0012\x03\x00345'
+    decoded = unmarshal_lazy(packed, lst_type, zero_copy=True)
+    assert isinstance(decoded[0], memoryview)
+    assert bytes(decoded[1]) == b'345'
+
+
+def test_decode_lazy_non_list():
+    assert unmarshal_lazy(b'\x01\x00', PAE_USHORT) == 1
+
+
+def test_decode_lazy_element_error_deferred():
+    lst_type = PAEHomogeneousList(PAEString(), WITH_CONST_PREFIX)
+    decoded = unmarshal_lazy(b'\x02\x00\x01\x00a\x02\x00\xee\xaa', lst_type)
+    assert decoded[0] == 'a'
+    with pytest.raises(PAEDecodeError):
+        decoded[1]
+
+
+@pytest.mark.parametrize('inp,pae_type,match', [
+    (b'\x02\x00\x04\x00\x01\x00\x00\x00\x05\x00123',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=WITH_CONST_PREFIX), 'next item'),
+    (b'\x01\x00\x01\x00',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX), 'next item'),
+    (b'\xff\xff\x01\x00',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX), 'would need'),
+    (b'\x01\x00\x00\x001',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX),
+     'trailing data'),
+    (b'\x01\x00\x01\x00\x00\x00',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=NO_CONST_PREFIX), 'Wrong number of components'),
+    (b'\x01',
+     PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX), 'list size'),
+])
+def test_decode_lazy_structure_errors(inp, pae_type, match):
+    with pytest.raises(PAEDecodeError, match=match):
+        unmarshal_lazy(inp, pae_type)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+@pytest.mark.parametrize('zero_copy', [False, True])
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_file_roundtrip(tmp_path, inp, types, expected_out, lazy, zero_copy):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    path = tmp_path / 'test.pae'
+    assert marshal_file(inp, lst_type, path) == len(expected_out)
+    assert path.read_bytes() == expected_out
+    decoded = unmarshal_file(path, lst_type, lazy=lazy, zero_copy=zero_copy)
+    if lazy:
+        decoded = decoded.materialise()
+    assert _to_bytes_deep(decoded) == inp
+
+
+def test_file_length_unknown(tmp_path):
+    lst_type = PAEHomogeneousList(OpaqueBytes(), settings=WITH_CONST_PREFIX)
+    path = str(tmp_path / 'test.pae')
+    marshal_file([b'12', b'345'], lst_type, path)
+    with open(path, 'rb') as f:
+        assert f.read() == b'\x02\x00\x02\x0012\x03\x00345'
+    with open(path, 'rb') as f:
+        assert unmarshal_file(f, lst_type) == [b'12', b'345']
+
+
+def test_file_objects(tmp_path):
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    out = BytesIO()
+    marshal_file([b'12', b'345'], lst_type, out)
+    assert unmarshal_file(BytesIO(out.getvalue()), lst_type) == \
+        [b'12', b'345']
+
+
+@pytest.mark.parametrize('lazy,zero_copy', [
+    (False, False), (True, False), (False, True), (True, True),
+])
+def test_file_nonzero_position(tmp_path, lazy, zero_copy):
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    path = tmp_path / 'test.pae'
+    with open(path, 'wb') as f:
+        f.write(b'header')
+        written = marshal_file([b'12', b'345'], lst_type, f)
+    assert path.read_bytes() == b'header' + marshal([b'12', b'345'], lst_type)
+    with open(path, 'rb') as f:
+        assert f.read(6) == b'header'
+        decoded = unmarshal_file(f, lst_type, lazy=lazy, zero_copy=zero_copy)
+        assert f.tell() == 6 + written
+    if lazy:
+        decoded = decoded.materialise()
+    assert [bytes(x) for x in decoded] == [b'12', b'345']
+
+
+def test_file_nonzero_position_at_end(tmp_path):
+    path = tmp_path / 'test.pae'
+    path.write_bytes(b'header')
+    with open(path, 'rb') as f:
+        f.seek(6)
+        assert unmarshal_file(f, PAEBytes()) == b''
+
+
+def test_file_empty(tmp_path):
+    path = tmp_path / 'test.pae'
+    assert marshal_file(b'', PAEBytes(), path) == 0
+    assert path.read_bytes() == b''
+    assert unmarshal_file(path, PAEBytes()) == b''
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_file_pipe(lazy):
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)
+    encoded = marshal([b'abc', b'de'], lst_type)
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, 'wb') as f:
+        f.write(encoded)
+    with os.fdopen(read_fd, 'rb') as f:
+        assert list(unmarshal_file(f, lst_type, lazy=lazy)) == [b'abc', b'de']
+
+
+def test_file_decode_error(tmp_path):
+    path = tmp_path / 'test.pae'
+    path.write_bytes(b'\x01\x00\x00\x001')
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        unmarshal_file(path, lst_type)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 1000])
+@pytest.mark.parametrize('expected_out,types,inp', NESTED_HETEROGENEOUS_TESTS)
+def test_push_parser_nested(inp, types, expected_out, chunk_size):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    parser = PAEPushParser(lst_type)
+    events = []
+    for ix in range(0, len(inp), chunk_size):
+        assert not parser.done
+        events.extend(parser.feed(inp[ix:ix + chunk_size]))
+    assert parser.done
+    assert parser.close() == expected_out
+    assert events[0] == ListStart((), len(expected_out))
+    assert events[-1] == ListEnd(())
+    top_level_values = [
+        ev.value for ev in events
+        if isinstance(ev, ElementValue) and len(ev.path) == 1
+    ]
+    assert top_level_values == expected_out
+
+
+def test_push_parser_events():
+    lst_type = PAEHomogeneousList(
+        PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX),
+        settings=WITH_CONST_PREFIX
+    )
+    parser = PAEPushParser(lst_type)
+    events = parser.feed(b'\x02\x00\x07\x00\x01\x00\x03\x00a')
+    assert events == [
+        ListStart((), 2), ElementLength((0,), 7), ListStart((0,), 1),
+        ElementLength((0, 0), 3),
+    ]
+    events = parser.feed(b'bc\x02\x00\x00\x00')
+    assert events == [
+        ElementValue((0, 0), b'abc'), ListEnd((0,)),
+        ElementValue((0,), [b'abc']), ElementLength((1,), 2),
+        ListStart((1,), 0), ListEnd((1,)), ElementValue((1,), []),
+        ListEnd(()),
+    ]
+    assert parser.close() == [[b'abc'], []]
+
+
+def test_push_parser_non_list():
+    parser = PAEPushParser(PAEString())
+    assert parser.feed(b'ab') == []
+    assert parser.feed(b'c') == []
+    assert parser.close() == 'abc'
+
+
+def test_push_parser_max_field_length():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    parser = PAEPushParser(lst_type, max_field_length=10)
+    with pytest.raises(PAEDecodeError, match='exceeds maximum'):
+        parser.feed(b'\x01\x00\xff\x00')
+
+
+def test_push_parser_truncated():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    parser = PAEPushParser(lst_type)
+    parser.feed(b'\x01\x00\x03\x00ab')
+    with pytest.raises(PAEDecodeError, match='end of input'):
+        parser.close()
+
+
+def test_push_parser_trailing_data():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    parser = PAEPushParser(lst_type)
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        parser.feed(b'\x01\x00\x01\x00ab')
+    parser = PAEPushParser(lst_type)
+    parser.feed(b'\x01\x00\x01\x00a')
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        parser.feed(b'b')
+
+
+@pytest.mark.parametrize('inp,pae_type,match', [
+    (b'\x02\x00\x04\x00\x01\x00\x00\x00\x06\x00\x01\x00\x05\x00123',
+     PAEHeterogeneousList(
+         component_types=[
+             PAE_UINT,
+             PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+         ],
+         settings=WITH_CONST_PREFIX), 'next item'),
+    (b'\x02\x00\x04\x00\x01\x00\x00\x00\x06\x00\x01\x00\x01\x00'
+     b'12',
+     PAEHeterogeneousList(
+         component_types=[
+             PAE_UINT,
+             PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+         ],
+         settings=WITH_CONST_PREFIX), 'trailing data'),
+    (b'\x01\x00\x01\x00\x00\x00',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=NO_CONST_PREFIX), 'Wrong number of components'),
+])
+def test_push_parser_errors(inp, pae_type, match):
+    parser = PAEPushParser(pae_type)
+    with pytest.raises(PAEDecodeError, match=match):
+        for ix in range(len(inp)):
+            parser.feed(inp[ix:ix + 1])
+
+
+class _Loopback:
+    # reader and writer connected to each other through a socket pair
+
+    async def __aenter__(self):
+        sock_a, sock_b = socket.socketpair()
+        self._streams_a = await asyncio.open_connection(sock=sock_a)
+        self._streams_b = await asyncio.open_connection(sock=sock_b)
+        return self._streams_b[0], self._streams_a[1]
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for _, writer in (self._streams_a, self._streams_b):
+            writer.close()
+            await writer.wait_closed()
+
+
+def _reader_for(data: bytes) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_async_roundtrip(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+
+    async def run():
+        async with _Loopback() as (reader, writer):
+            written = await marshal_async(inp, lst_type, writer)
+            assert written == len(expected_out)
+            decoded = await unmarshal_async(reader, lst_type)
+            writer.write_eof()
+            # make sure there's nothing left
+            assert await reader.read() == b''
+            return decoded
+
+    assert asyncio.run(run()) == inp
+
+
+def test_async_large_payload_backpressure():
+    lst_type = PAEHomogeneousList(
+        PAEBytes(), settings=PAEListSettings(size_type=PAE_UINT)
+    )
+    value = [b'x' * 1000000, b'y' * 1000000, b'']
+
+    async def run():
+        async with _Loopback() as (reader, writer):
+            write_task = asyncio.ensure_future(
+                marshal_async(value, lst_type, writer)
+            )
+            decoded = await unmarshal_async(reader, lst_type)
+            await write_task
+            return decoded
+
+    assert asyncio.run(run()) == value
+
+
+def test_async_length_unknown():
+    lst_type = PAEHomogeneousList(OpaqueBytes(), settings=WITH_CONST_PREFIX)
+
+    async def run():
+        async with _Loopback() as (reader, writer):
+            await marshal_async([b'12', b'345'], lst_type, writer)
+            writer.write_eof()
+            return await reader.read()
+
+    assert asyncio.run(run()) == b'\x02\x00\x02\x0012\x03\x00345'
+
+
+def test_async_leaf():
+    async def run():
+        return (
+            await unmarshal_async(_reader_for(b'abc'), PAEString()),
+            await unmarshal_async(_reader_for(b'abcd'), PAEBytes(), length=2),
+        )
+
+    assert asyncio.run(run()) == ('abc', b'ab')
+
+
+def test_async_read_pae_flexible_schema():
+    async def run():
+        reader = _reader_for(b'\x02\x00\x01\x00\x01\x03\x00abc')
+        coro = read_pae_async(reader, WITH_CONST_PREFIX)
+        count = await coro.__anext__()
+        values = []
+        pae_type = PAE_UCHAR
+        for _ in range(count):
+            values.append(await coro.asend(pae_type))
+            # the first value tells us the type of the second
+            pae_type = PAEString() if values[0] == 1 else PAEBytes()
+        return values
+
+    assert asyncio.run(run()) == [1, 'abc']
+
+
+@pytest.mark.parametrize('inp,pae_type,match', [
+    (b'\x02\x00\x04\x00\x01\x00\x00\x00\x05\x00123',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=WITH_CONST_PREFIX), 'Expected 5 bytes'),
+    (b'\x02\x00\x01\x00\x00\x00\x05',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=NO_CONST_PREFIX), 'Failed to read length'),
+    (b'\x01\x00\x01\x00\x00\x00',
+     PAEHeterogeneousList(
+         component_types=[PAE_UINT, PAEBytes()],
+         settings=NO_CONST_PREFIX), 'Wrong number of components'),
+    (b'\x02\x00\x04\x00\x01\x00\x00\x00\x06\x00\x01\x00\x05\x00123',
+     PAEHeterogeneousList(
+         component_types=[
+             PAE_UINT,
+             PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+         ],
+         settings=WITH_CONST_PREFIX), 'next item'),
+    (b'\x02\x00\x04\x00\x01\x00\x00\x00\x06\x00\x01\x00\x01\x00'
+     b'12',
+     PAEHeterogeneousList(
+         component_types=[
+             PAE_UINT,
+             PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+         ],
+         settings=WITH_CONST_PREFIX), 'trailing data'),
+])
+def test_async_decode_errors(inp, pae_type, match):
+    async def run():
+        return await unmarshal_async(_reader_for(inp), pae_type)
+
+    with pytest.raises(PAEDecodeError, match=match):
+        asyncio.run(run())
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_marshal_buffers(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    buffers = marshal_buffers(inp, lst_type)
+    assert b''.join(buffers) == expected_out
+
+
+def test_marshal_buffers_by_reference():
+    big = bytearray(b'x' * 1000)
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    buffers = marshal_buffers([b'abc', big, b'de'], lst_type)
+    assert len(buffers) == 3
+    assert buffers[1] is big
+    assert b''.join(buffers) == marshal([b'abc', big, b'de'], lst_type)
+
+
+def _fake_partial_send(received: list, max_size: int):
+    def send(bufs):
+        data = b''.join(bytes(b) for b in bufs)[:max_size]
+        received.append(data)
+        return len(data)
+    return send
+
+
+def test_writev_all_partial(monkeypatch):
+    received = []
+    fake = _fake_partial_send(received, 3)
+    monkeypatch.setattr(os, 'writev', lambda fd, bufs: fake(bufs))
+    buffers = [b'abcd', b'', memoryview(b'efgh'), bytearray(b'ij')]
+    assert writev_all(-1, buffers) == 10
+    assert b''.join(received) == b'abcdefghij'
+
+
+def test_writev_all_pipe():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=PAEListSettings(
+        size_type=PAE_UINT
+    ))
+    value = [b'x' * 100000, b'y' * 10, b'z' * 100000]
+    read_fd, write_fd = os.pipe()
+    received = []
+
+    def consume():
+        with os.fdopen(read_fd, 'rb') as f:
+            received.append(f.read())
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    try:
+        written = writev_all(write_fd, marshal_buffers(value, lst_type))
+    finally:
+        os.close(write_fd)
+        thread.join()
+    assert received == [marshal(value, lst_type)]
+    assert written == len(received[0])
+
+
+def test_sendmsg_all():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    value = [b'x' * 1000, b'abc']
+    sock_a, sock_b = socket.socketpair()
+    with sock_a, sock_b:
+        sendmsg_all(sock_a, marshal_buffers(value, lst_type))
+        sock_a.shutdown(socket.SHUT_WR)
+        data = b''
+        while True:
+            chunk = sock_b.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    assert data == marshal(value, lst_type)
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_marshal_into(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    size = encoded_size(inp, lst_type)
+    assert size == len(expected_out)
+    buf = bytearray(b'\xff' * (size + 5))
+    assert marshal_into(inp, lst_type, buf, offset=2) == size
+    assert buf[2:size + 2] == expected_out
+    assert buf[:2] == b'\xff\xff'
+    assert buf[size + 2:] == b'\xff' * 3
+
+
+def test_marshal_into_length_unknown():
+    lst_type = PAEHomogeneousList(OpaqueBytes(), settings=WITH_CONST_PREFIX)
+    expected = b'\x02\x00\x02\x0012\x03\x00345'
+    assert encoded_size([b'12', b'345'], lst_type) == len(expected)
+    mm = mmap.mmap(-1, len(expected))
+    assert marshal_into([b'12', b'345'], lst_type, mm) == len(expected)
+    assert mm[:] == expected
+    with pytest.raises(ValueError, match='too small'):
+        marshal_into([b'12', b'3456'], lst_type, bytearray(len(expected)))
+
+
+def test_marshal_into_too_small():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    buf = bytearray(10)
+    with pytest.raises(ValueError, match='too small'):
+        marshal_into([b'12', b'345'], lst_type, buf, offset=1)
+    # nothing was written
+    assert buf == bytearray(10)
+
+
+def test_marshal_into_read_only():
+    with pytest.raises(TypeError):
+        marshal_into(b'', PAEBytes(), b'abc')
+
+
+@pytest.mark.parametrize('settings', [NO_CONST_PREFIX, WITH_CONST_PREFIX])
+def test_iter_unmarshal(settings):
+    lst_type = PAEHomogeneousList(PAE_UINT, settings=settings)
+    values = list(range(50))
+    encoded = marshal(values, lst_type)
+    result = iter_unmarshal(BytesIO(encoded), lst_type)
+    assert list(result) == values
+    result = iter_unmarshal(BytesIO(encoded + b'xyz'), lst_type, len(encoded))
+    assert list(result) == values
+
+
+def test_iter_unmarshal_incremental():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    stream = BytesIO(b'\x02\x00\x02\x0012\x03\x00345')
+    result = iter_unmarshal(stream, lst_type)
+    assert next(result) == b'12'
+    # the second element hasn't been read yet
+    assert stream.tell() == 6
+    assert next(result) == b'345'
+    with pytest.raises(StopIteration):
+        next(result)
+
+
+def test_iter_unmarshal_nested():
+    inner = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    lst_type = PAEHomogeneousList(inner, settings=NO_CONST_PREFIX)
+    values = [['a', 'bc'], [], ['def']]
+    encoded = marshal(values, lst_type)
+    assert list(iter_unmarshal(BytesIO(encoded), lst_type)) == values
+
+
+@pytest.mark.parametrize('inp,length', [
+    (b'\x02\x00\x02\x0012\x03\x00345z', None),
+    (b'\x02\x00\x02\x0012\x03\x00345z', 12),
+    (b'\x00\x00z', None),
+    (b'\x00\x00z', 3),
+])
+def test_iter_unmarshal_trailing_data(inp, length):
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError, match='trailing'):
+        list(iter_unmarshal(BytesIO(inp), lst_type, length))
+
+
+def test_iter_unmarshal_errors_after_valid_items():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    stream = BytesIO(b'\x03\x00\x02\x0012\x03\x00345')
+    result = iter_unmarshal(stream, lst_type)
+    assert next(result) == b'12'
+    assert next(result) == b'345'
+    with pytest.raises(PAEDecodeError):
+        next(result)
+
+
+def test_iter_unmarshal_too_long():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    result = iter_unmarshal(
+        BytesIO(b'\x02\x00\x02\x0012\x03\x00345'), lst_type, 10
+    )
+    assert next(result) == b'12'
+    with pytest.raises(PAEDecodeError, match='too long'):
+        next(result)
+
+
+@pytest.mark.parametrize('settings', [NO_CONST_PREFIX, WITH_CONST_PREFIX])
+@pytest.mark.parametrize('child_type', [PAE_UINT, PAEString(), OpaqueBytes()])
+def test_marshal_iter(settings, child_type):
+    lst_type = PAEHomogeneousList(child_type, settings=settings)
+    if child_type is PAE_UINT:
+        values = list(range(20))
+    elif isinstance(child_type, PAEString):
+        values = [str(x) * x for x in range(20)]
+    else:
+        values = [bytes(x) for x in range(20)]
+    expected = marshal(values, lst_type)
+
+    # seekable, count backpatched
+    out = BytesIO()
+    out.write(b'xyz')
+    assert marshal_iter(iter(values), lst_type, out) == len(expected)
+    assert out.getvalue() == b'xyz' + expected
+    # count specified
+    out = NonSeekableStream()
+    assert marshal_iter(
+        iter(values), lst_type, out, count=len(values)
+    ) == len(expected)
+    assert out.getvalue() == expected
+    # spooled, both in memory and on disk
+    for spool_size in (1, 1024):
+        out = NonSeekableStream()
+        written = marshal_iter(
+            iter(values), lst_type, out, spool_size=spool_size
+        )
+        assert written == len(expected)
+        assert out.getvalue() == expected
+
+
+def test_marshal_iter_empty():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    out = NonSeekableStream()
+    assert marshal_iter(iter(()), lst_type, out) == 2
+    assert out.getvalue() == b'\x00\x00'
+
+
+def test_marshal_iter_count_hint_no_buffering():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    out = NonSeekableStream()
+
+    def _items():
+        yield b'12'
+        # output for previous items must already be available
+        assert out.getvalue() == b'\x02\x00\x02\x0012'
+        yield b'345'
+
+    marshal_iter(_items(), lst_type, out, count=2)
+    assert out.getvalue() == b'\x02\x00\x02\x0012\x03\x00345'
+
+
+@pytest.mark.parametrize('count', [1, 3])
+def test_marshal_iter_count_mismatch(count):
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    with pytest.raises(ValueError, match='Expected'):
+        marshal_iter(iter([b'12', b'345']), lst_type, BytesIO(), count=count)
+
+
+def test_marshal_iter_roundtrip_nested():
+    inner = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    lst_type = PAEHomogeneousList(inner, settings=NO_CONST_PREFIX)
+    values = [['a', 'bc'], [], ['def']]
+    out = NonSeekableStream()
+    marshal_iter((v for v in values), lst_type, out)
+    assert list(iter_unmarshal(BytesIO(out.getvalue()), lst_type)) == values
+
+
+class NonSeekableReader:
+    def __init__(self, data: bytes):
+        self.read = BytesIO(data).read
+
+    def seekable(self):
+        return False
+
+
+@pytest.mark.parametrize('inp,types,encoded', NESTED_HETEROGENEOUS_TESTS)
+def test_validate_nested(inp, types, encoded):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    summary = validate(encoded, lst_type)
+    assert summary.total_size == len(encoded)
+    assert summary.element_counts[0] == len(inp)
+    assert validate(BytesIO(encoded), lst_type) == summary
+    assert validate(NonSeekableReader(encoded), lst_type) == summary
+
+
+def test_validate_element_counts():
+    inner = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    lst_type = PAEHeterogeneousList(
+        [inner, PAEHomogeneousList(inner, settings=NO_CONST_PREFIX),
+         PAE_UINT, PAEHomogeneousList(PAE_UCHAR, settings=NO_CONST_PREFIX)],
+        settings=WITH_CONST_PREFIX
+    )
+    value = [['a', 'b'], [['c'], [], ['d', 'e']], 5, [1, 2, 3]]
+    encoded = marshal(value, lst_type)
+    assert validate(encoded, lst_type) == PAEValidationSummary(
+        total_size=len(encoded), element_counts=(4, 8, 3)
+    )
+
+
+def test_validate_not_a_list():
+    assert validate(b'abc', PAEString()) == PAEValidationSummary(3, ())
+    assert validate(memoryview(b'\x01\x00'), PAE_USHORT).total_size == 2
+
+
+def test_validate_length():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    stream = BytesIO(b'\x02\x00\x02\x0012\x03\x00345xyz')
+    assert validate(stream, lst_type, length=11).total_size == 11
+    assert stream.tell() == 11
+    with pytest.raises(PAEDecodeError, match='available'):
+        validate(BytesIO(b'\x02\x00\x02\x0012\x03\x00345'), lst_type, 12)
+    with pytest.raises(ValueError, match='length must be specified'):
+        validate(NonSeekableReader(b'abc'), PAEBytes())
+
+
+@pytest.mark.parametrize('lst_type,inp', [
+    # trailing data
+    (PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX),
+     b'\x02\x00\x02\x0012\x03\x00345z'),
+    (PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX),
+     b'\x00\x00z'),
+    (PAEHomogeneousList(PAE_USHORT, settings=NO_CONST_PREFIX),
+     b'\x02\x00\x01\x00\x02\x00z'),
+    # truncated
+    (PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX),
+     b'\x02\x00\x02\x0012\x03\x0034'),
+    (PAEHomogeneousList(PAE_USHORT, settings=NO_CONST_PREFIX),
+     b'\x02\x00\x01\x00\x02'),
+    (PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX), b'\x02'),
+    # wrong component count
+    (PAEHeterogeneousList([PAEBytes()], settings=WITH_CONST_PREFIX),
+     b'\x02\x00\x02\x0012\x03\x00345'),
+    # invalid UTF-8
+    (PAEHomogeneousList(PAEString(), settings=WITH_CONST_PREFIX),
+     b'\x01\x00\x02\x00\xc3\x28'),
+])
+def test_validate_errors(lst_type, inp):
+    with pytest.raises(PAEDecodeError):
+        validate(inp, lst_type)
+    with pytest.raises(PAEDecodeError):
+        validate(NonSeekableReader(inp), lst_type)
+
+
+def test_validate_generic_type():
+    lst_type = PAEHomogeneousList(OpaqueBytes(), settings=WITH_CONST_PREFIX)
+    encoded = b'\x02\x00\x02\x0012\x03\x00345'
+    assert validate(encoded, lst_type).element_counts == (2,)
+
+
+def test_validate_deep_nesting():
+    pae_type = PAEString()
+    value = 'x'
+    depth = 5000
+    for _ in range(depth):
+        pae_type = PAEHeterogeneousList([pae_type], settings=NO_CONST_PREFIX)
+        value = [value]
+    encoded = marshal(value, pae_type)
+    summary = validate(encoded, pae_type)
+    assert summary.total_size == len(encoded)
+    assert summary.element_counts == (1,) * depth
+    summary = validate(NonSeekableReader(encoded), pae_type)
+    assert summary.total_size == len(encoded)
+    with pytest.raises(PAEDecodeError, match='UTF-8'):
+        validate(encoded[:-1] + b'\xff', pae_type)
+
+
+NESTED_LIST_TYPE = PAEHomogeneousList(
+    PAEHomogeneousList(PAEString(), settings=WITH_CONST_PREFIX),
+    settings=WITH_CONST_PREFIX
+)
+NESTED_LIST_VALUE = [['a', 'bc'], [], ['def', 'g', 'h']]
+
+
+@pytest.mark.parametrize('limits', [
+    PAEDecodeLimits(),
+    PAEDecodeLimits(max_elements=8),
+    PAEDecodeLimits(max_depth=2),
+    PAEDecodeLimits(max_field_length=13),
+    PAEDecodeLimits(max_total_bytes=8),
+    PAEDecodeLimits(
+        max_elements=8, max_depth=2, max_field_length=13, max_total_bytes=8
+    ),
+])
+def test_decode_limits_ok(limits):
+    encoded = marshal(NESTED_LIST_VALUE, NESTED_LIST_TYPE)
+    decoded = unmarshal(encoded, NESTED_LIST_TYPE, limits=limits)
+    assert decoded == NESTED_LIST_VALUE
+    with decode_limits(limits):
+        codec = compile_codec(NESTED_LIST_TYPE)
+        assert codec.decode(encoded) == NESTED_LIST_VALUE
+
+
+@pytest.mark.parametrize('limits,err', [
+    (PAEDecodeLimits(max_elements=7), 'element budget'),
+    (PAEDecodeLimits(max_depth=1), 'nested'),
+    (PAEDecodeLimits(max_field_length=12), 'exceeds maximum'),
+    (PAEDecodeLimits(max_total_bytes=7), 'budget of 7 bytes'),
+])
+def test_decode_limits_exceeded(limits, err):
+    encoded = marshal(NESTED_LIST_VALUE, NESTED_LIST_TYPE)
+    with pytest.raises(PAEDecodeError, match=err):
+        unmarshal(encoded, NESTED_LIST_TYPE, limits=limits)
+    with decode_limits(limits):
+        with pytest.raises(PAEDecodeError, match=err):
+            compile_codec(NESTED_LIST_TYPE).decode(encoded)
+        with pytest.raises(PAEDecodeError, match=err):
+            list(iter_unmarshal(BytesIO(encoded), NESTED_LIST_TYPE))
+    # no limits outside of the context manager
+    assert unmarshal(encoded, NESTED_LIST_TYPE) == NESTED_LIST_VALUE
+
+
+def test_decode_limits_shared_budget():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    encoded = marshal([b'abc', b'de'], lst_type)
+    with decode_limits(PAEDecodeLimits(max_elements=5, max_total_bytes=10)):
+        unmarshal(encoded, lst_type)
+        unmarshal(encoded, lst_type)
+        with pytest.raises(PAEDecodeError, match='budget'):
+            unmarshal(encoded, lst_type)
+
+
+@pytest.mark.parametrize('lst_type', [
+    PAEHomogeneousList(PAEBytes(), settings=PAEListSettings()),
+    PAEHomogeneousList(PAE_UINT, settings=PAEListSettings()),
+    PAEHomogeneousList(
+        PAE_UINT, settings=PAEListSettings(prefix_if_constant=False)
+    ),
+    PAEPackedArray(
+        PAE_UINT, settings=PAEListSettings(prefix_if_constant=False)
+    ),
+])
+def test_decode_limits_huge_count(lst_type):
+    # a hostile count must be rejected before anything is allocated
+    encoded = struct.pack('<Q', 2 ** 60) + b'\x00' * 16
+    with pytest.raises(PAEDecodeError):
+        unmarshal(encoded, lst_type, limits=PAEDecodeLimits(max_elements=10))
+    with pytest.raises(PAEDecodeError):
+        unmarshal(encoded, lst_type)
+
+
+def test_decode_limits_async():
+    encoded = marshal(NESTED_LIST_VALUE, NESTED_LIST_TYPE)
+
+    async def _decode(limits):
+        with decode_limits(limits):
+            return await unmarshal_async(
+                _reader_for(encoded), NESTED_LIST_TYPE
+            )
+
+    limits = PAEDecodeLimits(max_elements=8, max_depth=2, max_field_length=13)
+    assert asyncio.run(_decode(limits)) == NESTED_LIST_VALUE
+    for limits in [PAEDecodeLimits(max_elements=7),
+                   PAEDecodeLimits(max_depth=1),
+                   PAEDecodeLimits(max_field_length=12)]:
+        with pytest.raises(PAEDecodeError):
+            asyncio.run(_decode(limits))
+
+
+def _summarise_events(events):
+    return [
+        (e.operation, e.pae_type, e.path, e.nbytes, e.elements)
+        for e in events
+    ]
+
+
+@pytest.mark.parametrize('operation', [ENCODE, DECODE])
+def test_instrument_events(operation):
+    str_list = NESTED_LIST_TYPE.child_type
+    value = [['a', 'bc'], []]
+    encoded = marshal(value, NESTED_LIST_TYPE)
+    with collecting() as events:
+        if operation == ENCODE:
+            marshal(value, NESTED_LIST_TYPE)
+        else:
+            unmarshal(encoded, NESTED_LIST_TYPE)
+    string_t = str_list.child_type
+    # events are emitted after the values have been processed
+    assert _summarise_events(events) == [
+        (operation, string_t, (0, 0), 3, None),
+        (operation, string_t, (0, 1), 4, None),
+        (operation, str_list, (0,), 11, 2),
+        (operation, str_list, (1,), 4, 0),
+        (operation, NESTED_LIST_TYPE, (), len(encoded), 2),
+    ]
+    assert all(e.elapsed_ns >= 0 for e in events)
+
+
+@pytest.mark.parametrize('settings', [NO_CONST_PREFIX, WITH_CONST_PREFIX])
+def test_instrument_packed_lists(settings):
+    for lst_type in (PAEHomogeneousList(PAE_UINT, settings=settings),
+                     PAEPackedArray(PAE_UINT, settings=NO_CONST_PREFIX)):
+        with collecting() as events:
+            encoded = marshal([1, 2, 3], lst_type)
+            unmarshal(encoded, lst_type)
+        root_events = [e for e in events if e.path == ()]
+        assert [(e.operation, e.elements) for e in root_events] \
+            == [(ENCODE, 3), (DECODE, 3)]
+
+
+def test_instrument_counters():
+    counters = PAECounters()
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    with instrument(counters):
+        encoded = marshal([b'abc', b'de'], lst_type)
+        unmarshal(encoded, lst_type)
+        unmarshal(encoded, lst_type)
+    stats = counters.snapshot()
+    assert stats.keys() == {
+        (ENCODE, lst_type), (ENCODE, lst_type.child_type),
+        (DECODE, lst_type), (DECODE, lst_type.child_type)
+    }
+    bytes_stats = stats[DECODE, lst_type.child_type]
+    assert (bytes_stats.count, bytes_stats.nbytes) == (4, 18)
+    list_stats = stats[DECODE, lst_type]
+    assert (list_stats.count, list_stats.nbytes, list_stats.elements) \
+        == (2, 22, 4)
+    counters.reset()
+    assert counters.snapshot() == {}
+
+
+def test_instrument_nested_sinks():
+    callback_events = []
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    with instrument(callback_events.append):
+        with collecting() as events:
+            marshal([b'abc'], lst_type)
+        marshal([b'abc'], lst_type)
+    assert len(events) == 2
+    assert len(callback_events) == 4
+    # nothing is recorded outside the blocks
+    marshal([b'abc'], lst_type)
+    assert len(callback_events) == 4
+
+
+def test_instrument_error():
+    lst_type = PAEHomogeneousList(PAEString(), settings=WITH_CONST_PREFIX)
+    with collecting() as events:
+        with pytest.raises(PAEDecodeError):
+            unmarshal(b'\x02\x00\x01\x00a\x02\x00\xc3\x28', lst_type)
+        unmarshal(b'\x01\x00\x01\x00a', lst_type)
+    # only successfully decoded values are reported, and the path of the
+    # next value is not affected by the failure
+    assert _summarise_events(events) == [
+        (DECODE, lst_type.child_type, (0,), 3, None),
+        (DECODE, lst_type.child_type, (0,), 3, None),
+        (DECODE, lst_type, (), 5, 1),
+    ]
+
+
+class BarrierBytes(PAEBytes):
+    def __init__(self, barrier: threading.Barrier):
+        self.barrier = barrier
+
+    def write(self, value: bytes, stream: IO) -> int:
+        # make sure that all threads are in the middle of an encode
+        self.barrier.wait(timeout=10)
+        return super().write(value, stream)
+
+
+def test_instrument_threads():
+    thread_count = 4
+    leaf_type = BarrierBytes(threading.Barrier(thread_count))
+    lst_type = PAEHomogeneousList(PAEHomogeneousList(leaf_type))
+    values = [[[b'a' * ix] * 2] * 2 for ix in range(thread_count)]
+
+    async def _encode_all():
+        return await asyncio.gather(*(
+            asyncio.to_thread(marshal, value, lst_type) for value in values
+        ))
+
+    with collecting() as events:
+        encoded = asyncio.run(_encode_all())
+    plain_type = PAEHomogeneousList(PAEHomogeneousList(PAEBytes()))
+    assert encoded == [marshal(value, plain_type) for value in values]
+    leaf_paths = sorted(e.path for e in events if e.pae_type is leaf_type)
+    assert leaf_paths == sorted(
+        [(0, 0), (0, 1), (1, 0), (1, 1)] * thread_count
+    )
+    root_events = [e for e in events if e.path == ()]
+    assert sorted(e.nbytes for e in root_events) == sorted(map(len, encoded))
+
+
+def test_instrument_codec():
+    codec = compile_codec(NESTED_LIST_TYPE)
+    value = [['a', 'bc'], []]
+    with collecting() as events:
+        encoded = codec.encode(value)
+        assert codec.decode(encoded) == value
+    assert [e.operation for e in events if e.path == ()] == [ENCODE, DECODE]
+
+
+@pytest.mark.parametrize('inp,types,expected_out', NESTED_HETEROGENEOUS_TESTS)
+def test_pre_encoded(inp, types, expected_out):
+    lst_type = PAEHeterogeneousList(
+        component_types=types, settings=WITH_CONST_PREFIX
+    )
+    # replace every component by its encoding
+    pre_encoded = [
+        PAEPreEncoded(marshal(item, item_type), item_type, validate=True)
+        for item, item_type in zip(inp, types)
+    ]
+    assert marshal(pre_encoded, lst_type) == expected_out
+    assert lst_type.encoded_length(pre_encoded) == len(expected_out)
+    assert compile_codec(lst_type).encode(pre_encoded) == expected_out
+    out = NonSeekableStream()
+    lst_type.write(pre_encoded, out)
+    assert out.getvalue() == expected_out
+    for item, pre in zip(inp, pre_encoded):
+        assert _to_bytes_deep(pre.decode()) == item
+
+
+def test_pre_encoded_nested():
+    inner = NESTED_LIST_TYPE.child_type
+    pre = PAEPreEncoded(
+        memoryview(marshal(['a', 'bc'], inner)), inner, validate=True
+    )
+    value = [pre, [], ['def', 'g', 'h']]
+    expected = marshal([['a', 'bc'], [], ['def', 'g', 'h']], NESTED_LIST_TYPE)
+    assert marshal(value, NESTED_LIST_TYPE) == expected
+    assert compile_codec(NESTED_LIST_TYPE).encode(value) == expected
+    assert marshal(pre, inner) == bytes(pre.encoded)
+    assert len(pre) == 9
+    assert 'PAEPreEncoded 9 bytes' in repr(pre)
+
+    async def _run():
+        async with _Loopback() as (reader, writer):
+            await marshal_async(value, NESTED_LIST_TYPE, writer)
+            writer.write_eof()
+            return await reader.read()
+
+    assert asyncio.run(_run()) == expected
+
+
+def test_pre_encoded_non_byte_buffer():
+    encoded = array.array('H', [0x0201, 0x0403])
+    pre = PAEPreEncoded(encoded, PAEBytes())
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=WITH_CONST_PREFIX)
+    assert len(pre) == 4
+    assert marshal([pre], lst_type) == marshal([encoded.tobytes()], lst_type)
+
+
+def test_pre_encoded_validation_failure():
+    lst_type = PAEHomogeneousList(PAEString(), settings=WITH_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError):
+        PAEPreEncoded(b'\x01\x00\x02\x00\xc3\x28', lst_type, validate=True)
+    # not validated by default
+    PAEPreEncoded(b'\x01\x00\x02\x00\xc3\x28', lst_type)
+
+
+def test_pre_encoded_fixed_width():
+    lst_type = PAEHeterogeneousList(
+        [PAE_UINT, PAEBytes()], settings=NO_CONST_PREFIX
+    )
+    value = [PAEPreEncoded(b'\x01\x00\x00\x00', PAE_UINT), b'xyz']
+    expected = marshal([1, b'xyz'], lst_type)
+    assert marshal(value, lst_type) == expected
+    assert compile_codec(lst_type).encode(value) == expected
+    with pytest.raises(ValueError, match='fixed-width'):
+        marshal([PAEPreEncoded(b'\x01', PAE_UINT), b'xyz'], lst_type)
+
+
+def test_pre_encoded_type_mismatch():
+    lst_type = PAEHeterogeneousList(
+        [PAEString(), PAEBytes()], settings=WITH_CONST_PREFIX
+    )
+    value = [PAEPreEncoded(b'xyz', PAEBytes()), b'xyz']
+    with pytest.raises(ValueError, match='cannot be used for type'):
+        marshal(value, lst_type)
+    with pytest.raises(ValueError, match='cannot be used for type'):
+        compile_codec(lst_type).encode(value)
+    with pytest.raises(ValueError, match='cannot be used for type'):
+        marshal(PAEPreEncoded(b'xyz', PAEBytes()), PAEString())
+    # structurally equal types are interchangeable
+    value = [PAEPreEncoded(b'xyz', PAEString()), b'xyz']
+    assert marshal(value, lst_type) == marshal(['xyz', b'xyz'], lst_type)
+
+
+def test_pre_encoded_component_type_sequences():
+    pairs = [('xyz', PAEString()), (1, PAE_UINT)]
+    lst_type = PAEHeterogeneousList([PAEString(), PAE_UINT])
+    pre = PAEPreEncoded(marshal(['xyz', 1], lst_type), lst_type)
+    tuple_type = PAEHeterogeneousList((PAEString(), PAE_UINT))
+    assert marshal(pre, tuple_type) == pae_encode_multiple(pairs)
+
+
+class SlottedBytes(PAEBytes):
+    __slots__ = ('label',)
+
+    def __init__(self, label):
+        self.label = label
+
+
+def test_pre_encoded_slotted_type():
+    pre = PAEPreEncoded(b'xyz', SlottedBytes('a'))
+    assert marshal(pre, pre.inner_type) == b'xyz'
+    with pytest.raises(ValueError, match='cannot be used for type'):
+        marshal(pre, SlottedBytes('a'))
+
+
+def test_pre_encoded_top_level(tmp_path):
+    lst_type = PAEHomogeneousList(PAEString(), settings=WITH_CONST_PREFIX)
+    expected = marshal(['ab', 'c'], lst_type)
+    pre = PAEPreEncoded(expected, lst_type)
+    assert encoded_size(pre, lst_type) == len(expected)
+    assert b''.join(marshal_buffers(pre, lst_type)) == expected
+    buf = bytearray(len(expected) + 1)
+    assert marshal_into(pre, lst_type, buf, offset=1) == len(expected)
+    assert bytes(buf[1:]) == expected
+    h = hashlib.sha256()
+    assert marshal_to_digest(pre, lst_type, h) == len(expected)
+    assert h.digest() == hashlib.sha256(expected).digest()
+    path = tmp_path / 'test.pae'
+    assert marshal_file(pre, lst_type, path) == len(expected)
+    assert path.read_bytes() == expected
+    with pytest.raises(ValueError, match='cannot be used for type'):
+        encoded_size(pre, PAEBytes())
+
+
+def test_pre_encoded_prefixed_numbers_codec():
+    lst_type = PAEHomogeneousList(PAE_UINT, settings=WITH_CONST_PREFIX)
+    value = [1, PAEPreEncoded(b'\x02\x00\x00\x00', PAE_UINT)]
+    codec = compile_codec(lst_type)
+    assert codec.encode(value) == marshal([1, 2], lst_type)
+    # other errors are not masked by the fallback
+    with pytest.raises(struct.error):
+        codec.encode([1, 'x'])
+
+
+RECORD_TYPE = PAEHeterogeneousList([
+    PAEString(), PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX),
+    PAE_UINT, PAEBytes(),
+], settings=WITH_CONST_PREFIX)
+
+
+def test_encoding_cache():
+    lst_type = PAEHomogeneousList(RECORD_TYPE, settings=NO_CONST_PREFIX)
+    value = [
+        ['issuer', ('aud1', 'aud2'), ix, b'payload%d' % ix] for ix in range(5)
+    ]
+    expected = marshal(value, lst_type)
+    cache = PAEEncodingCache()
+    with encoding_cache(cache):
+        assert marshal(value, lst_type) == expected
+        assert marshal(value, lst_type) == expected
+    # the issuer and the audience tuple are cached, the tuple's elements
+    # only need to be encoded once
+    assert cache.stats == PAECacheStats(
+        hits=18, misses=4, evictions=0, entries=4,
+        size=len('issuer') + len('aud1') + len('aud2') + 14
+    )
+    cache.clear()
+    assert cache.stats == PAECacheStats(0, 0, 0, 0, 0)
+    # nothing is cached outside of the context manager
+    marshal(value, lst_type)
+    assert cache.stats.misses == 0
+
+
+def test_encoding_cache_policy_order():
+    string_t = PAEString()
+    for policy, survivor in ((LRU, 'a'), (FIFO, 'b')):
+        cache = PAEEncodingCache(max_entries=2, policy=policy)
+        cache.lookup('a', string_t)
+        cache.lookup('b', string_t)
+        cache.lookup('a', string_t)
+        cache.lookup('c', string_t)
+        hits = cache.stats.hits
+        cache.lookup(survivor, string_t)
+        assert cache.stats.hits == hits + 1
+
+
+def test_encoding_cache_max_size():
+    cache = PAEEncodingCache(max_size=5)
+    string_t = PAEString()
+    cache.lookup('abc', string_t)
+    cache.lookup('de', string_t)
+    assert cache.stats.entries == 2
+    cache.lookup('f', string_t)
+    assert cache.stats == PAECacheStats(
+        hits=0, misses=3, evictions=1, entries=2, size=3
+    )
+    # too large to be cached at all
+    assert type(cache.lookup('ghijkl', string_t)) is PAEPreEncoded
+    assert cache.stats.entries == 2
+
+
+def test_encoding_cache_uncacheable():
+    cache = PAEEncodingCache()
+    lst_type = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    for value, pae_type in [(b'abc', PAEBytes()), (5, PAE_UINT),
+                            (['a'], lst_type), (('a', ['b']), RECORD_TYPE)]:
+        assert cache.lookup(value, pae_type) is value
+    assert cache.stats == PAECacheStats(0, 0, 0, 0, 0)
+
+
+def test_encoding_cache_type_in_key():
+    class Label(str):
+        pass
+
+    cache = PAEEncodingCache()
+    string_t = PAEString()
+    cache.lookup('abc', string_t)
+    assert cache.lookup(Label('abc'), string_t) == Label('abc')
+    assert cache.stats.hits == 0
+
+
+def test_encoding_cache_element_types_in_key():
+    pair_type = PAEHeterogeneousList(
+        [PAE_UINT, PAEString()], settings=WITH_CONST_PREFIX
+    )
+    lst_type = PAEHomogeneousList(pair_type, settings=NO_CONST_PREFIX)
+    cache = PAEEncodingCache()
+    with encoding_cache(cache):
+        assert marshal([(1, 'a')], lst_type) == marshal([[1, 'a']], lst_type)
+        with pytest.raises(struct.error):
+            marshal([(1.0, 'a')], lst_type)
+        with pytest.raises(struct.error):
+            marshal([((1,), 'a')], lst_type)
+
+
+def test_encoding_cache_bad_policy():
+    with pytest.raises(ValueError, match='policy'):
+        PAEEncodingCache(policy='random')
+
+
+def test_encoding_cache_threads():
+    lst_type = PAEHomogeneousList(RECORD_TYPE, settings=NO_CONST_PREFIX)
+    values = [
+        [['iss%d' % (ix % 7), ('a', 'b%d' % (ix % 3)), ix, b'x']
+         for ix in range(50)]
+        for _ in range(8)
+    ]
+    expected = [marshal(v, lst_type) for v in values]
+    cache = PAEEncodingCache(max_entries=8)
+    results = [None] * len(values)
+
+    def _work(ix):
+        with encoding_cache(cache):
+            for _ in range(20):
+                results[ix] = marshal(values[ix], lst_type)
+
+    threads = [
+        threading.Thread(target=_work, args=(ix,)) for ix in range(len(values))
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == expected
+    stats = cache.stats
+    assert stats.entries <= 8
+    assert stats.hits + stats.misses > 0
+
+
+PAE_FAST_PATH_INPUTS = [
+    [], [b''], [b'12', b'345'], [bytearray(b'abc'), b'', b'\xff' * 300],
+    [memoryview(b'view'), b'xyz'],
+]
+PAE_FAST_PATH_SIZE_TYPES = [PAE_UCHAR, PAE_USHORT, PAE_UINT, PAE_ULLONG]
+
+
+@pytest.mark.parametrize('size_t', PAE_FAST_PATH_SIZE_TYPES)
+@pytest.mark.parametrize('inp', PAE_FAST_PATH_INPUTS)
+def test_pae_encode_fast_path_identical(inp, size_t):
+    lst_type = PAEHomogeneousList(
+        PAEBytes(), settings=PAEListSettings(size_type=size_t)
+    )
+    if size_t is PAE_UCHAR and any(len(x) > 255 for x in inp):
+        with pytest.raises(struct.error):
+            pae_encode(inp, size_t)
+        return
+    expected = marshal(inp, lst_type)
+    assert pae_encode(inp, size_t) == expected
+    assert pae_encode_batch([inp, inp], size_t) == [expected, expected]
+    assert pae_decode(expected, size_t) == [bytes(x) for x in inp]
+
+
+def test_pae_encode_fast_path_instrumented():
+    with collecting() as events:
+        encoded = pae_encode([b'12', b'345'], size_t=PAE_USHORT)
+    assert encoded == b'\x02\x00\x02\x0012\x03\x00345'
+    assert [(e.path, e.nbytes) for e in events] == [
+        ((0,), 4), ((1,), 5), ((), 11)
+    ]
+    with collecting() as events:
+        assert pae_decode(encoded, PAE_USHORT) == [b'12', b'345']
+    assert len(events) == 3
+
+
+def test_pae_encode_batch_empty():
+    assert pae_encode_batch([]) == []
+
+
+def test_pae_decode_buffer_input():
+    encoded = pae_encode([b'12', b'345'])
+    assert pae_decode(bytearray(encoded)) == [b'12', b'345']
+    assert pae_decode(memoryview(encoded)) == [b'12', b'345']
+
+
+@pytest.mark.parametrize('inp', [
+    b'', b'\x01', b'\x01\x00', b'\x01\x00\x05\x00abc',
+    b'\x02\x00\x01\x00a', b'\x01\x00\x01\x00ab', b'\xff\xff\x00\x00',
+    b'\x00\x00z',
+])
+def test_pae_decode_errors(inp):
+    with pytest.raises(PAEDecodeError):
+        pae_decode(inp, PAE_USHORT)
+
+
+def test_pae_decode_limits():
+    encoded = pae_encode([b'12', b'345'])
+    with decode_limits(PAEDecodeLimits(max_elements=1)):
+        with pytest.raises(PAEDecodeError, match='element'):
+            pae_decode(encoded)
+
+
+BATCH_LIST_TYPE = PAEHomogeneousList(RECORD_TYPE, settings=NO_CONST_PREFIX)
+
+
+def _batch_values(count):
+    return [
+        [['iss%d' % ix, ('a', 'b'), ix, b'x' * (ix % 5)]] * (ix % 3)
+        for ix in range(count)
+    ]
+
+
+@pytest.mark.parametrize('pae_type', [
+    PAE_UCHAR, PAEBytes(), PAEString(), NESTED_LIST_TYPE, BATCH_LIST_TYPE,
+    PAEPackedArray(PAE_UINT), PAEHeterogeneousList(
+        [PAE_ULLONG, PAEString()], settings=WITH_CONST_PREFIX
+    ),
+])
+def test_pae_types_picklable(pae_type):
+    copied = pickle.loads(pickle.dumps(pae_type))
+    assert type(copied) is type(pae_type)
+    assert copied.constant_length == pae_type.constant_length
+
+
+def test_number_type_pickle_roundtrip():
+    copied = pickle.loads(pickle.dumps(PAE_USHORT))
+    assert copied.value == PAE_USHORT.value
+    assert copied.pack(0x1234) == b'\x34\x12'
+
+
+class TaggedNumberType(PAENumberType):
+
+    def __init__(self, value, tag=None):
+        super().__init__(value)
+        self.tag = tag
+
+
+def test_number_type_subclass_pickle_roundtrip():
+    num_type = TaggedNumberType(1, tag='x')
+    copied = pickle.loads(pickle.dumps(num_type))
+    assert type(copied) is TaggedNumberType
+    assert copied.tag == 'x'
+    assert copied.pack(0x1234) == b'\x34\x12'
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1000])
+def test_marshal_many_sequential(chunk_size):
+    values = _batch_values(30)
+    results = marshal_many(values, BATCH_LIST_TYPE, chunk_size=chunk_size)
+    assert [r.unwrap() for r in results] == [
+        marshal(v, BATCH_LIST_TYPE) for v in values
+    ]
+    decoded = unmarshal_many(
+        [r.value for r in results], BATCH_LIST_TYPE, chunk_size=chunk_size
+    )
+    assert all(r.ok for r in decoded)
+    assert [r.value for r in decoded] == [
+        [[x[0], list(x[1]), x[2], x[3]] for x in v] for v in values
+    ]
+
+
+def test_batch_empty():
+    assert marshal_many([], PAEBytes()) == []
+    assert unmarshal_many([], PAEBytes()) == []
+
+
+def test_batch_bad_chunk_size():
+    with pytest.raises(ValueError, match='chunk_size'):
+        marshal_many([b'a'], PAEBytes(), chunk_size=0)
+
+
+def test_marshal_many_errors_per_item():
+    results = marshal_many([1, 256, 2], PAE_UCHAR, chunk_size=2)
+    assert [r.ok for r in results] == [True, False, True]
+    assert results[0].value == b'\x01'
+    assert isinstance(results[1].error, struct.error)
+    with pytest.raises(struct.error):
+        results[1].unwrap()
+
+
+def test_unmarshal_many_errors_per_item():
+    lst_type = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    blobs = [
+        marshal(['a'], lst_type), b'\x01\x00', marshal(['b', 'c'], lst_type)
+    ]
+    results = unmarshal_many(blobs, lst_type)
+    assert [r.value for r in results] == [['a'], None, ['b', 'c']]
+    assert isinstance(results[1].error, PAEDecodeError)
+
+
+def test_unmarshal_many_limits():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)
+    blobs = [marshal([b'a'] * n, lst_type) for n in (1, 5, 2)]
+    results = unmarshal_many(
+        blobs, lst_type, limits=PAEDecodeLimits(max_elements=2)
+    )
+    assert [r.ok for r in results] == [True, False, True]
+    assert 'element' in str(results[1].error)
+
+
+def test_batch_thread_pool():
+    values = _batch_values(100)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = marshal_many(
+            values, BATCH_LIST_TYPE, executor=executor, chunk_size=8
+        )
+        blobs = [r.unwrap() for r in results] + [b'\xff']
+        decoded = unmarshal_many(
+            blobs, BATCH_LIST_TYPE, executor=executor, chunk_size=8
+        )
+    assert blobs[:-1] == [marshal(v, BATCH_LIST_TYPE) for v in values]
+    assert [r.ok for r in decoded] == [True] * len(values) + [False]
+
+
+def test_batch_process_pool():
+    values = _batch_values(40)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = marshal_many(
+            values, BATCH_LIST_TYPE, executor=executor, chunk_size=16
+        )
+        blobs = [r.unwrap() for r in results] + [b'\x01\x00']
+        decoded = unmarshal_many(
+            blobs, BATCH_LIST_TYPE, executor=executor, chunk_size=16
+        )
+    assert blobs[:-1] == [marshal(v, BATCH_LIST_TYPE) for v in values]
+    assert [r.value for r in decoded[:-1]] == [
+        unmarshal(b, BATCH_LIST_TYPE) for b in blobs[:-1]
+    ]
+    assert isinstance(decoded[-1].error, PAEDecodeError)
+
+
+PARALLEL_LIST_TYPE = PAEHomogeneousList(
+    PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX),
+    settings=NO_CONST_PREFIX
+)
+PARALLEL_LIST_VALUE = [['a%d' % ix, 'b' * (ix % 4)] for ix in range(100)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 1000])
+def test_unmarshal_parallel_sequential(chunk_size):
+    encoded = marshal(PARALLEL_LIST_VALUE, PARALLEL_LIST_TYPE)
+    result = unmarshal_parallel(
+        encoded, PARALLEL_LIST_TYPE, chunk_size=chunk_size
+    )
+    assert result == PARALLEL_LIST_VALUE
+
+
+def test_unmarshal_parallel_thread_pool():
+    encoded = marshal(PARALLEL_LIST_VALUE, PARALLEL_LIST_TYPE)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        result = unmarshal_parallel(
+            bytearray(encoded), PARALLEL_LIST_TYPE, executor=executor,
+            chunk_size=9
+        )
+    assert result == PARALLEL_LIST_VALUE
+
+
+@pytest.mark.parametrize('use_shared_memory', [True, False])
+def test_unmarshal_parallel_process_pool(monkeypatch, use_shared_memory):
+    if not use_shared_memory:
+        monkeypatch.setattr(python_pae.batch, 'shared_memory', None)
+    encoded = marshal(PARALLEL_LIST_VALUE, PARALLEL_LIST_TYPE)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        result = unmarshal_parallel(
+            encoded, PARALLEL_LIST_TYPE, executor=executor, chunk_size=30
+        )
+    assert result == PARALLEL_LIST_VALUE
+
+
+def test_unmarshal_parallel_empty():
+    encoded = marshal([], PARALLEL_LIST_TYPE)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert unmarshal_parallel(
+            encoded, PARALLEL_LIST_TYPE, executor=executor
+        ) == []
+
+
+def test_unmarshal_parallel_packed_numbers():
+    lst_type = PAEHomogeneousList(PAE_USHORT, settings=NO_CONST_PREFIX)
+    encoded = marshal(list(range(50)), lst_type)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert unmarshal_parallel(
+            encoded, lst_type, executor=executor, chunk_size=8
+        ) == list(range(50))
+
+
+def test_unmarshal_parallel_element_error():
+    lst_type = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    encoded = marshal(['ok', 'fine', 'x'], lst_type)
+    # make the last element invalid UTF-8
+    encoded = encoded[:-1] + b'\xff'
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(PAEDecodeError):
+            unmarshal_parallel(
+                encoded, lst_type, executor=executor, chunk_size=1
+            )
+
+
+class RecordingProcessPool(ProcessPoolExecutor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.futures = []
+
+    def submit(self, *args, **kwargs):
+        future = super().submit(*args, **kwargs)
+        self.futures.append(future)
+        return future
+
+
+def test_unmarshal_parallel_error_stops_workers():
+    lst_type = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    # the first element is invalid UTF-8
+    encoded = marshal(['\xff'] + ['ok'] * 50, lst_type)
+    encoded = encoded.replace('\xff'.encode('utf8'), b'\xff\xff')
+    with RecordingProcessPool(max_workers=1) as executor:
+        with pytest.raises(PAEDecodeError):
+            unmarshal_parallel(
+                encoded, lst_type, executor=executor, chunk_size=1
+            )
+        # nothing is left running against the discarded shared memory
+        futures = executor.futures
+        assert len(futures) == 51
+        assert all(future.done() for future in futures)
+        for future in futures[1:]:
+            assert future.cancelled() or future.exception() is None
+
+
+@pytest.mark.parametrize('inp', [
+    b'\x01', b'\x01\x00\x05\x00abc', b'\x00\x00z'
+])
+def test_unmarshal_parallel_structure_error(inp):
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError):
+        unmarshal_parallel(inp, lst_type)
+
+
+def test_unmarshal_parallel_wrong_type():
+    with pytest.raises(TypeError, match='homogeneous'):
+        unmarshal_parallel(b'\x00\x00', PAEHeterogeneousList([]))
+    with pytest.raises(ValueError, match='chunk_size'):
+        unmarshal_parallel(b'\x00\x00', PARALLEL_LIST_TYPE, chunk_size=0)
+
+
+def test_unmarshal_parallel_limits_fallback():
+    encoded = marshal(PARALLEL_LIST_VALUE, PARALLEL_LIST_TYPE)
+    with decode_limits(PAEDecodeLimits(max_elements=10)):
+        with pytest.raises(PAEDecodeError, match='element'):
+            unmarshal_parallel(encoded, PARALLEL_LIST_TYPE)
+
+
+def _deep_list(depth):
+    pae_type = PAEString()
+    value = 'leaf'
+    for ix in range(depth):
+        if ix % 2:
+            pae_type = PAEHomogeneousList(pae_type, settings=NO_CONST_PREFIX)
+            value = [value, value]
+        else:
+            pae_type = PAEHeterogeneousList(
+                [pae_type, PAE_UCHAR], settings=WITH_CONST_PREFIX
+            )
+            value = [value, ix % 256]
+    return value, pae_type
+
+
+def test_marshal_async_measures_once(monkeypatch):
+    value, pae_type = _deep_list(16)
+    expected = marshal(value, pae_type)
+    calls = []
+    measure = python_pae.pae_types._measure_tree
+
+    def _counting_measure(*args):
+        calls.append(args)
+        return measure(*args)
+
+    for module in (python_pae.pae_types, python_pae.aio):
+        monkeypatch.setattr(module, '_measure_tree', _counting_measure)
+
+    async def _run():
+        async with _Loopback() as (reader, writer):
+            await marshal_async(value, pae_type, writer)
+            writer.write_eof()
+            return await reader.read()
+
+    assert asyncio.run(_run()) == expected
+    assert len(calls) == 1
+
+
+def test_marshal_async_fresh_sublists():
+    lazy_value, pae_type, encoded = _fresh_sublists()
+
+    async def _run():
+        async with _Loopback() as (reader, writer):
+            written = await marshal_async(lazy_value, pae_type, writer)
+            writer.write_eof()
+            return written, await reader.read()
+
+    assert asyncio.run(_run()) == (len(encoded), encoded)
+
+
+def test_deep_nesting_beyond_recursion_limit():
+    pae_type = PAEBytes()
+    value = b'x'
+    depth = 5000
+    for _ in range(depth):
+        pae_type = PAEHomogeneousList(pae_type, settings=NO_CONST_PREFIX)
+        value = [value]
+    encoded = marshal(value, pae_type)
+    assert len(encoded) == 4 * depth + 1
+    assert pae_type.encoded_length(value) == len(encoded)
+    decoded = unmarshal(encoded, pae_type)
+    # comparing the lists directly would recurse
+    assert marshal(decoded, pae_type) == encoded
+    with pytest.raises(PAEDecodeError, match='100 levels'):
+        unmarshal(encoded, pae_type, limits=PAEDecodeLimits(max_depth=100))
+
+
+ENGINE_TEST_CASES = [
+    _deep_list(10),
+    (NESTED_LIST_VALUE, NESTED_LIST_TYPE),
+    ([['iss', ('a', 'b'), 3, b'x']] * 3,
+     PAEHomogeneousList(RECORD_TYPE, settings=NO_CONST_PREFIX)),
+    ([[b'12', b'345'], []], PAEHomogeneousList(
+        PAEHomogeneousList(OpaqueBytes(), settings=WITH_CONST_PREFIX),
+        settings=WITH_CONST_PREFIX
+    )),
+    ([[1, 2], PAEPreEncoded(b'\x01\x00\x07\x00', PAEHomogeneousList(
+        PAE_USHORT, settings=NO_CONST_PREFIX
+    ))], PAEHomogeneousList(PAEHomogeneousList(
+        PAE_USHORT, settings=NO_CONST_PREFIX
+    ), settings=NO_CONST_PREFIX)),
+]
+
+
+@pytest.mark.parametrize('stream_type', [BytesIO, NonSeekableStream])
+@pytest.mark.parametrize('value,pae_type', ENGINE_TEST_CASES)
+def test_engine_matches_recursive(value, pae_type, stream_type):
+    # instrumentation forces the recursive implementation
+    with collecting():
+        expected = marshal(value, pae_type)
+        expected_decoded = unmarshal(expected, pae_type)
+    out = stream_type()
+    assert pae_type.write(value, out) == len(expected)
+    assert out.getvalue() == expected
+    assert pae_type.encoded_length(value) in (len(expected), None)
+    assert unmarshal(expected, pae_type) == expected_decoded
+
+
+def test_engine_shared_sublists():
+    value, pae_type = _deep_list(20)
+    encoded = marshal(value, pae_type)
+    assert pae_type.encoded_length(value) == len(encoded)
+    assert marshal(unmarshal(encoded, pae_type), pae_type) == encoded
+
+
+def _fresh_sublists():
+    pae_type = PAEHomogeneousList(PAEHomogeneousList(PAEBytes()))
+    value = [[b'x' * ix] * ix for ix in range(1, 8)]
+    encoded = marshal(value, pae_type)
+    # the lazy view decodes its elements again on every access
+    return unmarshal_lazy(encoded, pae_type, memoize=False), pae_type, encoded
+
+
+def test_engine_fresh_sublists():
+    lazy_value, pae_type, encoded = _fresh_sublists()
+    assert pae_type.encoded_length(lazy_value) == len(encoded)
+    assert marshal(lazy_value, pae_type) == encoded
+    out = NonSeekableStream()
+    assert pae_type.write(lazy_value, out) == len(encoded)
+    assert out.getvalue() == encoded
+
+
+def test_engine_nested_component_count_error():
+    lst_type = PAEHomogeneousList(
+        PAEHeterogeneousList([PAEString(), PAE_UCHAR])
+    )
+    with pytest.raises(ValueError, match='Wrong number of components'):
+        marshal([['a', 1], ['b']], lst_type)
+
+
+@pytest.mark.parametrize('inp', [
+    b'\x01\x00\x05\x00\x00\x00\x01\x00',
+    b'\x01\x00\x06\x00\x01\x00\x01\x00ab',
+    b'\x01\x00\x07\x00\x01\x00\x02\x00ab',
+    b'\x01\x00\x02\x00\x00\x00\x00',
+])
+def test_engine_nested_decode_errors(inp):
+    with pytest.raises(PAEDecodeError):
+        unmarshal(inp, NESTED_LIST_TYPE)
+
+
+def test_engine_budget_depth_restored_after_error():
+    limits = PAEDecodeLimits(max_depth=2)
+    encoded = marshal(NESTED_LIST_VALUE, NESTED_LIST_TYPE)
+    with decode_limits(limits):
+        with pytest.raises(PAEDecodeError):
+            unmarshal(encoded[:-1], NESTED_LIST_TYPE)
+        assert unmarshal(encoded, NESTED_LIST_TYPE) == NESTED_LIST_VALUE
+
+
+def test_engine_with_cache():
+    value, pae_type = _deep_list(6)
+    lst_type = PAEHomogeneousList(pae_type, settings=NO_CONST_PREFIX)
+    expected = marshal([value] * 3, lst_type)
+    cache = PAEEncodingCache()
+    with encoding_cache(cache):
+        assert marshal([value] * 3, lst_type) == expected
+
+
+def test_list_reader():
+    encoded = b'\x03\x00\x01\x00\x01\x03\x00abc\x02\x00xy'
+    reader = PAEListReader(BytesIO(encoded), WITH_CONST_PREFIX, len(encoded))
+    assert reader.count == 3
+    assert reader.peek_length() == 1
+    # peeking is idempotent
+    assert reader.peek_length(PAE_UCHAR) == 1
+    assert reader.read_next(PAE_UCHAR) == 1
+    assert reader.skip_next() == 3
+    assert reader.index == 2
+    assert reader.read_next(PAEBytes()) == b'xy'
+    assert reader.bytes_read == len(encoded)
+    reader.finish()
+    with pytest.raises(IndexError):
+        reader.peek_length()
+
+
+@pytest.mark.parametrize('stream_type', [BytesIO, NonSeekableReader])
+def test_list_reader_skip(stream_type):
+    lst_type = PAEHomogeneousList(PAEString(), settings=NO_CONST_PREFIX)
+    encoded = marshal(['a' * 65000, 'bc'], lst_type)
+    reader = PAEListReader(stream_type(encoded), NO_CONST_PREFIX)
+    assert reader.skip_next(PAEString()) == 65000
+    assert reader.read_next(PAEString()) == 'bc'
+    reader.finish()
+
+
+def test_list_reader_skip_truncated():
+    reader = PAEListReader(
+        NonSeekableReader(b'\x01\x00\x05\x00abc'), WITH_CONST_PREFIX
+    )
+    with pytest.raises(PAEDecodeError, match='only 3'):
+        reader.skip_next()
+
+
+def test_list_reader_type_required():
+    reader = PAEListReader(BytesIO(b'\x01\x00\x05'), NO_CONST_PREFIX)
+    with pytest.raises(ValueError, match='type of the next element'):
+        reader.peek_length()
+    assert reader.peek_length(PAE_UCHAR) == 1
+    assert reader.read_next(PAE_UCHAR) == 5
+
+
+def test_list_reader_finish_early():
+    reader = PAEListReader(
+        BytesIO(b'\x02\x00\x01\x00a\x01\x00b'), WITH_CONST_PREFIX
+    )
+    reader.read_next(PAEBytes())
+    with pytest.raises(ValueError, match='Only 1 of 2'):
+        reader.finish()
+    reader.peek_length()
+    with pytest.raises(ValueError, match='Only 1 of 2'):
+        reader.finish()
+
+
+@pytest.mark.parametrize('inp,match', [
+    (b'\x02\x00\x05\x00abc', 'too long'),
+    (b'\x01\x00\x01\x00ab', 'trailing data'),
+    (b'\x01\x00\x01', 'Failed to read length prefix'),
+])
+def test_list_reader_errors(inp, match):
+    reader = PAEListReader(BytesIO(inp), WITH_CONST_PREFIX, len(inp))
+    with pytest.raises(PAEDecodeError, match=match):
+        reader.read_next(PAEBytes())
+
+
+@pytest.mark.parametrize('inp', [b'', b'\x01'])
+def test_list_reader_truncated_size(inp):
+    with pytest.raises(PAEDecodeError, match='list size'):
+        PAEListReader(BytesIO(inp), PAEListSettings())
+
+
+def test_list_reader_limits():
+    encoded = b'\x02\x00\x05\x00abcde\x01\x00f'
+    with decode_limits(PAEDecodeLimits(max_field_length=4)):
+        reader = PAEListReader(BytesIO(encoded), WITH_CONST_PREFIX)
+        with pytest.raises(PAEDecodeError, match='exceeds maximum'):
+            reader.skip_next()
+    with decode_limits(PAEDecodeLimits(max_elements=1)):
+        with pytest.raises(PAEDecodeError, match='element budget'):
+            PAEListReader(BytesIO(encoded), WITH_CONST_PREFIX)
+
+
+def test_list_reader_instrumented():
+    encoded = b'\x02\x00\x01\x00a\x02\x00bc'
+    with collecting() as events:
+        reader = PAEListReader(BytesIO(encoded), WITH_CONST_PREFIX)
+        assert reader.read_next(PAEBytes()) == b'a'
+        reader.skip_next()
+        reader.finish()
+    assert [e.nbytes for e in events] == [3]
+    assert isinstance(events[0].pae_type, PAEBytes)
+
+
+def test_empty_list_trailing_data():
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        unmarshal(b'\x00\x00z', lst_type)
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        list(iter_unmarshal(BytesIO(b'\x00\x00z'), lst_type, length=3))
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        pae_decode(b'\x00\x00z', PAE_USHORT)
+    coro = read_pae_coro(BytesIO(b'\x00\x00z'), NO_CONST_PREFIX, 3)
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        next(coro)
+
+    async def run():
+        return await unmarshal_async(
+            _reader_for(b'\x00\x00z'), lst_type, length=3
+        )
+
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        asyncio.run(run())
+    with pytest.raises(PAEDecodeError, match='trailing data'):
+        with collecting():
+            unmarshal(b'\x00\x00z', lst_type)
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\x00' * 7 + b'\xb0', PAEHomogeneousList(PAEBytes())),
+    (b'\xff' * 8 + b'\x00', PAEHomogeneousList(PAEBytes())),
+    (b'\xff' * 8, PAEHomogeneousList(PAEHomogeneousList(PAEBytes()))),
+    (b'\xff' * 8 + b'\x01', PAEHomogeneousList(
+        PAE_UCHAR, settings=PAEListSettings(prefix_if_constant=True)
+    )),
+])
+def test_hostile_list_count(inp, pae_type):
+    with pytest.raises(PAEDecodeError):
+        unmarshal(inp, pae_type)
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'\x00' * 7 + b'\xb0', PAEHomogeneousList(PAEBytes())),
+    (b'\xff' * 8 + b'\x00', PAEHomogeneousList(PAEBytes())),
+    (b'\xff' * 8, PAEHomogeneousList(PAEHomogeneousList(PAEBytes()))),
+])
+def test_hostile_list_count_async(inp, pae_type):
+    async def run():
+        return await unmarshal_async(_reader_for(inp), pae_type)
+
+    with pytest.raises(PAEDecodeError):
+        asyncio.run(run())
+
+
+def test_hostile_list_count_pae_decode():
+    with pytest.raises(PAEDecodeError):
+        pae_decode(b'\xff' * 8)
+
+
+@pytest.mark.parametrize('inp,pae_type', [
+    (b'', PAE_UCHAR),
+    (b'\x02\x00\x03\x00\x01\x02\x03\x01\x00x', PAEHeterogeneousList(
+        [PAE_UINT, PAEBytes()], settings=WITH_CONST_PREFIX
+    )),
+    (b'\xff' * 8 + b'\x00', PAEHomogeneousList(PAEBytes())),
+    (b'\xff' * 8 + b'\x00', PAEHomogeneousList(PAEHomogeneousList(
+        PAEBytes()
+    ))),
+])
+def test_validate_rejects_what_unmarshal_rejects(inp, pae_type):
+    with pytest.raises(PAEDecodeError):
+        unmarshal(inp, pae_type)
+    with pytest.raises(PAEDecodeError):
+        validate(inp, pae_type)
+    with pytest.raises(PAEDecodeError):
+        validate(NonSeekableReader(inp), pae_type, length=len(inp))
+
+
+def test_validate_number_wrong_length():
+    with pytest.raises(PAEDecodeError, match='Expected 1 bytes'):
+        validate(b'\x01\x02', PAE_UCHAR)
+
+
+@pytest.mark.parametrize('inp,length', [
+    (b'\x01\x00\x0a\x00abc', None),
+    (b'\x01\x00\x0a\x00abc', 14),
+    (b'\x02\x00\x01\x00a\x0a\x00abc', None),
+    (b'\x01', None),
+    (b'', None),
+])
+def test_iter_unmarshal_truncated(inp, length):
+    lst_type = PAEHomogeneousList(PAEBytes(), settings=NO_CONST_PREFIX)
+    with pytest.raises(PAEDecodeError):
+        list(iter_unmarshal(BytesIO(inp), lst_type, length=length))
+
+
+@pytest.mark.parametrize('item_len', [2 ** 45, 2 ** 63, 2 ** 64 - 1])
+def test_iter_unmarshal_huge_prefix_file(tmp_path, item_len):
+    lst_type = PAEHomogeneousList(PAEBytes())
+    path = tmp_path / 'huge.bin'
+    path.write_bytes(PAE_ULLONG.pack(1) + PAE_ULLONG.pack(item_len) + b'abc')
+    with path.open('rb') as f:
+        with pytest.raises(PAEDecodeError, match='too long'):
+            list(iter_unmarshal(f, lst_type))
+
+
+@pytest.mark.parametrize('item_len', [2 ** 45, 2 ** 63, 2 ** 64 - 1])
+def test_iter_unmarshal_huge_prefix_non_seekable(item_len):
+    lst_type = PAEHomogeneousList(PAEBytes())
+    inp = PAE_ULLONG.pack(1) + PAE_ULLONG.pack(item_len) + b'abc'
+    with pytest.raises(PAEDecodeError, match='only 19 were available'):
+        list(iter_unmarshal(NonSeekableReader(inp), lst_type))
+
+
+def test_iter_unmarshal_truncated_nested():
+    encoded = marshal(NESTED_LIST_VALUE, NESTED_LIST_TYPE)
+    with pytest.raises(PAEDecodeError):
+        list(iter_unmarshal(BytesIO(encoded[:-1]), NESTED_LIST_TYPE))